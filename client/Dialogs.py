@@ -2,6 +2,7 @@ import base64
 import copy
 import os
 import random
+import re
 import secrets
 import time
 from datetime import datetime
@@ -11,7 +12,7 @@ from PySide6.QtWidgets import (
     QApplication, QDialog, QSizePolicy, QVBoxLayout, QHBoxLayout, QFormLayout,
     QLineEdit, QPushButton, QDialogButtonBox, QLabel,
     QMessageBox, QCheckBox, QListWidget, QListWidgetItem,
-    QWidget, QTreeWidget, QTreeWidgetItem, QComboBox, QProgressBar,
+    QWidget, QTreeWidget, QTreeWidgetItem, QComboBox, QProgressBar, QPlainTextEdit,
     QGraphicsDropShadowEffect, QScrollArea, QApplication, QMenu, QFileDialog
 )
 from PySide6.QtCore import QBuffer, QDir, QIODevice, QPoint, QSize, Qt, QTimer, QThread, Signal, QPropertyAnimation, QEasingCurve, QByteArray
@@ -627,10 +628,22 @@ class NodeEditDialog(QDialog):
         return{'remark':remark,'server_addr':addr,'server_port':int(port_str),'token':self.token_input.text().strip()}
 class ManageSharesDialog(QDialog):
     def __init__(self,share_api_client,session_token,parent=None):
-        super().__init__(parent);self.share_api_client = share_api_client;self.session_token=session_token;self.setWindowTitle("管理我的分享");self.setMinimumSize(500,300);layout=QVBoxLayout(self);self.list_widget=QListWidget();self.list_widget.setToolTip("双击可复制分享ID");layout.addWidget(QLabel("您创建的分享列表："));layout.addWidget(self.list_widget);button_layout=QHBoxLayout();self.refresh_button=QPushButton("刷新列表");self.close_button=QPushButton("关闭");button_layout.addWidget(self.refresh_button);button_layout.addStretch();button_layout.addWidget(self.close_button);layout.addLayout(button_layout);self.refresh_button.clicked.connect(self.refresh_list);self.close_button.clicked.connect(self.reject);self.list_widget.itemDoubleClicked.connect(self.copy_share_id);self.refresh_list()
+        super().__init__(parent);self.share_api_client = share_api_client;self.session_token=session_token;self.setWindowTitle("管理我的分享");self.setMinimumSize(500,300);layout=QVBoxLayout(self);self.list_widget=QListWidget();self.list_widget.setToolTip("双击可复制分享ID");layout.addWidget(QLabel("您创建的分享列表："));layout.addWidget(self.list_widget);button_layout=QHBoxLayout();self.refresh_button=QPushButton("刷新列表");self.close_button=QPushButton("关闭");button_layout.addWidget(self.refresh_button);button_layout.addStretch();button_layout.addWidget(self.close_button);layout.addLayout(button_layout);self.refresh_button.clicked.connect(self.refresh_list);self.close_button.clicked.connect(self.reject);self.list_widget.itemDoubleClicked.connect(self.copy_share_id);self.pending_futures=[];self.refresh_list()
+    def track(self, future):
+        """记录进行中的请求。share_api_client 是异步端点，对话框关闭时取消未完成的请求，结果不会再回调到已关闭的对话框。"""
+        self.pending_futures = [f for f in self.pending_futures if f.is_pending()] + [future]
+        return future
+    def done(self, result):
+        for future in self.pending_futures: future.cancel()
+        super().done(result)
     def refresh_list(self):
         self.list_widget.clear()
-        success, data = self.share_api_client.list_my(self.session_token)
+        self.list_widget.addItem("正在加载...")
+        self.refresh_button.setEnabled(False)
+        self.track(self.share_api_client.list_my(self.session_token)).then(self.on_list_loaded)
+    def on_list_loaded(self, success, data):
+        self.refresh_button.setEnabled(True)
+        self.list_widget.clear()
         if not success:
             QMessageBox.critical(self, "错误", f"获取分享列表失败: {data}")
             return
@@ -669,19 +682,76 @@ class ManageSharesDialog(QDialog):
     def handle_revoke_share(self):
         share_id=self.sender().property("share_id");share_name=self.sender().property("share_name");reply=QMessageBox.question(self,"确认撤销",f"您确定要永久撤销分享 '{share_name}' 吗？\n\n所有订阅了此分享的用户将立即无法使用。",QMessageBox.Yes|QMessageBox.No,QMessageBox.No)
         if reply == QMessageBox.Yes:
-            # 使用 share_api_client 进行调用。
-            success, message = self.share_api_client.revoke(self.session_token, share_id)
-            if success:
-                QMessageBox.information(self, "成功", "分享已成功撤销。")
-                self.refresh_list()
-            else:
-                QMessageBox.critical(self, "失败", f"撤销分享失败: {message}")
+            # 使用 share_api_client 进行调用，请求期间禁用这个撤销按钮
+            self.sender().setEnabled(False)
+            self.track(self.share_api_client.revoke(self.session_token, share_id)).then(self.on_revoke_finished)
+    def on_revoke_finished(self, success, message):
+        if success:
+            QMessageBox.information(self, "成功", "分享已成功撤销。")
+        else:
+            QMessageBox.critical(self, "失败", f"撤销分享失败: {message}")
+        # 成功时移除已撤销的分享，失败时恢复按钮
+        self.refresh_list()
     def copy_share_id(self,item):
         widget=self.list_widget.itemWidget(item)
         if not widget:return
         label_text=widget.findChild(QLabel).text()
         try:share_id=label_text.split("ID: ")[1].split(")")[0];QApplication.clipboard().setText(share_id);QMessageBox.information(self,"已复制",f"分享ID '{share_id}' 已复制到剪贴板。")
         except IndexError:pass
+class AddSubscriptionsDialog(QDialog):
+    """
+    批量添加分享订阅：粘贴或从文本文件导入任意格式的分享ID列表（每行一个、逗号分隔或夹在其他文字中均可）。
+    """
+    SHARE_ID_PATTERN = re.compile(r'share-[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}')
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("添加分享订阅")
+        self.setMinimumSize(480, 320)
+        layout = QVBoxLayout(self)
+        layout.addWidget(QLabel("请粘贴您收到的分享ID，可以一次粘贴多个："))
+        self.ids_edit = QPlainTextEdit()
+        self.ids_edit.setPlaceholderText("share-xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx\nshare-...")
+        layout.addWidget(self.ids_edit)
+        self.count_label = QLabel()
+        layout.addWidget(self.count_label)
+
+        button_layout = QHBoxLayout()
+        self.import_button = QPushButton("从文件导入...")
+        button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        self.ok_button = button_box.button(QDialogButtonBox.Ok)
+        button_layout.addWidget(self.import_button)
+        button_layout.addStretch()
+        button_layout.addWidget(button_box)
+        layout.addLayout(button_layout)
+
+        self.import_button.clicked.connect(self.import_from_file)
+        self.ids_edit.textChanged.connect(self.update_count)
+        button_box.accepted.connect(self.accept)
+        button_box.rejected.connect(self.reject)
+        self.update_count()
+
+    def get_share_ids(self):
+        """返回去重后的分享ID列表（保持原顺序）。文本中找不到标准格式的ID时，按空白和逗号拆分原样使用。"""
+        text = self.ids_edit.toPlainText()
+        share_ids = self.SHARE_ID_PATTERN.findall(text) or [part for part in re.split(r'[\s,;，；]+', text) if part]
+        return list(dict.fromkeys(share_ids))
+
+    def update_count(self):
+        count = len(self.get_share_ids())
+        self.count_label.setText(f"已识别 {count} 个分享ID")
+        self.ok_button.setEnabled(count > 0)
+
+    def import_from_file(self):
+        file_path, _ = QFileDialog.getOpenFileName(self, "导入分享ID列表", "", "文本文件 (*.txt *.csv);;所有文件 (*)")
+        if not file_path: return
+        try:
+            with open(file_path, 'r', encoding='utf-8-sig', errors='replace') as f: content = f.read()
+        except OSError as e:
+            QMessageBox.critical(self, "错误", f"读取文件失败: {e}"); return
+        existing = self.ids_edit.toPlainText().strip()
+        self.ids_edit.setPlainText(f"{existing}\n{content}" if existing else content)
+
 class CreateShareDialog(QDialog):
     def __init__(self,current_config,parent=None):
         super().__init__(parent);self.setWindowTitle("创建分享");self.setMinimumWidth(400);self.current_config=current_config;self.layout=QVBoxLayout(self);form_layout=QFormLayout();self.share_name_input=QLineEdit();self.is_template_checkbox=QCheckBox("作为模板分享 (对方可自定义本地端口等)");self.nodes_tree=QTreeWidget();self.nodes_tree.setHeaderHidden(True);form_layout.addRow("分享名称:",self.share_name_input);form_layout.addRow(self.is_template_checkbox);form_layout.addRow("包含的节点(模板模式):",self.nodes_tree);self.is_template_checkbox.toggled.connect(self.nodes_tree.setVisible);self.populate_nodes();self.layout.addLayout(form_layout);button_box=QDialogButtonBox(QDialogButtonBox.Ok|QDialogButtonBox.Cancel);button_box.accepted.connect(self.accept);button_box.rejected.connect(self.reject);self.layout.addWidget(button_box)
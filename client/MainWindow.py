@@ -1,16 +1,19 @@
 # --- 主窗口 ---
 import base64
-from Dialogs import CreateShareDialog, HardenedDelayDialog, ImageViewerDialog, LoginDialog, ManageSharesDialog, NodeEditDialog, ProxyEditDialog, ProxySettingsDialog, QFileDialog
+from Dialogs import AddSubscriptionsDialog, CreateShareDialog, HardenedDelayDialog, ImageViewerDialog, LoginDialog, ManageSharesDialog, NodeEditDialog, ProxyEditDialog, ProxySettingsDialog, QFileDialog
 from ImageLabel import ImageLabel
 from api import ApiClient
 from api.base import BaseClient
-from config import CLIENT_VERSION, CLIENT_VERSION_STR, CLOUD_SERVER_URL, CUTE_COPY_AS_ICON_BASE64, CUTE_REFRESH_AS_ICON_BASE64, IMAGE_FETCH_GLOBAL_TIMEOUT_MS, IMAGE_REFRESH_INTERVAL_MS, IMAGE_SOURCES, VERSION_SECRET, CUTE_SAVE_AS_ICON_BASE64
+from async_api import AsyncApiClient
+from config import CLIENT_VERSION, CLIENT_VERSION_STR, CLOUD_SAVE_EXIT_TIMEOUT_MS, CLOUD_SERVER_URL, CUTE_COPY_AS_ICON_BASE64, CUTE_REFRESH_AS_ICON_BASE64, IMAGE_FETCH_GLOBAL_TIMEOUT_MS, IMAGE_REFRESH_INTERVAL_MS, IMAGE_SOURCES, LATENCY_AUTO_MAX_AGE_S, LATENCY_HISTORY_MAX_AGE_S, LATENCY_HISTORY_MAX_NODES, LATENCY_HISTORY_SIZE, PING_CONNECT_TIMEOUT_MS, PING_DEADLINE_MS, PING_MAX_CONCURRENCY, PING_SAMPLES_PER_NODE, VERSION_SECRET, CUTE_SAVE_AS_ICON_BASE64
 from security import EncryptionManager
-from threads import ImageFetcherThread, LogReaderThread, PingThread, RefreshThread
+from tasks import PRIORITY_BACKGROUND, PRIORITY_USER, TaskExecutor
+from latency import LatencyHistory, probe_nodes
+from threads import LogReaderThread, EventListenerThread, fetch_image
 from utils import get_file_sha256, resource_path
 
 import toml
-from PySide6.QtCore import QBuffer, QByteArray, QIODevice, QSettings, QThread, QTimer, Qt, Signal
+from PySide6.QtCore import QBuffer, QByteArray, QIODevice, QSettings, QTimer, Qt
 from PySide6.QtGui import QColor, QIcon, QImageReader, QMovie, QPalette, QPixmap
 from PySide6.QtWidgets import QAbstractItemView, QApplication, QComboBox, QDialog, QFormLayout, QGroupBox, QHBoxLayout, QHeaderView, QInputDialog, QLabel, QListWidget, QListWidgetItem, QMainWindow, QMenu, QMessageBox, QPushButton, QSplitter, QStackedWidget, QStyle, QTableWidget, QTableWidgetItem, QTextEdit, QVBoxLayout, QWidget
 
@@ -23,9 +26,16 @@ import re
 import subprocess
 import sys
 import tempfile
+import time
 import uuid
 from datetime import datetime
 
+# 开发模式下 frpc 子进程的入口脚本
+FRPC_RUNNER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'frpc_runner.py')
+# 节点下拉框中"自动选择"条目的关联数据；分享模板的 node_remark 保存为 AUTO_NODE_REMARK
+AUTO_NODE_REMARK = '__auto__'
+AUTO_NODE = {'auto': True, 'remark': AUTO_NODE_REMARK}
+
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -48,10 +58,16 @@ class MainWindow(QMainWindow):
         # 使用已创建的工具加载应用配置 ---
         self.app_settings = self._load_app_settings()
         print(f"程序启动，加载的应用设置: {self.app_settings}")
+        self.latency_history = self._load_latency_history()
         self._update_proxy_from_settings()
         self.api_client = ApiClient(CLOUD_SERVER_URL)
+        # 所有后台工作（API请求、图片、测速）共用一个有上限的线程池，用户操作优先于后台轮询
+        self.task_executor = TaskExecutor(self)
+        self.async_api = AsyncApiClient(self.api_client, self.task_executor)
+        self.background_api = AsyncApiClient(self.api_client, self.task_executor, priority=PRIORITY_BACKGROUND)
         # 初始化其他所有业务逻辑和UI组件 ---
-        self.image_fetch_thread = None
+        self.image_fetch_future = None
+        self.ping_future = None
         self.is_fetching_image = False
         self.current_source_index = 0
         self.image_sources = IMAGE_SOURCES
@@ -70,6 +86,8 @@ class MainWindow(QMainWindow):
 
         self.is_running = False
         self.frp_process = None
+        self.frp_launch_started = None # 点击启动的时刻，收到 frpc 的第一行日志时输出启动耗时
+        self.launch_future = None # 正在申请的配置票据，期间可以取消启动
         self.running_config = {}
         self.guest_config_path = None
 
@@ -82,15 +100,29 @@ class MainWindow(QMainWindow):
         self.is_forced_exit = False
         self.has_shown_connection_error = False
 
+        # 会话状态和配置变更由服务器事件流推送；这两个定时轮询只在服务器不支持事件流时作为后备
+        self.event_listener = None
         self.session_timer = QTimer(self)
         self.session_timer.timeout.connect(self.check_session_status)
 
         self.refresh_timer = QTimer(self)
         self.refresh_timer.setInterval(30000)
         self.refresh_timer.timeout.connect(self.handle_silent_refresh)
+        # frpc 运行期间或同步期间收到的配置变更，等服务停止或同步完成后再刷新
+        self.pending_silent_refresh = False
 
         self.profiles = {'guest': {'type': 'guest', 'data': {}}}
         self.current_profile_id = 'guest'
+        # 服务器上各云端配置/订阅的最后已知状态：{profile_id: {'type', 'payload', 'revision'}}，用于计算增量同步
+        self.cloud_sync_state = {}
+        # 上次从 /api/configs 获取到的版本标识，后台刷新时用于条件请求
+        self.configs_etag = None
+        # 完整分享的编译结果：{share_id: (etag, final_toml_data)}，切换配置时用条件请求复用
+        self.full_share_cache = {}
+        self.full_share_future = None
+        # 进行中的增量同步。它返回新修订号之前再次保存会被服务器当作冲突，因此排队到它完成后再执行
+        self.cloud_save_future = None
+        self.cloud_save_queued = False
 
         self.init_ui()
         self.update_ui_for_login_status(False)
@@ -166,10 +198,10 @@ class MainWindow(QMainWindow):
 
         print(f"[Timeout] 全局图片获取超时（超过 {IMAGE_FETCH_GLOBAL_TIMEOUT_MS / 1000} 秒）。正在强制刷新...")
 
-        # 终止当前正在下载的线程
-        if self.image_fetch_thread and self.image_fetch_thread.isRunning():
-            self.image_fetch_thread.terminate() # 强制终止
-            self.image_fetch_thread.wait()      # 等待线程完全停止
+        # 取消当前的下载：结果不再回调，任务在读完当前数据块后自行结束
+        if self.image_fetch_future is not None:
+            self.image_fetch_future.cancel()
+            self.image_fetch_future = None
 
         # 重置状态，以便下一次刷新可以正常启动
         self.is_fetching_image = False
@@ -210,10 +242,14 @@ class MainWindow(QMainWindow):
 
         print(f"[Image Fetch] 正在尝试源 {self.current_source_index}: {source_object.get('url')}")
 
-        self.image_fetch_thread = ImageFetcherThread(source_object)
-        self.image_fetch_thread.image_ready.connect(self.on_image_loaded)
-        self.image_fetch_thread.error_occurred.connect(self.on_image_fetch_error)
-        self.image_fetch_thread.start()
+        self.image_fetch_future = self.task_executor.submit(fetch_image, source_object, name='image.fetch',
+                                                           priority=PRIORITY_BACKGROUND, with_context=True)
+        self.image_fetch_future.then(self.on_image_fetch_finished)
+
+    def on_image_fetch_finished(self, success, data):
+        self.image_fetch_future = None
+        if success: self.on_image_loaded(QByteArray(data))
+        else: self.on_image_fetch_error(data)
 
     def _handle_single_source_failure(self, error_message, next_source_index):
         """ 当单个源失败时被调用，准备尝试下一个源 """
@@ -477,7 +513,7 @@ class MainWindow(QMainWindow):
         if profile['type'] in ['guest', 'cloud']: profile['data'] = self.get_config_from_ui()
         elif profile['type'] == 'share' and profile.get('is_template'):
             user_params = {'proxies': self.get_proxies_from_ui()}
-            if hasattr(self, 'node_selector'): user_params['node_remark'] = self.node_selector.currentText()
+            if hasattr(self, 'node_selector') and self.node_selector.currentData(): user_params['node_remark'] = self.node_selector.currentData().get('remark')
             profile['user_params'] = user_params
 
     def load_data_for_profile(self, profile_id):
@@ -488,11 +524,13 @@ class MainWindow(QMainWindow):
             is_template = profile.get('is_template', False)
             self.shared_proxy_group.setEnabled(is_template); self.node_selector.parent().setVisible(is_template); self.node_label.setVisible(not is_template)
             if is_template:
-                self.node_selector.clear(); self.update_active_node_selector(profile.get('nodes',[]), self.node_selector)
-                if profile.get('user_params', {}).get('node_remark'): self.node_selector.setCurrentText(profile.get('user_params').get('node_remark'))
+                self.cancel_ping(); self.node_selector.clear(); self.update_active_node_selector(profile.get('nodes',[]), self.node_selector)
+                if profile.get('user_params', {}).get('node_remark'): self.select_node_by_remark(self.node_selector, profile.get('user_params').get('node_remark'))
                 proxies = profile.get('user_params', {}).get('proxies', [])
             else:
-                success, data = self.api_client.use_share(profile['share_id'], {}); proxies = data.get('final_toml_data', {}).get('proxies', []) if success else []
+                # 先显示缓存的规则（没有时为空），后台获取到最新结果后再更新
+                cached = self.full_share_cache.get(profile['share_id']); proxies = cached[1].get('proxies', []) if cached else []
+                self.use_full_share(profile_id, profile['share_id'])
             self.set_proxies_to_ui(proxies)
         else:
             self.stacked_widget.setCurrentWidget(self.editable_page); self.set_config_to_ui(profile.get('data', {}))
@@ -504,6 +542,28 @@ class MainWindow(QMainWindow):
             self.save_cloud_button.setVisible(is_cloud); self.share_button.setVisible(is_cloud)
         self.update_ui_for_run_status(self.is_running)
 
+    def use_full_share(self, profile_id, share_id):
+        """在后台获取完整分享编译好的 final_toml_data，分享未变化时复用本地缓存。切换配置时取消上一个未完成的请求。"""
+        if self.full_share_future is not None: self.full_share_future.cancel()
+        cached = self.full_share_cache.get(share_id)
+        self.full_share_future = self.async_api.share.use(share_id, {}, cached[0] if cached else None)
+        self.full_share_future.then(lambda success, data: self.on_full_share_loaded(profile_id, share_id, success, data))
+
+    def on_full_share_loaded(self, profile_id, share_id, success, data):
+        self.full_share_future = None
+        cached = self.full_share_cache.get(share_id)
+        if not success:
+            self.full_share_cache.pop(share_id, None)
+            final_toml_data = {}
+        elif data.get('not_modified') and cached:
+            final_toml_data = cached[1]
+        else:
+            final_toml_data = data.get('final_toml_data', {})
+            self.full_share_cache[share_id] = (data.get('etag'), final_toml_data)
+        # 结果返回前用户可能已经切换了配置或启动了服务
+        if self.current_profile_id == profile_id and not self.is_running:
+            self.set_proxies_to_ui(final_toml_data.get('proxies', []))
+
     def get_config_from_ui(self): return {'nodes': self.get_nodes_from_ui(), 'proxies': self.get_proxies_from_ui()}
 
     def set_config_to_ui(self, data):
@@ -608,7 +668,7 @@ class MainWindow(QMainWindow):
 
     def handle_login(self):
         """
-        处理用户登录，采用“先强制延时，后网络验证”的线性、扁平化流程。
+        处理用户登录：先强制延时，再在后台依次获取挑战码、发送登录请求，等待服务器期间界面保持响应。
         """
         # --- 步骤 1: 获取用户凭据 ---
         dialog = LoginDialog("登录", self,
@@ -625,9 +685,8 @@ class MainWindow(QMainWindow):
         delay_dialog.start_delay()  # 这会阻塞，直到动画播放完毕
         self.log_to_gui("安全延时完成。")
 
-        # --- 步骤 3: 执行所有可能失败的操作，并用一个 try...except 块统一处理 ---
+        # --- 步骤 3: 准备本地凭据 (计算哈希) ---
         try:
-            # a. 准备本地凭据 (计算哈希)
             self.log_to_gui("正在准备安全凭据...")
             dll_path = resource_path("MoeFrpClient.mfc")
             if not os.path.exists(dll_path):
@@ -636,57 +695,64 @@ class MainWindow(QMainWindow):
             dll_hash = get_file_sha256(dll_path)
             if not dll_hash:
                 raise ValueError("未能成功计算核心组件的哈希值。")
+        except Exception as e:
+            self.on_login_failed(str(e))
+            return
 
-            # b. 获取挑战码
-            self.log_to_gui("正在从服务器获取安全挑战码...")
-            success, challenge_data = self.api_client.auth.get_login_challenge(nickname)
-            if not success:
-                # 直接抛出从API收到的错误信息
-                #raise Exception(f"获取挑战码失败: {challenge_data}") 
-                raise Exception(f"获取挑战码失败") # 可选，上面的会有更多信息
-            challenge = challenge_data.get('challenge')
-
-            # c. 计算登录证明 (Proof)
-            self.log_to_gui("正在计算登录证明(Proof)...")
-            message_to_hash = f"{VERSION_SECRET}:{dll_hash}:{CLIENT_VERSION}:{challenge}"
-            h = hashlib.sha256()
-            h.update(message_to_hash.encode('utf-8'))
-            proof = h.hexdigest()
-
-            # d. 正式登录
-            self.log_to_gui("正在发送登录请求...")
-            success, data = self.api_client.auth.login(
-                nickname, password, CLIENT_VERSION, VERSION_SECRET, dll_hash, challenge, proof
-            )
-            if not success:
-                # 直接抛出从API收到的错误信息
-                raise Exception(str(data))
-
-            # --- 如果以上所有步骤都成功，才会执行到这里 ---
-            # e. 处理成功结果
-            self.log_to_gui(f"欢迎，{nickname}！登录成功。", "green")
-            self.session_token = data.get('session_token')
-            self.logged_in_nickname = nickname
-
-            if remember_me:
-                self.app_settings['nickname'] = nickname
-                self.app_settings['password'] = password
-            else:
-                self.app_settings.pop('nickname', None)
-                self.app_settings.pop('password', None)
-            self._save_app_settings()
+        # --- 步骤 4: 获取挑战码，完成后在 on_login_challenge 中继续 ---
+        # 请求期间禁用登录按钮，防止重复提交
+        self.login_button.setEnabled(False)
+        self.log_to_gui("正在从服务器获取安全挑战码...")
+        self.async_api.auth.get_login_challenge(nickname).then(
+            lambda success, data: self.on_login_challenge(success, data, nickname, password, remember_me, dll_hash))
 
-            self.update_ui_for_login_status(True)
-            self.handle_cloud_load()  # 这个也可能失败，所以放在 try 块里
-            self.session_timer.start(30000)
-            self.refresh_timer.start()
+    def on_login_challenge(self, success, challenge_data, nickname, password, remember_me, dll_hash):
+        if not success:
+            print(f"[Login] Get challenge failed: {challenge_data}")
+            self.on_login_failed("获取挑战码失败")
+            return
+        challenge = challenge_data.get('challenge')
+
+        # 计算登录证明 (Proof)
+        self.log_to_gui("正在计算登录证明(Proof)...")
+        message_to_hash = f"{VERSION_SECRET}:{dll_hash}:{CLIENT_VERSION}:{challenge}"
+        h = hashlib.sha256()
+        h.update(message_to_hash.encode('utf-8'))
+        proof = h.hexdigest()
+
+        # 正式登录
+        self.log_to_gui("正在发送登录请求...")
+        self.async_api.auth.login(
+            nickname, password, CLIENT_VERSION, VERSION_SECRET, dll_hash, challenge, proof
+        ).then(lambda success, data: self.on_login_finished(success, data, nickname, password, remember_me))
+
+    def on_login_finished(self, success, data, nickname, password, remember_me):
+        if not success:
+            self.on_login_failed(str(data))
+            return
 
-        except Exception as e:
-            # --- 统一的失败处理 ---
-            # 捕获以上任何步骤中抛出的异常
-            error_message = str(e)
-            self.log_to_gui(f"登录失败: {error_message}", "red")
-            QMessageBox.critical(self, "登录失败", error_message)
+        self.login_button.setEnabled(True)
+        self.log_to_gui(f"欢迎，{nickname}！登录成功。", "green")
+        self.session_token = data.get('session_token')
+        self.logged_in_nickname = nickname
+
+        if remember_me:
+            self.app_settings['nickname'] = nickname
+            self.app_settings['password'] = password
+        else:
+            self.app_settings.pop('nickname', None)
+            self.app_settings.pop('password', None)
+        self._save_app_settings()
+
+        self.update_ui_for_login_status(True)
+        self.handle_cloud_load()
+        self.start_event_listener()
+
+    def on_login_failed(self, error_message):
+        """登录任一步骤失败时的统一处理。"""
+        self.login_button.setEnabled(True)
+        self.log_to_gui(f"登录失败: {error_message}", "red")
+        QMessageBox.critical(self, "登录失败", error_message)
 
     def handle_logout(self, show_confirm=True):
         """
@@ -701,6 +767,18 @@ class MainWindow(QMainWindow):
 
         self.log_to_gui("正在退出当前会话...", "orange")
 
+        # 先断开事件流，避免收到自己注销产生的下线通知
+        self.stop_event_listener()
+        # 通知服务器注销令牌：在后台发出且不等待结果，服务器无响应也不影响本地退出。
+        # 不放入 API 分组，下面的 cancel_all() 不会取消它
+        if self.session_token:
+            self.task_executor.submit(self.api_client.auth.logout, self.session_token, name='api.auth.logout', priority=PRIORITY_USER)
+        # 旧会话还没返回的请求结果不再处理（包括未完成的同步）
+        self.async_api.cancel_all()
+        self.cloud_save_future = None
+        self.cloud_save_queued = False
+        self.full_share_future = None
+
         # 步骤1: 清除会话信息
         self.session_token = None
         self.logged_in_nickname = None
@@ -708,6 +786,7 @@ class MainWindow(QMainWindow):
         # 步骤2: 停止所有后台定时器
         self.session_timer.stop()
         self.refresh_timer.stop()
+        self.pending_silent_refresh = False
 
         # 这里不调用 _clear_local_settings()
 
@@ -716,6 +795,8 @@ class MainWindow(QMainWindow):
 
         # 步骤5: 重置配置字典和UI列表，仅保留游客模式
         self.profiles = {'guest': {'type': 'guest', 'data': {}}}
+        self.cloud_sync_state = {}
+        self.configs_etag = None
         self.refresh_profile_list()
 
         self.log_to_gui("您已成功退出。")
@@ -786,6 +867,25 @@ class MainWindow(QMainWindow):
         except Exception as e:
             print(f"保存应用设置失败: {e}")
 
+    def _load_latency_history(self):
+        """从 QSettings 加载节点测速历史。与应用设置一样加密保存，读取失败时从空记录开始。"""
+        history_args = dict(size=LATENCY_HISTORY_SIZE, max_nodes=LATENCY_HISTORY_MAX_NODES, max_age=LATENCY_HISTORY_MAX_AGE_S)
+        encrypted_data_str = self.qt_settings.value("node_latency_history", "")
+        if not encrypted_data_str: return LatencyHistory(**history_args)
+        try:
+            data = json.loads(self.encryption_manager.decrypt(encrypted_data_str.encode('utf-8')))
+            return LatencyHistory(data, **history_args)
+        except Exception as e:
+            print(f"加载节点测速历史失败，将重新记录。错误: {e}")
+            return LatencyHistory(**history_args)
+
+    def _save_latency_history(self):
+        try:
+            data_to_encrypt = json.dumps(self.latency_history.to_dict(), separators=(',', ':')).encode('utf-8')
+            self.qt_settings.setValue("node_latency_history", self.encryption_manager.encrypt(data_to_encrypt).decode('utf-8'))
+        except Exception as e:
+            print(f"保存节点测速历史失败: {e}")
+
     def _clear_app_settings(self):
         """
         删除 QSettings 创建的整个应用配置目录，并清除系统密钥环中的主密钥。
@@ -813,6 +913,7 @@ class MainWindow(QMainWindow):
         print("[CleanUp] 清理完成。下次启动将使用全新默认设置。")
 
     def force_logout(self, message):
+        self.stop_event_listener(wait_ms=2000)
         self.refresh_timer.stop()
         self.session_timer.stop()
         if self.is_running:
@@ -825,11 +926,58 @@ class MainWindow(QMainWindow):
         QMessageBox.critical(self, "强制下线", f"{message}\n\n您的账户已在其他设备登录或会话已过期，本程序将关闭。")
         self.close()
 
+    def start_event_listener(self):
+        """登录后连接服务器事件流，代替定时检查会话和轮询配置。"""
+        self.stop_event_listener()
+        self.event_listener = EventListenerThread(self.api_client.events, self.session_token, self)
+        self.event_listener.connected.connect(self.on_event_stream_connected)
+        self.event_listener.config_changed.connect(self.handle_silent_refresh)
+        self.event_listener.share_revoked.connect(self.on_share_revoked_event)
+        self.event_listener.session_invalidated.connect(self.on_session_invalidated_event)
+        self.event_listener.unsupported.connect(self.on_event_stream_unsupported)
+        self.event_listener.finished.connect(self.event_listener.deleteLater)
+        self.event_listener.start()
+
+    def stop_event_listener(self, wait_ms=0):
+        if self.event_listener is None: return
+        listener, self.event_listener = self.event_listener, None
+        # 断开信号，已停止的线程在退出前发出的事件不再处理
+        for signal in (listener.connected, listener.config_changed, listener.share_revoked,
+                       listener.session_invalidated, listener.unsupported):
+            signal.disconnect()
+        listener.stop()
+        if wait_ms: listener.wait(wait_ms)
+
+    def on_event_stream_connected(self, etag):
+        # 首次连接或断线重连后，期间可能错过事件，用 ETag 对齐一次
+        if etag != self.configs_etag: self.handle_silent_refresh()
+
+    def on_share_revoked_event(self, share_id):
+        self.log_to_gui(f"您订阅的分享 {share_id} 已被所有者撤销。", "orange")
+
+    def on_session_invalidated_event(self, reason):
+        messages = {
+            'displaced': "您的账户已在其他设备登录。",
+            'logout': "当前会话已被注销。",
+            'expired': "您的会话已过期。",
+        }
+        self.force_logout(messages.get(reason, reason or "您的会话已在别处登录或已过期。"))
+
+    def on_event_stream_unsupported(self):
+        # 旧版服务器没有事件流，退回到定时轮询
+        self.log_to_gui("服务器不支持实时推送，改为每30秒同步一次。", "orange")
+        self.event_listener = None
+        self.session_timer.start(30000)
+        self.refresh_timer.start()
+
     def handle_silent_refresh(self):
-        if not self.session_token or self.is_running: return
-        self.refresh_thread = RefreshThread(self.api_client.config, self.session_token) # 传递 config 部分
-        self.refresh_thread.finished.connect(self.on_silent_refresh_finished)
-        self.refresh_thread.start()
+        if not self.session_token: return
+        # 运行中或正在同步时推迟：同步完成前合并会把刚上传的改动当作冲突
+        if self.is_running or self.cloud_save_future is not None:
+            self.pending_silent_refresh = True
+            return
+        self.pending_silent_refresh = False
+        self.background_api.config.get_all_configs(self.session_token, self.configs_etag).then(self.on_silent_refresh_finished)
         self.statusBar().showMessage("正在后台同步配置...", 1500)
 
     def on_silent_refresh_finished(self, success, data):
@@ -838,57 +986,91 @@ class MainWindow(QMainWindow):
             else: self.statusBar().showMessage(f"后台同步失败: {data}", 3000)
             return
 
+        # 服务器返回304，云端配置自上次同步以来没有变化
+        if data.get('not_modified'): return
+        # 请求期间开始了同步：结果可能不包含这次同步，等同步完成后重新获取
+        if self.cloud_save_future is not None:
+            self.pending_silent_refresh = True
+            return
+        self.configs_etag = data.get('etag')
+        self._merge_server_configs(data)
+
+    def _profile_from_server(self, item):
+        """把 /api/configs 返回的一个个人配置或订阅转换为 (配置项, 同步基线)。"""
+        if 'config_id' in item:
+            profile = {'type': 'cloud', 'profile_name': item['profile_name'], 'data': json.loads(item['config_json'])}
+        else:
+            profile = {
+                'type': 'share',
+                'share_id': item.get('share_id'),
+                'share_name': item.get('share_name'),
+                'is_template': item.get('is_template'),
+                'user_params': json.loads(item.get('user_params_json') or '{}'),
+                # 从服务器获取节点信息
+                'nodes': json.loads(item.get('share_config_json') or '{}').get('nodes', [])
+            }
+        return profile, {'type': profile['type'], 'payload': self._get_sync_payload(profile), 'revision': item.get('revision', 1)}
+
+    def _merge_server_configs(self, data):
+        """
+        以同步基线为共同版本，把云端的配置合并到本地：
+          - 本地没有未保存的修改：使用云端版本
+          - 本地有未保存的修改，云端自上次同步以来没有变化：保留本地的修改（包括本地的删除），之后照常上传
+          - 两边都修改过：使用云端版本，放弃本地的修改，否则下次保存会用新的基线覆盖其他设备的修改
+          - 从未同步过的本地配置保留；云端已删除而本地有修改的配置保留为新配置
+        返回本地修改被云端版本替换的配置名列表。
+        """
         current_id = self.profile_list_widget.currentItem().data(Qt.UserRole) if self.profile_list_widget.currentItem() else None
-        new_profiles = {'guest': self.profiles.get('guest', {'type': 'guest', 'data': {}})}
+        # 界面上尚未写回的编辑也算作本地修改
+        self.save_current_ui_to_profile(current_id)
 
-        # 处理个人云端配置
-        for config in data.get('personal_configs', []):
-            try:
-                new_profiles[config['config_id']] = {'type': 'cloud', 'profile_name': config['profile_name'], 'data': json.loads(config['config_json'])}
-            except:
-                continue
+        server_items = {}
+        for item in data.get('personal_configs', []) + data.get('subscriptions', []):
+            try: server_items[item.get('config_id') or item['subscription_id']] = self._profile_from_server(item)
+            except (KeyError, TypeError, ValueError, AttributeError): continue
 
-        # --- 处理订阅 ---
-        for sub in data.get('subscriptions', []):
-            try:
-                sub_id = sub['subscription_id']
+        new_profiles = {'guest': self.profiles.get('guest', {'type': 'guest', 'data': {}})}
+        new_sync_state = {}
+        overridden = []
+        for item_id, (server_profile, server_state) in server_items.items():
+            local = self.profiles.get(item_id)
+            synced = self.cloud_sync_state.get(item_id)
+            local_changed = synced is not None and (local is None or self._get_sync_payload(local) != synced['payload'])
+            if local_changed and synced['revision'] == server_state['revision']:
+                if local is None: pass # 本地删除尚未上传
+                elif local['type'] == 'share': new_profiles[item_id] = {**server_profile, 'user_params': local.get('user_params', {})}
+                else: new_profiles[item_id] = local
+            else:
+                if local_changed: overridden.append(self._profile_display_name(local or server_profile))
+                new_profiles[item_id] = server_profile
+            new_sync_state[item_id] = server_state
+        for item_id, local in self.profiles.items():
+            if item_id in server_items or local.get('type') not in ('cloud', 'share'): continue
+            synced = self.cloud_sync_state.get(item_id)
+            # 从未同步过，或者云端已删除但本地有修改：作为新配置保留
+            if synced is None or self._get_sync_payload(local) != synced['payload']: new_profiles[item_id] = local
 
-                # 从服务器获取节点信息
-                nodes_data = json.loads(sub.get('share_config_json', '{}')).get('nodes', [])
-
-                # 检查本地是否已存在此订阅的配置
-                existing_profile = self.profiles.get(sub_id)
-
-                final_user_params = {}
-                # 如果本地存在且是一个分享配置，则优先使用本地的 user_params
-                if existing_profile and existing_profile.get('type') == 'share':
-                    final_user_params = existing_profile.get('user_params', {})
-                # 否则 (例如首次加载)，使用从服务器获取的 user_params
-                else:
-                    final_user_params = json.loads(sub.get('user_params_json', '{}'))
-
-                # 使用合并后的 user_params 构建新的配置项
-                new_profiles[sub_id] = {
-                    'type': 'share',
-                    'share_id': sub.get('share_id'),
-                    'share_name': sub.get('share_name'),
-                    'is_template': sub.get('is_template'),
-                    'user_params': final_user_params,
-                    'nodes': nodes_data
-                }
-            except:
-                continue
-        # ------------------------------------
+        self.cloud_sync_state = new_sync_state
 
         # 只有在数据确实发生变化时才更新UI
         if new_profiles != self.profiles:
             self.profiles = new_profiles
+            # 先清空列表且不触发切换：否则切换时会把界面上的旧内容写回刚合并好的配置
+            self.profile_list_widget.blockSignals(True); self.profile_list_widget.clear(); self.profile_list_widget.blockSignals(False)
             self.refresh_profile_list(current_id)
             self.statusBar().showMessage("配置列表已更新！", 2000)
+        return overridden
+
+    def _profile_display_name(self, profile):
+        return profile.get('profile_name') or profile.get('share_name') or '未命名配置'
 
     def handle_cloud_load(self):
         if not self.session_token: return
-        success, data = self.api_client.config.get_all_configs(self.session_token)
+        self.statusBar().showMessage("正在从云端加载配置...")
+        self.async_api.config.get_all_configs(self.session_token).then(self.on_cloud_load_finished)
+
+    def on_cloud_load_finished(self, success, data):
+        self.statusBar().clearMessage()
         if success:
             self.on_silent_refresh_finished(success, data)
             if self.profile_list_widget.count() > 1: self.profile_list_widget.setCurrentRow(1)
@@ -898,17 +1080,108 @@ class MainWindow(QMainWindow):
             if "会话无效" in str(data) or "会话已过期" in str(data): self.force_logout(str(data))
             else: QMessageBox.critical(self, "错误", f"加载配置失败: {data}")
 
+    def _get_sync_payload(self, profile):
+        """返回一个配置项需要同步到云端的内容，用于和同步基线比较。"""
+        if profile.get('type') == 'cloud':
+            return {'profile_name': profile['profile_name'], 'config_json': json.dumps(profile.get('data', {}))}
+        return {'share_id': profile.get('share_id'), 'user_params': profile.get('user_params', {})}
+
+    def _collect_sync_changes(self):
+        """对比本地配置与同步基线，得出需要上传的新增、修改和删除。"""
+        changes = {'personal_configs': {'upsert': [], 'delete': []}, 'subscriptions': {'upsert': [], 'delete': []}}
+        pending_payloads = {}
+        for profile_id, profile in self.profiles.items():
+            profile_type = profile.get('type')
+            if profile_type not in ('cloud', 'share'): continue
+            payload = self._get_sync_payload(profile)
+            synced = self.cloud_sync_state.get(profile_id)
+            if synced and synced['payload'] == payload: continue
+            pending_payloads[profile_id] = (profile_type, payload)
+            base_revision = synced['revision'] if synced else None
+            if profile_type == 'cloud':
+                changes['personal_configs']['upsert'].append({'config_id': profile_id, **payload, 'base_revision': base_revision})
+            else:
+                changes['subscriptions']['upsert'].append({'subscription_id': profile_id, **payload, 'base_revision': base_revision})
+        for profile_id, synced in self.cloud_sync_state.items():
+            if profile_id in self.profiles: continue
+            if synced['type'] == 'cloud':
+                changes['personal_configs']['delete'].append({'config_id': profile_id, 'base_revision': synced['revision']})
+            else:
+                changes['subscriptions']['delete'].append({'subscription_id': profile_id, 'base_revision': synced['revision']})
+        has_changes = any(items for group in changes.values() for items in group.values())
+        return (changes if has_changes else None), pending_payloads
+
     def handle_cloud_save(self):
-        if not self.session_token: return
+        """在后台把本地改动增量同步到云端。返回进行中的同步的 TaskFuture，没有需要同步的改动时返回 None。"""
+        if not self.session_token: return None
         self.save_current_ui_to_profile(self.current_profile_id)
-        personal_configs = [{'config_id': k, 'profile_name': v['profile_name'], 'config_json': json.dumps(v['data'])} for k, v in self.profiles.items() if v.get('type') == 'cloud']
-        subscriptions = {k: {'share_id': v.get('share_id'), 'user_params': v.get('user_params', {})} for k, v in self.profiles.items() if v.get('type') == 'share'}
-        payload = {'personal_configs': personal_configs, 'subscriptions': subscriptions}
-        success, message = self.api_client.config.save_all_configs(self.session_token, payload)
-        if success: self.statusBar().showMessage("所有云端配置和订阅已保存！", 2000)
+        if self.cloud_save_future is not None:
+            self.cloud_save_queued = True
+            return self.cloud_save_future
+        changes, pending_payloads = self._collect_sync_changes()
+        if not changes:
+            self.statusBar().showMessage("云端配置已是最新。", 2000)
+            return None
+        self.cloud_save_future = self.async_api.config.sync_configs(self.session_token, changes)
+        self.cloud_save_future.then(lambda success, data: self.on_cloud_save_finished(success, data, changes, pending_payloads))
+        return self.cloud_save_future
+
+    def on_cloud_save_finished(self, success, data, changes, pending_payloads):
+        self.cloud_save_future = None
+        queued, self.cloud_save_queued = self.cloud_save_queued, False
+        if success:
+            # 用服务器返回的新修订号推进同步基线
+            revisions = {**data.get('revisions', {}).get('personal_configs', {}), **data.get('revisions', {}).get('subscriptions', {})}
+            for profile_id, (profile_type, payload) in pending_payloads.items():
+                if profile_id in revisions:
+                    self.cloud_sync_state[profile_id] = {'type': profile_type, 'payload': payload, 'revision': revisions[profile_id]}
+            for group in changes.values():
+                for item in group['delete']:
+                    self.cloud_sync_state.pop(item.get('config_id') or item.get('subscription_id'), None)
+            self.statusBar().showMessage("所有云端配置和订阅已保存！", 2000)
+            # 同步期间又有新的改动，基线已推进，现在可以上传了
+            if queued: self.handle_cloud_save()
         else:
-            if "会话无效" in str(message) or "会话已过期" in str(message): self.force_logout(str(message))
+            message = data.get('error', '') if isinstance(data, dict) else str(data)
+            if "会话无效" in message or "会话已过期" in message: self.force_logout(message)
+            elif isinstance(data, dict) and data.get('status') == 409 and data.get('conflicts'):
+                # 服务器因冲突回滚了整批改动：重新获取云端配置，只有冲突的条目改用云端版本，其余改动重新提交。
+                # 重新加载期间视为同步仍在进行，期间的保存请求排队，关闭窗口时也会等待
+                self.statusBar().showMessage("部分配置已在其他设备上修改，正在合并...")
+                conflicts = data['conflicts']
+                self.cloud_save_future = self.async_api.config.get_all_configs(self.session_token)
+                self.cloud_save_future.then(lambda success, server_data: self.on_sync_conflicts_loaded(success, server_data, conflicts))
             else: QMessageBox.critical(self, "错误", f"保存配置失败: {message}")
+        # 同步期间推迟的后台刷新
+        if self.cloud_save_future is None and self.pending_silent_refresh: self.handle_silent_refresh()
+
+    def on_sync_conflicts_loaded(self, success, data, conflicts):
+        self.cloud_save_future = None
+        self.cloud_save_queued = False
+        self.statusBar().clearMessage()
+        if not success:
+            if "会话无效" in str(data) or "会话已过期" in str(data): self.force_logout(str(data))
+            else: QMessageBox.critical(self, "错误", f"同步冲突后重新加载配置失败: {data}")
+            return
+        self.configs_etag = data.get('etag')
+        overridden = self._merge_server_configs(data)
+        # 合并后仍然无法提交的新条目：所订阅的分享已不存在，或者（极少见的）ID 与他人的配置重复
+        dropped = []; renamed = False
+        for conflict in conflicts:
+            item_id = conflict.get('id')
+            if item_id not in self.profiles or item_id in self.cloud_sync_state: continue
+            if conflict.get('kind') == 'subscription':
+                dropped.append(self._profile_display_name(self.profiles.pop(item_id)))
+            else:
+                self.profiles[f"conf-{uuid.uuid4()}"] = self.profiles.pop(item_id); renamed = True
+        if dropped or renamed: self.refresh_profile_list()
+        notes = []
+        if overridden: notes.append("以下配置已在其他设备上修改，已改用云端版本，本地的修改未保存：\n" + "\n".join(overridden))
+        if dropped: notes.append("以下订阅所对应的分享已不存在，已移除：\n" + "\n".join(dropped))
+        if notes: QMessageBox.warning(self, "同步冲突", "\n\n".join(notes))
+        # 其余没有冲突的改动重新提交
+        self.handle_cloud_save()
+        if self.cloud_save_future is None and self.pending_silent_refresh: self.handle_silent_refresh()
 
     def handle_create_share(self):
         profile = self.profiles.get(self.current_profile_id)
@@ -923,18 +1196,48 @@ class MainWindow(QMainWindow):
 
     def handle_manage_shares(self):
         if not self.session_token: return
-        dialog = ManageSharesDialog(self.api_client.share, self.session_token, self); dialog.exec()
+        dialog = ManageSharesDialog(self.async_api.share, self.session_token, self); dialog.exec()
 
     def handle_add_subscription(self):
+        """添加一个或多个分享订阅：一次请求查询所有分享的公开信息，全部添加后只保存一次。"""
         if not self.session_token: return
-        share_id, ok = QInputDialog.getText(self, "添加分享订阅", "请输入您收到的分享ID:")
-        if ok and share_id:
-            success, data = self.api_client.share.get_public_info(share_id)
-            if success:
-                new_sub_id = f"sub-{uuid.uuid4()}"; self.profiles[new_sub_id] = {'type': 'share', 'share_id': share_id, **data, 'user_params': {}}
-                self.refresh_profile_list(); self.handle_cloud_save()
-                QMessageBox.information(self, "成功", f"已成功订阅分享 '{data['share_name']}'！")
-            else: QMessageBox.critical(self, "失败", f"添加订阅失败: {data}")
+        dialog = AddSubscriptionsDialog(self)
+        if dialog.exec() != QDialog.Accepted: return
+        share_ids = dialog.get_share_ids()
+        if not share_ids: return
+        # 同一个模板分享可以用不同参数订阅多次，已订阅的由用户决定是否重复添加
+        subscribed = {profile.get('share_id') for profile in self.profiles.values() if profile.get('type') == 'share'}
+        duplicates = [share_id for share_id in share_ids if share_id in subscribed]
+        if duplicates:
+            reply = QMessageBox.question(self, "重复订阅", f"其中 {len(duplicates)} 个分享已经订阅过，是否仍然重复添加？", QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+            if reply != QMessageBox.Yes: share_ids = [share_id for share_id in share_ids if share_id not in subscribed]
+            if not share_ids: return
+
+        # 查询期间禁用按钮，结果返回后在 on_subscription_info_loaded 中添加
+        self.add_share_button.setEnabled(False)
+        self.statusBar().showMessage(f"正在查询 {len(share_ids)} 个分享...")
+        self.async_api.share.get_public_info_batch(share_ids).then(
+            lambda success, data: self.on_subscription_info_loaded(success, data, share_ids))
+
+    def on_subscription_info_loaded(self, success, data, share_ids):
+        self.add_share_button.setEnabled(bool(self.session_token))
+        self.statusBar().clearMessage()
+        if not success: QMessageBox.critical(self, "失败", f"添加订阅失败: {data}"); return
+        added = []
+        for share_id in share_ids:
+            info = data['shares'].get(share_id)
+            if info is None: continue
+            self.profiles[f"sub-{uuid.uuid4()}"] = {'type': 'share', 'share_id': share_id, **info, 'user_params': {}}
+            added.append(info['share_name'])
+        if added: self.refresh_profile_list(); self.handle_cloud_save()
+
+        failed = [f"{share_id}（不存在或已撤销）" for share_id in data['missing']] + [f"{share_id}（分享配置已损坏）" for share_id in data['corrupted']]
+        if not failed:
+            QMessageBox.information(self, "成功", f"已成功订阅分享 '{added[0]}'！" if len(added) == 1 else f"已成功订阅 {len(added)} 个分享！")
+        elif added:
+            QMessageBox.warning(self, "部分成功", f"已成功订阅 {len(added)} 个分享，以下 {len(failed)} 个未能添加：\n" + "\n".join(failed))
+        else:
+            QMessageBox.critical(self, "失败", "添加订阅失败：\n" + "\n".join(failed))
 
     def handle_delete_profile(self):
         item = self.profile_list_widget.currentItem();
@@ -956,34 +1259,67 @@ class MainWindow(QMainWindow):
         """测速时，获取原始节点数据，而不是显示的文本"""
         if self.node_selector.count() == 0: return
 
-        # 从每个条目的关联数据(userData)中获取节点信息来ping
-        nodes_to_ping = [self.node_selector.itemData(i) for i in range(self.node_selector.count())]
+        # 从每个条目的关联数据(userData)中获取节点信息来ping，跳过"自动选择"条目
+        indices = [i for i in range(self.node_selector.count()) if not self.node_selector.itemData(i).get('auto')]
+        nodes_to_ping = [self.node_selector.itemData(i) for i in indices]
 
         if not nodes_to_ping: return
 
-        self.ping_thread = PingThread(nodes_to_ping)
-        self.ping_thread.result_ready.connect(self.update_ping_result)
-        self.ping_thread.finished.connect(lambda: self.ping_button.setEnabled(True))
+        for i, node in zip(indices, nodes_to_ping):
+            self.node_selector.setItemText(i, f"{node.get('remark', '未知节点')} (测速中...)")
+        # 所有节点并发测速，每个节点测完立即更新
+        self.ping_future = self.start_node_probe(nodes_to_ping)
+        self.ping_future.progress.connect(lambda result: self.update_ping_result(indices[result[0]], result[1]))
+        self.ping_future.then(self.on_ping_finished)
         self.ping_button.setEnabled(False)
-        self.ping_thread.start()
 
-    def update_ping_result(self, index, latency):
-        """只修改显示的文本，不影响关联数据"""
+    def start_node_probe(self, nodes):
+        return self.task_executor.submit(
+            probe_nodes, nodes, name='nodes.ping', priority=PRIORITY_USER, with_context=True,
+            samples=PING_SAMPLES_PER_NODE, connect_timeout_ms=PING_CONNECT_TIMEOUT_MS,
+            deadline_ms=PING_DEADLINE_MS, concurrency=PING_MAX_CONCURRENCY)
+
+    def on_ping_finished(self, success, data):
+        self.ping_future = None
+        self.ping_button.setEnabled(True)
+        if success: self._save_latency_history()
+
+    def cancel_ping(self):
+        """节点列表被重新填充前调用，旧的测速结果不再对应下拉框中的条目。"""
+        if self.ping_future is None: return
+        self.ping_future.cancel()
+        self.ping_future = None
+        self.ping_button.setEnabled(True)
+
+    def update_ping_result(self, index, stats):
+        """记录到测速历史，并只修改显示的文本和提示，不影响关联数据。stats 的格式见 latency.summarize()"""
         try:
             # 从关联数据中获取原始的、干净的备注名
-            original_remark = self.node_selector.itemData(index).get('remark', '未知节点')
+            node = self.node_selector.itemData(index)
+            original_remark = node.get('remark', '未知节点')
+            self.latency_history.record(node, stats)
 
-            if latency != -1:
+            if stats['received']:
                 # 只更新 setItemText
-                self.node_selector.setItemText(index, f"{original_remark} ({latency:.2f} ms)")
+                loss_text = f", 丢包 {stats['loss']:.0%}" if stats['loss'] else ""
+                self.node_selector.setItemText(index, f"{original_remark} ({stats['median']:.1f} ms{loss_text})")
+                dns_text = f"{stats['dns_ms']:.1f} ms" if stats['dns_ms'] is not None else "-"
+                self.node_selector.setItemData(index, (
+                    f"最小 {stats['min']:.1f} ms / 中位数 {stats['median']:.1f} ms / p95 {stats['p95']:.1f} ms\n"
+                    f"成功 {stats['received']}/{stats['sent']}，DNS解析 {dns_text}\n"
+                    f"{self.node_quality_tooltip(node)}"), Qt.ToolTipRole)
             else:
-                self.node_selector.setItemText(index, f"{original_remark} (超时)")
+                self.node_selector.setItemText(index, f"{original_remark} ({stats['error'] or '超时'})")
+                self.node_selector.setItemData(index, self.node_quality_tooltip(node), Qt.ToolTipRole)
+            self.update_auto_node_item(self.node_selector)
         except Exception:
             pass # 防止在ping的过程中，下拉框被清空导致index越界
 
     def toggle_connection(self):
-        """根据当前运行状态，决定是启动还是停止frp服务"""
-        if self.is_running:
+        """根据当前运行状态，决定是启动还是停止frp服务；正在申请配置票据时取消启动"""
+        if self.launch_future is not None:
+            self.cancel_frp_launch()
+        elif self.is_running:
             self.stop_frp()
         else:
             self.start_frp()
@@ -994,6 +1330,7 @@ class MainWindow(QMainWindow):
         - frpc.dll下载配置通过环境变量设置的代理。
         - frpc本身与frps服务器的连接不走代理，进行直连。
         """
+        self.frp_launch_started = time.perf_counter()
         self.has_shown_connection_error = False
         self.log_output.clear()
         self._cleanup_guest_config_file() # 确保清理游客模式的旧文件
@@ -1010,12 +1347,26 @@ class MainWindow(QMainWindow):
             self.save_current_ui_to_profile(self.current_profile_id)
             profile = self.profiles[self.current_profile_id]
 
+            # === "自动选择"节点：最近没有可用的测速结果时先测速，测完后重新走一遍启动流程 ===
+            node_selector = self.node_selector if profile['type'] == 'share' else self.active_node_selector
+            uses_node_choice = profile['type'] != 'share' or profile.get('is_template')
+            current_choice = node_selector.currentData()
+            if uses_node_choice and current_choice and current_choice.get('auto'):
+                selected_node = self.selected_node(node_selector)
+                if selected_node is None:
+                    self.log_to_gui("自动选择节点：最近没有测速结果，正在测速...")
+                    nodes = self.node_choices(node_selector)
+                    self.launch_future = self.start_node_probe(nodes).then(lambda success, data: self.on_auto_node_probed(success, data, nodes, node_selector))
+                    self.update_ui_for_launch_pending()
+                    return
+                self.log_to_gui(f"自动选择节点: {selected_node.get('remark', '未命名节点')}")
+
             config_location_arg = ""
 
             if profile['type'] == 'guest':
                 # --- 游客模式 ---
                 self.log_to_gui("正在准备游客模式（本地）配置...")
-                selected_node = self.active_node_selector.currentData()
+                selected_node = self.selected_node(self.active_node_selector)
                 if not selected_node: raise ValueError("请选择一个运行节点。")
                 proxies = self.get_proxies_from_ui()
                 config_dict = {'serverAddr': selected_node.get('server_addr'), 'serverPort': int(selected_node.get('server_port')), 'auth': {'token': selected_node.get('token', '')}}
@@ -1050,18 +1401,16 @@ class MainWindow(QMainWindow):
             else: # 在线模式 (cloud or share)
                 # --- 在线模式：获取远程配置URL ---
                 self.log_to_gui("正在准备在线模式配置...")
-                config_dict = {}
                 if profile['type'] == 'share':
-                     selected_node_data = self.node_selector.currentData()
+                     selected_node_data = self.selected_node(self.node_selector) if profile.get('is_template') else self.node_selector.currentData()
                      if not selected_node_data: raise ValueError("请选择一个有效的节点。")
                      user_params = {'node_remark': selected_node_data.get('remark')}
                      if profile.get('is_template'): user_params['proxies'] = self.get_proxies_from_ui()
-                     success, data = self.api_client.share.use(profile['share_id'], user_params)
-                     if not success: raise Exception(str(data))
-                     config_dict = data.get('final_toml_data', {})
-                     if isinstance(config_dict, str): config_dict = toml.loads(config_dict)
+                     # 服务器直接编译分享并签发票据，配置不再经客户端取回、渲染后再上传
+                     self.log_to_gui("正在向服务器申请配置票据 (通过代理)...")
+                     future = self.async_api.share.launch(self.session_token, profile['share_id'], user_params)
                 elif profile['type'] == 'cloud':
-                     selected_node = self.active_node_selector.currentData()
+                     selected_node = self.selected_node(self.active_node_selector)
                      if not selected_node: raise ValueError("请选择一个运行节点。")
                      proxies = self.get_proxies_from_ui()
                      config_dict = {'serverAddr': selected_node.get('server_addr'),'serverPort': int(selected_node.get('server_port')),'auth': {'token': selected_node.get('token', '')}}
@@ -1079,22 +1428,74 @@ class MainWindow(QMainWindow):
                          final_proxies.append(new_p)
                      if final_proxies: config_dict['proxies'] = final_proxies
 
-                # 在线模式下，不再向服务器请求的配置中注入 transport.proxyURL
-                # if self.app_settings.get("proxy_mode") == "all" ... 这段代码被移除
+                     # 在线模式下，不再向服务器请求的配置中注入 transport.proxyURL
+                     # if self.app_settings.get("proxy_mode") == "all" ... 这段代码被移除
 
-                config_dict['log'] = {'level': 'info'}
-                self.running_config = copy.deepcopy(config_dict)
-                config_content_for_ticket = toml.dumps(config_dict)
+                     config_dict['log'] = {'level': 'info'}
+                     self.running_config = copy.deepcopy(config_dict)
+                     config_content_for_ticket = toml.dumps(config_dict)
+
+                     self.log_to_gui("正在向服务器申请配置票据 (通过代理)...")
+                     future = self.async_api.config.request_config_ticket(self.session_token, config_content_for_ticket)
+                # 票据在后台申请，期间界面保持响应，再次点击按钮可以取消；拿到票据后在 on_config_ticket_ready 中继续启动
+                is_share = profile['type'] == 'share'
+                self.launch_future = future.then(lambda success, data: self.on_config_ticket_ready(success, data, is_share, dll_path))
+                self.update_ui_for_launch_pending()
+                return
 
-                self.log_to_gui("正在向服务器申请配置票据 (通过代理)...")
-                success, data = self.api_client.config.request_config_ticket(self.session_token, config_content_for_ticket)
-                if not success: raise Exception(f"无法获取配置票据: {data}")
-                config_id = data.get('config_id')
-                if not config_id: raise Exception("服务器未返回有效的配置票据。")
+            self.launch_frpc_process(config_location_arg, dll_path)
 
-                config_location_arg = f"{CLOUD_SERVER_URL.rstrip('/')}/api/get_temp_config/{config_id}"
-                self.log_to_gui(f"成功获取配置")
+        except Exception as e:
+            self.log_to_gui(f"启动frp服务失败: {e}", "red")
+            self.update_ui_for_run_status(False)
 
+    def on_auto_node_probed(self, success, data, nodes, selector):
+        """启动前的测速完成：记录结果后重新启动，此时"自动选择"会选中最快的节点。"""
+        self.launch_future = None
+        if success:
+            for node, stats in zip(nodes, data): self.latency_history.record(node, stats)
+            self._save_latency_history()
+            self.refresh_node_selector(selector)
+        if self.latency_history.best_node(nodes, LATENCY_AUTO_MAX_AGE_S) is None:
+            self.log_to_gui(f"自动选择节点失败：所有节点均无法连接。{'' if success else data}", "red")
+            self.update_ui_for_run_status(False)
+            return
+        self.start_frp()
+
+    def on_config_ticket_ready(self, success, data, is_share, dll_path):
+        self.launch_future = None
+        try:
+            if not success: raise Exception(f"无法获取配置票据: {data}")
+            if is_share: self.running_config = data.get('config_summary') or {}
+            config_id = data.get('config_id')
+            if not config_id: raise Exception("服务器未返回有效的配置票据。")
+
+            config_location_arg = f"{CLOUD_SERVER_URL.rstrip('/')}/api/get_temp_config/{config_id}"
+            self.log_to_gui(f"成功获取配置")
+        except Exception as e:
+            self.log_to_gui(f"启动frp服务失败: {e}", "red")
+            self.update_ui_for_run_status(False)
+            return
+        self.launch_frpc_process(config_location_arg, dll_path)
+
+    def cancel_frp_launch(self):
+        """取消正在申请票据的启动。服务器可能已经签发了票据，它没有被使用，会自行过期。"""
+        self.launch_future.cancel()
+        self.launch_future = None
+        self.frp_launch_started = None
+        self.log_to_gui("已取消启动。", "orange")
+        self.update_ui_for_run_status(False)
+
+    def update_ui_for_launch_pending(self):
+        """申请配置票据期间锁定配置相关的界面，启动按钮改为取消。"""
+        self.account_group.setEnabled(False); self.profile_list_group.setEnabled(False)
+        self.stacked_widget.setEnabled(False); self.active_node_selector.setEnabled(False)
+        self.connect_button.setText("取消启动")
+        self.connect_button.setStyleSheet("background-color: #9E9E9E; color: white; height: 40px; font-size: 16px;")
+
+    def launch_frpc_process(self, config_location_arg, dll_path):
+        """以配置位置（URL或本地路径）启动 frpc 子进程，并开始读取它的日志。"""
+        try:
             # === 准备子进程的环境变量（仅用于下载配置） ===
             process_env = os.environ.copy()
             proxy_url = self.app_settings.get("proxy_url")
@@ -1108,9 +1509,11 @@ class MainWindow(QMainWindow):
             self.log_to_gui("正在启动内置frp服务...")
             command = []
             if getattr(sys, 'frozen', False):
+                # 打包后重新执行本程序，main.py 在导入任何GUI模块之前就会转入 frpc_runner
                 command = [sys.executable, config_location_arg, dll_path]
             else:
-                command = [sys.executable, sys.argv[0], config_location_arg, dll_path]
+                # 开发模式下直接运行只依赖标准库的 frpc_runner.py，子进程不再导入 Qt
+                command = [sys.executable, FRPC_RUNNER_SCRIPT, config_location_arg, dll_path]
 
             creation_flags = subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0
 
@@ -1168,6 +1571,7 @@ class MainWindow(QMainWindow):
         self.frp_process = None
         if self.is_running:
             self.update_ui_for_run_status(False)
+            if self.pending_silent_refresh: self.handle_silent_refresh()
 
     def on_frp_finished(self):
         """
@@ -1208,6 +1612,10 @@ class MainWindow(QMainWindow):
         if not clean_line:
             return
 
+        if self.frp_launch_started is not None:
+            print(f"[MainWindow] frpc first log line {(time.perf_counter() - self.frp_launch_started) * 1000:.0f} ms after Start.")
+            self.frp_launch_started = None
+
         # 1. 优先检查是否是【代理启动成功】的标志
         # 这是最重要的、必须给用户看的正面反馈
         if "start proxy success" in clean_line:
@@ -1224,10 +1632,10 @@ class MainWindow(QMainWindow):
                     profile = self.profiles.get(self.current_profile_id, {})
 
                     if profile.get('type') == 'share':
-                        if profile.get('is_template'): server_addr = self.node_selector.currentData().get('server_addr', '未知服务器')
+                        if profile.get('is_template'): server_addr = (self.selected_node(self.node_selector) or {}).get('server_addr', '未知服务器')
                         else: server_addr = self.running_config.get('serverAddr', '分享服务器')
                     else:
-                        node_data = self.active_node_selector.currentData()
+                        node_data = self.selected_node(self.active_node_selector)
                         if node_data: server_addr = node_data.get('server_addr', '未知服务器')
 
                     proxy_type = proxy.get('type')
@@ -1322,18 +1730,69 @@ class MainWindow(QMainWindow):
         current_data = selector.currentData()
         selector.clear()
         if nodes:
+            # 多个节点时在最前面提供"自动选择"，启动时使用最近测得最快的节点
+            if len(nodes) > 1: selector.addItem("自动选择", userData=AUTO_NODE)
             for node in nodes:
                 remark = node.get('remark', '未命名节点')
-                # 第一个参数是显示文本，第二个是关联数据
-                selector.addItem(remark, userData=node)
-                # 为条目设置 ToolTip，显示原始名称
-                selector.setItemData(selector.count() - 1, remark, Qt.ToolTipRole)
-
-            if current_data:
-                # findData 现在会根据我们存入的完整字典来查找
-                index = selector.findData(current_data)
-                if index != -1:
-                    selector.setCurrentIndex(index)
+                # 第一个参数是显示文本（附带最近的测速质量），第二个是关联数据
+                selector.addItem(self.node_display_text(node), userData=node)
+                # 为条目设置 ToolTip，显示原始名称和测速历史
+                selector.setItemData(selector.count() - 1, f"{remark}\n{self.node_quality_tooltip(node)}", Qt.ToolTipRole)
+            self.update_auto_node_item(selector)
+
+            # findData 现在会根据我们存入的完整字典来查找；默认选中第一个实际节点
+            index = selector.findData(current_data) if current_data else -1
+            selector.setCurrentIndex(index if index != -1 else (1 if len(nodes) > 1 else 0))
+
+    def node_display_text(self, node):
+        """节点备注名，附带保存期内测速结果的中位数、丢包率和距最近一次测速的时间。"""
+        remark = node.get('remark', '未命名节点')
+        quality = self.latency_history.quality(node)
+        if not quality: return remark
+        age = quality['age']
+        age_text = "刚刚" if age < 60 else f"{int(age // 60)}分钟前" if age < 3600 else f"{int(age // 3600)}小时前" if age < 86400 else f"{int(age // 86400)}天前"
+        if quality['median'] is None: return f"{remark} (不可用, {age_text})"
+        loss_text = f", 丢包 {quality['loss']:.0%}" if quality['loss'] >= 0.005 else ""
+        return f"{remark} ({quality['median']:.0f} ms{loss_text}, {age_text})"
+
+    def node_quality_tooltip(self, node):
+        quality = self.latency_history.quality(node)
+        if not quality: return "暂无测速记录"
+        median_text = f"{quality['median']:.1f} ms" if quality['median'] is not None else "-"
+        return f"最近 {quality['count']} 次测速：延迟中位数 {median_text}，平均丢包 {quality['loss']:.0%}"
+
+    def node_choices(self, selector):
+        """下拉框中的实际节点（不含"自动选择"）。"""
+        return [selector.itemData(i) for i in range(selector.count()) if not selector.itemData(i).get('auto')]
+
+    def update_auto_node_item(self, selector):
+        """在"自动选择"条目上显示它现在会选中的节点。"""
+        if selector.count() == 0 or not selector.itemData(0).get('auto'): return
+        best = self.latency_history.best_node(self.node_choices(selector), LATENCY_AUTO_MAX_AGE_S)
+        text = f"自动选择 (当前最快: {best.get('remark', '未命名节点')})" if best else "自动选择 (启动前测速)"
+        selector.setItemText(0, text)
+        selector.setItemData(0, f"使用最近 {LATENCY_AUTO_MAX_AGE_S // 60} 分钟内测得最快的节点，没有测速结果时先测速再启动", Qt.ToolTipRole)
+
+    def refresh_node_selector(self, selector):
+        """按测速历史更新各节点条目的文本和提示，不改变条目和当前选择。"""
+        for i in range(selector.count()):
+            node = selector.itemData(i)
+            if node.get('auto'): continue
+            selector.setItemText(i, self.node_display_text(node))
+            selector.setItemData(i, f"{node.get('remark', '未命名节点')}\n{self.node_quality_tooltip(node)}", Qt.ToolTipRole)
+        self.update_auto_node_item(selector)
+
+    def selected_node(self, selector):
+        """当前选中的节点；选中"自动选择"时返回最近测得最快的节点，没有可用的测速结果时返回 None。"""
+        node = selector.currentData()
+        if node and node.get('auto'): return self.latency_history.best_node(self.node_choices(selector), LATENCY_AUTO_MAX_AGE_S)
+        return node
+
+    def select_node_by_remark(self, selector, remark):
+        for i in range(selector.count()):
+            if selector.itemData(i).get('remark') == remark:
+                selector.setCurrentIndex(i); return
+        selector.setCurrentText(remark) # 旧版本保存的是带测速结果的显示文本
 
     def refresh_profile_list(self, pre_selected_id=None):
         id_to_select = pre_selected_id or (self.profile_list_widget.currentItem().data(Qt.UserRole) if self.profile_list_widget.currentItem() else self.current_profile_id)
@@ -1380,21 +1839,15 @@ class MainWindow(QMainWindow):
 
     def check_session_status(self):
         if not self.session_token: self.session_timer.stop(); return
-        class SessionCheckThread(QThread):
-            finished = Signal(bool)
-            def __init__(self, api_client, token):
-                super().__init__()
-                self.api_client = api_client
-                self.token = token
-            def run(self):
-                self.finished.emit(self.api_client.auth.check_session(self.token))
-
-        def on_check_finished(is_valid):
-            if not is_valid: self.force_logout("您的会话已在别处登录或已过期。")
-
-        self.session_check_thread = SessionCheckThread(self.api_client, self.session_token)
-        self.session_check_thread.finished.connect(on_check_finished)
-        self.session_check_thread.start()
+        def check_session(token):
+            # check_session 只返回是否有效，这里包装成任务约定的 (success, data)
+            return True, self.api_client.auth.check_session(token)
+
+        def on_check_finished(success, is_valid):
+            if success and not is_valid: self.force_logout("您的会话已在别处登录或已过期。")
+
+        self.task_executor.submit(check_session, self.session_token, name='api.auth.check_session', group='api',
+                                  priority=PRIORITY_BACKGROUND, dedupe_key=('api.auth.check_session', self.session_token)).then(on_check_finished)
 
     def _load_local_settings(self):
         """从注册表/QSettings加载并解密凭证"""
@@ -1548,13 +2001,23 @@ class MainWindow(QMainWindow):
                 event.ignore()
                 return
 
-        # 保存云端配置（如果已登录）
+        if self.launch_future is not None: self.cancel_frp_launch()
+
+        # 保存云端配置（如果已登录）。同步在后台进行，窗口关闭后不会再处理结果，因此在这里等它完成
         if self.session_token:
-            self.handle_cloud_save()
+            future = self.handle_cloud_save()
+            while future is not None and future.wait(CLOUD_SAVE_EXIT_TIMEOUT_MS) is not None:
+                future = self.cloud_save_future # 等待期间排队的同步会在完成回调中发出
+
+        # 关闭事件流；监听线程是窗口的子对象，需在窗口销毁前退出
+        self.stop_event_listener(wait_ms=2000)
 
         # 调用统一的停止和清理方法
         self.stop_frp()
 
+        # 其余未完成的任务不再需要，最多再等一小会儿让已经开始的任务结束
+        self.task_executor.shutdown(wait_ms=1000)
+
         # 等待旧的frp_thread（如果存在的话）
         if hasattr(self, 'frp_thread') and self.frp_thread and self.frp_thread.isRunning():
             self.frp_thread.wait()
@@ -2,6 +2,7 @@
 from .auth import AuthEndpoints
 from .config import ConfigEndpoints
 from .share import ShareEndpoints
+from .events import EventEndpoints
 
 class ApiClient:
     """
@@ -13,6 +14,7 @@ class ApiClient:
     client.auth.login(...)
     client.config.get_all_configs(...)
     client.share.create(...)
+    client.events.open_stream(...)
     """
     def __init__(self, base_url):
         """
@@ -22,3 +24,4 @@ class ApiClient:
         self.auth = AuthEndpoints(base_url)
         self.config = ConfigEndpoints(base_url)
         self.share = ShareEndpoints(base_url)
+        self.events = EventEndpoints(base_url)
@@ -41,6 +41,13 @@ class AuthEndpoints(BaseClient):
             }
         )
     
+    def logout(self, token):
+        """注销当前会话，使令牌在服务器端立即失效。"""
+        return self._make_request(
+            'POST', '/api/logout',
+            headers={'Authorization': f"Bearer {token}"}
+        )
+
     def check_session(self, token):
         """检查会话令牌是否有效。"""
         # 这个方法返回布尔值，所以我们在这里处理一下
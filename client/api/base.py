@@ -1,6 +1,16 @@
 # api/base.py
 import requests
 import json
+import gzip
+
+try:
+    import msgpack
+except ImportError: # 未安装时只使用 JSON
+    msgpack = None
+
+MSGPACK_MIMETYPE = 'application/msgpack'
+REQUEST_COMPRESSION_MIN_BYTES = 1024 # 小于此大小的请求体不压缩
+_DECODE_ERRORS = (ValueError, msgpack.UnpackException) if msgpack else (ValueError,)
 
 class BaseClient:
     """
@@ -15,6 +25,10 @@ class BaseClient:
     # 当前激活的代理模式
     _current_proxy_mode = "none" # 默认直连
 
+    # 各服务器地址支持的传输能力，从最近的响应头中得知：{'gzip': 接受压缩的请求体, 'msgpack': 能收发 MessagePack}
+    # 旧版服务器不会声明这些能力，此时请求体保持未压缩的 JSON
+    _server_capabilities = {}
+
     def __init__(self, base_url, timeout=10):
         self.base_url = base_url.rstrip('/')
         self.timeout = timeout
@@ -34,24 +48,76 @@ class BaseClient:
                 print("[BaseClient] Created sandboxed Session (will ignore system proxies).")
             return BaseClient._sandboxed_session
 
-    def _make_request(self, method, endpoint, **kwargs):
-        """一个私有的辅助方法，用于向API发送请求。"""
+    def _make_request(self, method, endpoint, error_details=False, **kwargs):
+        """
+        一个私有的辅助方法，用于向API发送请求。
+        失败时返回 (False, 错误信息)；error_details=True 时改为返回
+        (False, {'error': 错误信息, 'status': HTTP状态码(网络错误时为 None), ...响应体中的其他字段})。
+        """
         url = f"{self.base_url}{endpoint}"
         
         # 动态获取当前应该使用的session
         session = BaseClient._get_active_session()
 
+        # 响应的 gzip 解压由 requests 自动完成（默认发送 Accept-Encoding: gzip, deflate）
+        headers = dict(kwargs.pop('headers', None) or {})
+        if msgpack is not None:
+            headers.setdefault('Accept', f"{MSGPACK_MIMETYPE}, application/json;q=0.9")
+        if 'json' in kwargs:
+            kwargs['data'] = self._encode_body(kwargs.pop('json'), headers)
+
         try:
-            response = session.request(method, url, timeout=self.timeout, **kwargs)
+            response = session.request(method, url, timeout=self.timeout, headers=headers, **kwargs)
+            self._record_capabilities(response)
+            # 条件请求命中：内容未变化，调用方应继续使用本地缓存
+            if response.status_code == 304:
+                return True, {'not_modified': True}
             if response.status_code >= 400:
-                try: message = response.json().get('error', f"Srv Error {response.status_code}")
-                except json.JSONDecodeError: message = f"Srv responded {response.status_code}"
+                body = {}
+                try:
+                    decoded = self._decode_body(response)
+                    if isinstance(decoded, dict): body = decoded
+                    message = body.get('error', f"Srv Error {response.status_code}")
+                except _DECODE_ERRORS: message = f"Srv responded {response.status_code}"
+                if error_details: return False, {**body, 'error': message, 'status': response.status_code}
                 return False, message
-            try: return True, response.json()
-            except json.JSONDecodeError: return True, {}
+            try: return True, self._decode_body(response)
+            except _DECODE_ERRORS: return True, {}
         except requests.exceptions.RequestException as e:
+            if error_details: return False, {'error': f"Network error: {e}", 'status': None}
             return False, f"Network error: {e}"
 
+    def _encode_body(self, payload, headers):
+        """按服务器已声明的能力编码请求体：支持时用 MessagePack，较大时再用 gzip 压缩。"""
+        capabilities = BaseClient._server_capabilities.get(self.base_url, {})
+        if msgpack is not None and capabilities.get('msgpack'):
+            body = msgpack.packb(payload, use_bin_type=True)
+            headers['Content-Type'] = MSGPACK_MIMETYPE
+        else:
+            body = json.dumps(payload).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        if capabilities.get('gzip') and len(body) >= REQUEST_COMPRESSION_MIN_BYTES:
+            body = gzip.compress(body, compresslevel=6)
+            headers['Content-Encoding'] = 'gzip'
+        return body
+
+    def _record_capabilities(self, response):
+        capabilities = BaseClient._server_capabilities.setdefault(self.base_url, {})
+        # 每个响应都重新判断，服务器回退到旧版本后自动停止压缩上传
+        capabilities['gzip'] = 'gzip' in response.headers.get('Accept-Encoding', '').lower()
+        content_type = response.headers.get('Content-Type', '')
+        if content_type.startswith(MSGPACK_MIMETYPE):
+            capabilities['msgpack'] = True
+        elif content_type.startswith('application/json'):
+            # 请求了 MessagePack 却收到 JSON，说明服务器不支持
+            capabilities['msgpack'] = False
+
+    @staticmethod
+    def _decode_body(response):
+        if msgpack is not None and response.headers.get('Content-Type', '').startswith(MSGPACK_MIMETYPE):
+            return msgpack.unpackb(response.content, raw=False)
+        return response.json()
+
     @staticmethod
     def update_proxy_settings(mode: str, url: str = None):
         """
@@ -12,9 +12,30 @@ class ConfigEndpoints(BaseClient):
             json={'config_content': config_content}
         )
 
-    def get_all_configs(self, token):
-        """获取用户的所有配置（个人配置和订阅）。"""
-        return self._make_request('GET', '/api/configs', headers={'Authorization': f"Bearer {token}"})
+    def get_all_configs(self, token, etag=None):
+        """
+        获取用户的所有配置（个人配置和订阅）。
+        :param etag: 上次响应中的 'etag'。传入后服务器在配置未变化时返回 304，此时结果为 {'not_modified': True}。
+        """
+        headers = {'Authorization': f"Bearer {token}"}
+        if etag: headers['If-None-Match'] = etag
+        return self._make_request('GET', '/api/configs', headers=headers)
+
+    def sync_configs(self, token, changes):
+        """
+        增量同步配置，只上传发生变化的条目。
+        :param changes: {'personal_configs': {'upsert': [...], 'delete': [...]}, 'subscriptions': {...}}，
+                        每个条目都带有 base_revision（新建时为 None）。
+        :return: 成功时 data['revisions'] 包含各条目的新修订号。
+                 失败时 data 为 {'error': 错误信息, 'status': HTTP状态码, ...}；
+                 版本冲突时 status 为 409，data['conflicts'] 列出冲突的条目（kind、id、current_revision）。
+        """
+        return self._make_request(
+            'PATCH', '/api/configs',
+            headers={'Authorization': f"Bearer {token}"},
+            json=changes,
+            error_details=True
+        )
 
     def save_all_configs(self, token, payload):
         """
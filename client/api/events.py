@@ -0,0 +1,34 @@
+# api/events.py
+import requests
+from .base import BaseClient
+
+class EventEndpoints(BaseClient):
+    """服务器推送的变更事件流 (SSE)。"""
+
+    # 服务器每25秒发送一次心跳，读超时留出足够余量
+    STREAM_READ_TIMEOUT = 60
+
+    def open_stream(self, token):
+        """
+        打开事件流长连接。
+        :return: (True, response) 成功时返回流式响应对象，由调用方逐行读取并负责关闭；
+                 (False, (status_code, message)) 失败时 status_code 在网络错误时为 None。
+        """
+        url = f"{self.base_url}/api/events"
+        session = BaseClient._get_active_session()
+        try:
+            response = session.get(
+                url, stream=True,
+                headers={'Authorization': f"Bearer {token}", 'Accept': 'text/event-stream'},
+                timeout=(self.timeout, self.STREAM_READ_TIMEOUT)
+            )
+        except requests.exceptions.RequestException as e:
+            return False, (None, f"Network error: {e}")
+        if response.status_code != 200:
+            try: message = response.json().get('error', f"Srv Error {response.status_code}")
+            except ValueError: message = f"Srv responded {response.status_code}"
+            response.close()
+            return False, (response.status_code, message)
+        # 事件流的 Content-Type 不带 charset，显式指定后 iter_lines 才会解码为字符串
+        response.encoding = 'utf-8'
+        return True, response
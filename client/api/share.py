@@ -4,6 +4,8 @@ from .base import BaseClient
 class ShareEndpoints(BaseClient):
     """处理创建、管理和使用分享相关的API端点。"""
 
+    PUBLIC_INFO_BATCH_SIZE = 100 # 与服务器批量查询的上限一致
+
     def create(self, token, share_data):
         """从用户配置创建新的分享。"""
         return self._make_request(
@@ -28,9 +30,41 @@ class ShareEndpoints(BaseClient):
         """获取分享的公开信息（用于订阅）。"""
         return self._make_request('GET', f'/api/share/get_public_info/{share_id}')
 
-    def use(self, share_id, user_params):
-        """使用分享以获取最终组合好的TOML数据。"""
+    def get_public_info_batch(self, share_ids):
+        """
+        一次获取多个分享的公开信息（用于批量订阅）。超过服务器单次上限时分批请求并合并结果。
+        :return: 成功时 data 为 {'shares': {share_id: 公开信息}, 'missing': [...], 'corrupted': [...]}。
+        """
+        share_ids = list(dict.fromkeys(share_ids))
+        merged = {'shares': {}, 'missing': [], 'corrupted': []}
+        for i in range(0, len(share_ids), self.PUBLIC_INFO_BATCH_SIZE):
+            success, data = self._make_request('POST', '/api/share/public_info', json={'share_ids': share_ids[i:i + self.PUBLIC_INFO_BATCH_SIZE]})
+            if not success:
+                return False, data
+            merged['shares'].update(data.get('shares', {}))
+            merged['missing'].extend(data.get('missing', []))
+            merged['corrupted'].extend(data.get('corrupted', []))
+        return True, merged
+
+    def use(self, share_id, user_params, etag=None):
+        """
+        使用分享以获取最终组合好的TOML数据。
+        :param etag: 完整分享上次响应中的 'etag'。分享未变化时服务器返回 304，结果为 {'not_modified': True}。
+        """
+        headers = {'If-None-Match': etag} if etag else {}
         return self._make_request(
             'POST', '/api/share/use',
+            headers=headers,
+            json={'share_id': share_id, 'user_params': user_params}
+        )
+
+    def launch(self, token, share_id, user_params):
+        """
+        一键启动分享：服务器编译分享并直接签发配置票据。
+        :return: 成功时 data 包含 'config_id' 和 'config_summary'（服务器地址与代理规则，不含认证令牌）。
+        """
+        return self._make_request(
+            'POST', '/api/share/launch',
+            headers={'Authorization': f"Bearer {token}"},
             json={'share_id': share_id, 'user_params': user_params}
         )
@@ -0,0 +1,49 @@
+# async_api.py
+# ApiClient 的异步门面：请求交给共享的 TaskExecutor 执行，结果通过 Qt 信号回到主线程，界面不再等待网络。
+#
+# 使用方法:
+#   future = self.async_api.config.get_all_configs(token)   # 与 ApiClient 的方法同名同参数，立即返回 TaskFuture
+#   future.then(self.on_configs_loaded)                      # 回调在主线程中以 (success, data) 调用
+#   future.cancel()                                          # 不再需要结果时取消，回调不会被调用
+#
+# 参数完全相同的请求仍在进行中时不会重复发送，后来的调用方得到同一个请求的结果（例如连续双击按钮）。
+
+from tasks import PRIORITY_USER
+
+API_TASK_GROUP = 'api'
+
+
+class _AsyncEndpoints:
+    """把一组同步端点（如 ApiClient.auth）的方法包装成返回 TaskFuture 的方法。"""
+    def __init__(self, client, group, endpoints):
+        self._client = client
+        self._group = group
+        self._endpoints = endpoints
+
+    def __getattr__(self, name):
+        method = getattr(self._endpoints, name)
+        def submit(*args, **kwargs):
+            # 去重键不含优先级：后台刷新和用户手动加载同样的数据时只请求一次
+            key = (API_TASK_GROUP, self._group, name, repr(args), repr(sorted(kwargs.items())))
+            return self._client.executor.submit(method, *args, name=f"api.{self._group}.{name}", group=API_TASK_GROUP,
+                                                priority=self._client.priority, dedupe_key=key, **kwargs)
+        return submit
+
+
+class AsyncApiClient:
+    """
+    ApiClient 的异步版本，auth / config / share 的方法与 ApiClient 一一对应，返回 TaskFuture。
+    priority 决定排队时的先后：界面操作用默认的 PRIORITY_USER，后台轮询另建一个 PRIORITY_BACKGROUND 的实例。
+    必须在主线程中调用。
+    """
+    def __init__(self, api_client, executor, priority=PRIORITY_USER):
+        self.api_client = api_client
+        self.executor = executor
+        self.priority = priority
+        self.auth = _AsyncEndpoints(self, 'auth', api_client.auth)
+        self.config = _AsyncEndpoints(self, 'config', api_client.config)
+        self.share = _AsyncEndpoints(self, 'share', api_client.share)
+
+    def cancel_all(self):
+        """取消所有未完成的 API 请求（包括其他优先级的实例发出的），例如退出登录时，旧会话的结果不应再更新界面。"""
+        self.executor.cancel_all(API_TASK_GROUP)
@@ -31,6 +31,17 @@ IMAGE_SOURCES = [
 ]
 IMAGE_REFRESH_INTERVAL_MS = 20000 # 图片刷新间隔（毫秒）
 IMAGE_FETCH_GLOBAL_TIMEOUT_MS = 15000 # 全局获取超时（15秒）
+# --- 节点测速 ---
+PING_SAMPLES_PER_NODE = 3 # 每个节点的 TCP 连接采样次数
+PING_CONNECT_TIMEOUT_MS = 2000 # 单次连接（以及 DNS 解析）的超时
+PING_DEADLINE_MS = 8000 # 一次测速的总时限，所有节点共用
+PING_MAX_CONCURRENCY = 16 # 同时探测的节点数上限
+LATENCY_HISTORY_SIZE = 8 # 每个节点保存的最近测速次数
+LATENCY_HISTORY_MAX_NODES = 200 # 最多保存多少个节点的测速记录
+LATENCY_HISTORY_MAX_AGE_S = 7 * 24 * 3600 # 测速记录的保存时间（秒），节点旁显示的质量也只统计这段时间
+LATENCY_AUTO_MAX_AGE_S = 300 # "自动选择"只采用这段时间（秒）内的测速结果，没有时启动前先测速
+# --- 云端同步 ---
+CLOUD_SAVE_EXIT_TIMEOUT_MS = 10000 # 关闭窗口时等待配置保存完成的最长时间（毫秒）
 # --- 应用基本信息 ---
 APP_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # 图标存储
@@ -1,7 +1,11 @@
 # frpc_runner.py
+# frpc 子进程的入口。只使用标准库，不能导入 Qt、requests 等 GUI 进程才需要的模块，
+# 否则每次启动隧道都要多付出几百毫秒的导入时间和几十MB内存。
+# 用法: python frpc_runner.py <配置URL或路径> <核心组件路径>
 
 import ctypes
 import os
+import sys
 from datetime import datetime
 
 def run_frpc_service(config_location, dll_path):
@@ -22,3 +26,8 @@ def run_frpc_service(config_location, dll_path):
             f.write(f"{datetime.now()}: {e}\n")
         raise
 
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("用法: frpc_runner.py <配置URL或路径> <核心组件路径>")
+        sys.exit(2)
+    run_frpc_service(sys.argv[1], sys.argv[2])
@@ -0,0 +1,207 @@
+# latency.py
+# 节点延迟测量：所有节点并发探测（asyncio，在一个后台任务线程中运行），
+# 每个节点先单独解析 DNS，再做多次 TCP 连接采样，给出最小值、中位数、p95 和丢包率。
+# 每个节点测完立即报告，所有节点共用一个总时限，个别不通的节点不会拖慢整体。
+# LatencyHistory 按 server_addr:port 保存每个节点最近几次的测速结果，用于显示节点质量和自动选择最快的节点。
+
+import asyncio
+import collections
+import math
+import socket
+import statistics
+import threading
+import time
+
+CANCEL_POLL_SECONDS = 0.1 # 检查任务是否被取消的间隔
+
+
+def _resolve(loop, host, port):
+    """
+    在守护线程中解析 DNS，返回 asyncio Future。
+    不使用 loop.getaddrinfo：它占用事件循环的默认线程池，asyncio.run 结束时会等待卡住的解析线程，
+    总时限就失去了作用；守护线程不被等待，超时后结果直接丢弃。
+    """
+    future = loop.create_future()
+
+    def deliver(result, error):
+        if future.done(): return # 已超时被取消
+        if error is not None: future.set_exception(error)
+        else: future.set_result(result)
+
+    def worker():
+        result, error = None, None
+        try: result = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        except (OSError, UnicodeError) as exc: error = exc
+        try: loop.call_soon_threadsafe(deliver, result, error)
+        except RuntimeError: pass # 事件循环已关闭
+
+    threading.Thread(target=worker, name="latency-resolve", daemon=True).start()
+    return future
+
+
+def summarize(samples, attempts, dns_ms=None, error=None):
+    """
+    汇总一个节点的采样结果（毫秒，失败的采样为 None）。
+    attempts 为计划的采样次数，因总时限而未完成的采样也计为丢失。
+    """
+    received = sorted(sample for sample in samples if sample is not None)
+    result = {
+        'sent': attempts,
+        'received': len(received),
+        'loss': (attempts - len(received)) / attempts if attempts else 1.0,
+        'min': None, 'median': None, 'p95': None,
+        'dns_ms': dns_ms,
+        'error': error,
+    }
+    if received:
+        result['min'] = received[0]
+        result['median'] = statistics.median(received)
+        # 最近秩法：采样很少时 p95 就是最大值
+        result['p95'] = received[max(0, math.ceil(0.95 * len(received)) - 1)]
+    return result
+
+
+class _NodeProbe:
+    """一个节点的探测状态。超出总时限被中断时，已经拿到的采样仍然计入结果。"""
+    def __init__(self, node, attempts):
+        self.node = node
+        self.attempts = attempts
+        self.samples = []
+        self.dns_ms = None
+        self.error = None
+
+    def summary(self):
+        return summarize(self.samples, self.attempts, self.dns_ms, self.error)
+
+    async def run(self, semaphore, connect_timeout):
+        async with semaphore:
+            try:
+                addr = self.node.get('server_addr'); port = int(self.node.get('server_port'))
+            except (TypeError, ValueError):
+                self.error = "节点地址或端口无效"; return
+            loop = asyncio.get_running_loop()
+            start_time = time.perf_counter()
+            try:
+                infos = await asyncio.wait_for(_resolve(loop, addr, port), connect_timeout)
+            except (OSError, asyncio.TimeoutError, UnicodeError):
+                self.error = "DNS解析失败"; return
+            self.dns_ms = (time.perf_counter() - start_time) * 1000
+            family, _, _, _, sockaddr = infos[0]
+            for _ in range(self.attempts):
+                start_time = time.perf_counter()
+                try:
+                    # 直接连接解析出的地址，采样中不再包含 DNS 时间
+                    _, writer = await asyncio.wait_for(asyncio.open_connection(sockaddr[0], sockaddr[1], family=family), connect_timeout)
+                except (OSError, asyncio.TimeoutError):
+                    self.samples.append(None); continue
+                self.samples.append((time.perf_counter() - start_time) * 1000)
+                writer.close()
+                try: await writer.wait_closed()
+                except OSError: pass
+
+
+async def _probe_all(context, nodes, samples, connect_timeout, deadline, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    probes = [_NodeProbe(node, samples) for node in nodes]
+    tasks = {asyncio.ensure_future(probe.run(semaphore, connect_timeout)): index for index, probe in enumerate(probes)}
+    loop = asyncio.get_running_loop()
+    end_time = loop.time() + deadline
+    pending = set(tasks)
+    while pending and not context.is_cancelled():
+        remaining = end_time - loop.time()
+        if remaining <= 0: break
+        done, pending = await asyncio.wait(pending, timeout=min(remaining, CANCEL_POLL_SECONDS), return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            context.report((tasks[task], probes[tasks[task]].summary()))
+    for task in pending: task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    context.check()
+    # 超出总时限的节点按已有的采样报告
+    for task in pending:
+        probe = probes[tasks[task]]
+        if probe.error is None and not any(sample is not None for sample in probe.samples): probe.error = "超出测速时限"
+        context.report((tasks[task], probe.summary()))
+    return [probe.summary() for probe in probes]
+
+
+def probe_nodes(context, nodes, samples=3, connect_timeout_ms=2000, deadline_ms=8000, concurrency=16):
+    """
+    测速任务（交给 TaskExecutor 执行，with_context=True）。
+    每个节点测完时通过 context.report((序号, 结果)) 报告，结果的格式见 summarize()；
+    返回 (True, 按节点顺序排列的全部结果)。
+    """
+    results = asyncio.run(_probe_all(context, nodes, samples, connect_timeout_ms / 1000, deadline_ms / 1000, concurrency))
+    return True, results
+
+
+class LatencyHistory:
+    """
+    每个节点（按 server_addr:port 区分）最近 size 次测速结果的环形缓冲区。
+    每条记录为 [时间戳(秒), 中位数延迟(毫秒，全部丢失时为 None), 丢包率]，可以直接序列化为 JSON 保存。
+    """
+    def __init__(self, data=None, size=8, max_nodes=200, max_age=7 * 24 * 3600):
+        self.size = size
+        self.max_nodes = max_nodes
+        self.max_age = max_age
+        self._entries = {}
+        for key, entries in (data or {}).items():
+            try:
+                self._entries[key] = collections.deque(([int(ts), median, float(loss)] for ts, median, loss in entries), maxlen=size)
+            except (TypeError, ValueError):
+                continue # 忽略格式不对的记录
+        self.prune()
+
+    @staticmethod
+    def node_key(node):
+        return f"{node.get('server_addr')}:{node.get('server_port')}"
+
+    def record(self, node, stats, now=None):
+        """记录一次测速结果，stats 的格式见 summarize()。"""
+        median = round(stats['median'], 1) if stats['received'] else None
+        entry = [int(now if now is not None else time.time()), median, round(stats['loss'], 2)]
+        self._entries.setdefault(self.node_key(node), collections.deque(maxlen=self.size)).append(entry)
+
+    def quality(self, node, max_age=None, now=None):
+        """
+        汇总 max_age 秒内（默认为全部保留的记录）的测速结果，没有记录时返回 None。
+        返回 {'median': 各次中位数的中位数(全部丢失时为 None), 'loss': 平均丢包率, 'count': 次数, 'age': 距最近一次的秒数}
+        """
+        now = now if now is not None else time.time()
+        max_age = max_age if max_age is not None else self.max_age
+        entries = [entry for entry in self._entries.get(self.node_key(node), ()) if now - entry[0] <= max_age]
+        if not entries: return None
+        medians = [median for _, median, _ in entries if median is not None]
+        return {
+            'median': statistics.median(medians) if medians else None,
+            'loss': sum(loss for _, _, loss in entries) / len(entries),
+            'count': len(entries),
+            'age': max(0, now - entries[-1][0]),
+        }
+
+    def best_node(self, nodes, max_age, now=None):
+        """
+        max_age 秒内测过的节点中最快的一个，都没有可用结果时返回 None。
+        丢包按重传折算：有效延迟 = 中位数 / (1 - 丢包率)，完全不通的节点不参与选择。
+        """
+        best, best_score = None, None
+        for node in nodes:
+            quality = self.quality(node, max_age, now)
+            if not quality or quality['median'] is None or quality['loss'] >= 1: continue
+            score = quality['median'] / (1 - quality['loss'])
+            if best_score is None or score < best_score: best, best_score = node, score
+        return best
+
+    def prune(self, now=None):
+        """丢弃过期的记录；节点数超过上限时只保留最近测过的 max_nodes 个。"""
+        now = now if now is not None else time.time()
+        for key in list(self._entries):
+            entries = self._entries[key]
+            while entries and now - entries[0][0] > self.max_age: entries.popleft()
+            if not entries: del self._entries[key]
+        if len(self._entries) > self.max_nodes:
+            keep = sorted(self._entries, key=lambda key: self._entries[key][-1][0], reverse=True)[:self.max_nodes]
+            self._entries = {key: self._entries[key] for key in keep}
+
+    def to_dict(self):
+        self.prune()
+        return {key: list(entries) for key, entries in self._entries.items()}
@@ -1,22 +1,25 @@
 import sys
-from PySide6.QtWidgets import (
-    QApplication
-)
-
-from MainWindow import MainWindow
-# --- 自定义模块导入 ---
-from utils import GlobalCopyInterceptor
-from frpc_runner import run_frpc_service
 
 if __name__ == '__main__':
     if len(sys.argv) == 3:
+        # frpc 子进程：只导入标准库实现的 frpc_runner，不加载 Qt 和界面模块。
+        # 开发模式下 MainWindow 直接运行 frpc_runner.py；打包后的程序只有这一个入口，仍然走这里。
+        from frpc_runner import run_frpc_service
         config_location_arg = sys.argv[1]
         dll_path_arg = sys.argv[2]
         run_frpc_service(config_location_arg, dll_path_arg)
     else:
+        from PySide6.QtWidgets import (
+            QApplication
+        )
+
+        from MainWindow import MainWindow
+        # --- 自定义模块导入 ---
+        from utils import GlobalCopyInterceptor
+
         app = QApplication(sys.argv)
         window = MainWindow()
         interceptor = GlobalCopyInterceptor(window)
         app.installEventFilter(interceptor)
         window.show()
-        sys.exit(app.exec())
\ No newline at end of file
+        sys.exit(app.exec())
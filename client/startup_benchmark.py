@@ -0,0 +1,89 @@
+# startup_benchmark.py
+# 测量 frpc 子进程从创建到输出第一行日志的时间（以及子进程的峰值内存），比较几种子进程入口：
+#   runner : 直接运行只依赖标准库的 frpc_runner.py（开发模式现在的做法）
+#   main   : 运行 main.py，在导入 GUI 模块之前分流（打包后的程序走的也是这个分支）
+#   legacy : 模拟原来的 main.py，先导入 PySide6、MainWindow 等模块再运行 frpc
+# 点击"启动"后的完整耗时还包括申请配置票据的网络请求，客户端会在控制台打印
+# "frpc first log line ... ms after Start"。
+#
+# 不指定 --dll 时使用一个不存在的路径：子进程在加载核心组件时报错退出，
+# 此时的"第一行输出"正好标志着子进程完成启动、即将加载核心组件，测到的就是入口本身的开销。
+# 子进程在临时目录中运行，它们写出的 frpc_child_error.log 等文件随临时目录一起删除，不会留在客户端目录里。
+#
+# 用法示例：
+#   python startup_benchmark.py
+#   python startup_benchmark.py --dll MoeFrpClient.mfc --config frpc.toml --runs 10
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+CLIENT_DIR = os.path.dirname(os.path.abspath(__file__))
+MAIN_SCRIPT = os.path.join(CLIENT_DIR, 'main.py')
+RUNNER_SCRIPT = os.path.join(CLIENT_DIR, 'frpc_runner.py')
+LEGACY_SNIPPET = (
+    "import sys; sys.path.insert(0, {client_dir!r}); "
+    "from PySide6.QtWidgets import QApplication; import MainWindow; from utils import GlobalCopyInterceptor; "
+    "from frpc_runner import run_frpc_service; run_frpc_service(sys.argv[1], sys.argv[2])"
+)
+
+MODES = {
+    "runner": lambda config, dll: [sys.executable, RUNNER_SCRIPT, config, dll],
+    "main": lambda config, dll: [sys.executable, MAIN_SCRIPT, config, dll],
+    "legacy": lambda config, dll: [sys.executable, '-c', LEGACY_SNIPPET.format(client_dir=CLIENT_DIR), config, dll],
+}
+
+
+def measure_once(command, work_dir):
+    """在 work_dir 中运行一次 command，返回 (到第一行输出的秒数, 峰值内存MB 或 None, 第一行输出)。"""
+    env = os.environ.copy()
+    env["PYTHONUNBUFFERED"] = "1" # 子进程的 print 立即写出，否则管道中的输出要等进程退出才能读到
+    creation_flags = subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0
+    started = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding='utf-8',
+                               errors='ignore', bufsize=1, env=env, cwd=work_dir, creationflags=creation_flags)
+    first_line = process.stdout.readline()
+    elapsed = time.perf_counter() - started
+    if process.poll() is None:
+        process.terminate()
+    process.stdout.close()
+    peak_mb = None
+    if hasattr(os, 'wait4'):
+        # wait4 能取到这一个子进程自己的资源统计（Linux 上 ru_maxrss 的单位是 KB，macOS 上是字节）
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        peak_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    else:
+        process.wait()
+    return elapsed, peak_mb, first_line.strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="测量 frpc 子进程的启动耗时和内存。")
+    parser.add_argument('--dll', default=os.path.join(CLIENT_DIR, 'nonexistent-core.mfc'), help="核心组件路径（默认使用不存在的路径，只测入口开销）。")
+    parser.add_argument('--config', default='frpc.toml', help="传给 frpc 的配置URL或本地路径。")
+    parser.add_argument('--runs', type=int, default=5, help="每种入口重复的次数（默认 5）。")
+    parser.add_argument('--modes', default='runner,main,legacy', help="要比较的入口，逗号分隔。")
+    args = parser.parse_args()
+    # 子进程不在当前目录运行，本地配置文件要先换成绝对路径
+    config = args.config if '://' in args.config else os.path.abspath(args.config)
+
+    print(f"{'入口':<10}{'中位数(ms)':>12}{'最小(ms)':>12}{'峰值内存(MB)':>16}  第一行输出")
+    with tempfile.TemporaryDirectory(prefix='frpc-bench-') as work_dir:
+        for mode in [m.strip() for m in args.modes.split(',') if m.strip()]:
+            command = MODES[mode](config, os.path.abspath(args.dll))
+            # 先跑一次预热磁盘缓存，不计入结果
+            measure_once(command, work_dir)
+            results = [measure_once(command, work_dir) for _ in range(args.runs)]
+            times = [elapsed * 1000 for elapsed, _, _ in results]
+            peaks = [peak for _, peak, _ in results if peak is not None]
+            peak_text = f"{max(peaks):.1f}" if peaks else "-"
+            print(f"{mode:<10}{statistics.median(times):>12.1f}{min(times):>12.1f}{peak_text:>16}  {results[-1][2][:60]}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+# tasks.py
+# 共享的后台任务执行器：图片获取、配置刷新、测速、会话检查和所有 API 请求都在同一个有上限的线程池中执行，
+# 不再为每次调用创建一个 QThread。
+#   - 优先级：用户操作（登录、保存、启动、测速）排在后台轮询和图片获取之前
+#   - 取消：任务通过 TaskContext 协作式地检查取消状态，不再强行 terminate() 正在执行的线程
+#   - 超时：可为任务设置从提交时算起的超时，超时后取消任务并以失败结束
+#   - 统计：按任务名记录次数、排队时间和执行时间，耗时过长的任务输出到控制台
+#
+# 使用方法:
+#   future = executor.submit(func, arg, name='image.fetch', priority=PRIORITY_BACKGROUND, with_context=True)
+#   future.then(self.on_done)            # 在主线程中以 (success, data) 调用
+#   future.progress.connect(self.on_progress)  # 任务中 context.report(value) 发出的中间结果
+#   future.cancel()
+# 任务函数返回 (success, data)；抛出的异常转换为 (False, 错误信息)。
+
+import threading
+import time
+
+from PySide6.QtCore import QEventLoop, QObject, QRunnable, QThreadPool, QTimer, Qt, Signal
+
+TASK_MAX_WORKERS = 4        # 同时执行的任务数上限
+TASK_SLOW_LOG_MS = 5000     # 执行时间超过此值的任务输出一条提示
+
+PRIORITY_USER = 10          # 用户正在等待结果的操作
+PRIORITY_DEFAULT = 5
+PRIORITY_BACKGROUND = 0     # 后台轮询、图片获取等用户不会察觉延迟的任务
+
+
+class TaskCancelled(Exception):
+    """任务已被取消。任务函数中由 TaskContext.check() 抛出，执行器按取消处理。"""
+
+
+class CancellationToken:
+    """协作式取消令牌：取消可以在任意线程中发生，任务在合适的位置检查并自行结束。"""
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    def is_cancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        """已取消时抛出 TaskCancelled。"""
+        if self._event.is_set(): raise TaskCancelled()
+
+    def sleep(self, seconds):
+        """可被取消打断的等待，返回 False 表示等待期间被取消。"""
+        return not self._event.wait(seconds)
+
+
+class TaskContext(CancellationToken):
+    """with_context=True 时作为第一个参数传给任务函数：取消令牌，外加向主线程报告中间结果的 report()。"""
+    def __init__(self, executor, task):
+        super().__init__()
+        self._executor = executor
+        self._task = task
+
+    def report(self, value):
+        """发出一个中间结果，由各 future 的 progress 信号在主线程中送达。已取消的任务不再报告。"""
+        if not self.is_cancelled(): self._executor._task_progress.emit(self._task, value)
+
+
+class TaskFuture(QObject):
+    """
+    一次提交的结果。finished(success, data) 在主线程中发出，每个 future 最多发出一次；取消后不再发出。
+    同一个任务被多个调用方共享（去重）时，各自的 future 互不影响。
+    """
+    finished = Signal(bool, object)
+    progress = Signal(object)
+
+    def __init__(self, executor, task):
+        super().__init__()
+        self._executor = executor
+        self._task = task
+        self._state = 'pending' # pending / done / cancelled
+        self.result = None      # 完成后为 (success, data)
+
+    def is_pending(self): return self._state == 'pending'
+    def is_done(self): return self._state == 'done'
+    def is_cancelled(self): return self._state == 'cancelled'
+
+    def then(self, callback):
+        """登记完成回调并返回自身。已经完成时回调在下一轮事件循环中调用。"""
+        if self._state == 'done':
+            QTimer.singleShot(0, lambda: callback(*self.result))
+        elif self._state == 'pending':
+            self.finished.connect(callback)
+        return self
+
+    def cancel(self):
+        """取消。任务尚未开始时从队列中移除；正在执行时通知它尽快结束，结果被丢弃。"""
+        if self._state != 'pending': return False
+        self._state = 'cancelled'
+        self._executor._detach(self._task, self)
+        return True
+
+    def wait(self, timeout_ms=None):
+        """
+        在局部事件循环中等待结果，返回 (success, data)；超时或被取消时返回 None。
+        只用于退出程序前必须完成的任务（如关闭窗口时保存配置），其他场合请使用 then()。
+        """
+        if self._state == 'pending':
+            loop = QEventLoop()
+            self.finished.connect(loop.quit)
+            if timeout_ms is not None: QTimer.singleShot(timeout_ms, loop.quit)
+            loop.exec()
+        return self.result
+
+    def _resolve(self, success, data):
+        if self._state != 'pending': return
+        self._state = 'done'
+        self.result = (success, data)
+        self.finished.emit(success, data)
+
+
+class _Task(QRunnable):
+    """在工作线程中执行的一个任务，可以由多个 future 共享。"""
+    def __init__(self, executor, name, group, key, func, args, kwargs, with_context):
+        super().__init__()
+        # 由执行器持有引用直到结果送达，不交给线程池释放
+        self.setAutoDelete(False)
+        self.name = name
+        self.group = group
+        self.key = key
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.with_context = with_context
+        self.context = TaskContext(executor, self)
+        self.executor = executor
+        self.futures = []
+        self.submitted_at = time.perf_counter()
+        self.started_at = None
+        self.finished_at = None
+        self.timed_out = False
+
+    def run(self):
+        self.started_at = time.perf_counter()
+        try:
+            self.context.check()
+            args = (self.context, *self.args) if self.with_context else self.args
+            success, data = self.func(*args, **self.kwargs)
+        except TaskCancelled:
+            success, data = False, "任务已取消"
+        except Exception as e:
+            # API 端点自己会把网络错误转换为 (False, 错误信息)，这里只兜底意外的异常
+            success, data = False, f"客户端错误: {e}"
+        self.finished_at = time.perf_counter()
+        self.executor._task_finished.emit(self, success, data)
+
+
+class TaskStats:
+    """同名任务的累计统计。排队时间从提交到开始执行，执行时间从开始到结束（秒）。"""
+    __slots__ = ('submitted', 'succeeded', 'failed', 'cancelled', 'timed_out', 'deduplicated',
+                 'wait_total', 'run_total', 'run_max')
+
+    def __init__(self):
+        self.submitted = self.succeeded = self.failed = self.cancelled = self.timed_out = self.deduplicated = 0
+        self.wait_total = self.run_total = self.run_max = 0.0
+
+    def as_dict(self):
+        ran = self.succeeded + self.failed
+        return {
+            "submitted": self.submitted, "succeeded": self.succeeded, "failed": self.failed,
+            "cancelled": self.cancelled, "timed_out": self.timed_out, "deduplicated": self.deduplicated,
+            "avg_wait_ms": self.wait_total / ran * 1000 if ran else 0.0,
+            "avg_run_ms": self.run_total / ran * 1000 if ran else 0.0,
+            "max_run_ms": self.run_max * 1000,
+        }
+
+
+class TaskExecutor(QObject):
+    """
+    有上限的共享任务执行器。必须在主线程中创建和调用；结果、进度、取消和超时都在主线程中处理，无需加锁。
+    """
+    _task_finished = Signal(object, bool, object)
+    _task_progress = Signal(object, object)
+
+    def __init__(self, parent=None, max_workers=TASK_MAX_WORKERS):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max_workers)
+        self._tasks = set()   # 尚未送达结果的任务
+        self._in_flight = {}  # 去重键 -> 任务
+        self._stats = {}
+        self._task_finished.connect(self._deliver, Qt.QueuedConnection)
+        self._task_progress.connect(self._deliver_progress, Qt.QueuedConnection)
+
+    def submit(self, func, *args, name=None, group=None, priority=PRIORITY_DEFAULT, dedupe_key=None,
+               timeout_ms=None, with_context=False, **kwargs):
+        """
+        在线程池中执行 func(*args, **kwargs)，返回 TaskFuture。
+        :param name: 统计用的任务名，默认为函数名。
+        :param group: 任务分组，cancel_all(group) 只取消这一组。
+        :param priority: 排队时优先级高的先执行，已经开始的任务不受影响。
+        :param dedupe_key: 相同键的任务仍在进行中时不再重复执行，直接共享它的结果。
+        :param timeout_ms: 从提交时算起的超时，超时后取消任务，future 以 (False, "任务超时") 结束。
+        :param with_context: 为 True 时把 TaskContext 作为第一个参数传给 func，用于检查取消和报告进度。
+        """
+        name = name or getattr(func, '__name__', 'task')
+        stats = self._stats.setdefault(name, TaskStats())
+        task = self._in_flight.get(dedupe_key) if dedupe_key is not None else None
+        if task is None:
+            task = _Task(self, name, group, dedupe_key, func, args, kwargs, with_context)
+            stats.submitted += 1
+            self._tasks.add(task)
+            if dedupe_key is not None: self._in_flight[dedupe_key] = task
+            self.pool.start(task, priority)
+            if timeout_ms is not None: QTimer.singleShot(timeout_ms, lambda: self._on_timeout(task))
+        else:
+            stats.deduplicated += 1
+        future = TaskFuture(self, task)
+        task.futures.append(future)
+        return future
+
+    def cancel_all(self, group=None):
+        """取消所有（或某一组）未完成的任务。"""
+        for task in list(self._tasks):
+            if group is not None and task.group != group: continue
+            for future in list(task.futures): future.cancel()
+
+    def shutdown(self, wait_ms=0):
+        """取消所有任务，并最多等待 wait_ms 毫秒让正在执行的任务结束。"""
+        self.cancel_all()
+        self.pool.clear()
+        if wait_ms: self.pool.waitForDone(wait_ms)
+
+    def stats(self):
+        return {name: stats.as_dict() for name, stats in self._stats.items()}
+
+    def _forget(self, task):
+        self._tasks.discard(task)
+        if task.key is not None and self._in_flight.get(task.key) is task: del self._in_flight[task.key]
+
+    def _detach(self, task, future):
+        if future in task.futures: task.futures.remove(future)
+        if task.futures: return
+        # 没有调用方再需要这个结果：通知任务结束，之后的相同任务重新执行
+        task.context.cancel()
+        if task.key is not None and self._in_flight.get(task.key) is task: del self._in_flight[task.key]
+        if self.pool.tryTake(task):
+            self._stats[task.name].cancelled += 1
+            self._forget(task)
+
+    def _on_timeout(self, task):
+        if task not in self._tasks or not task.futures: return
+        task.timed_out = True
+        task.context.cancel()
+        self._stats[task.name].timed_out += 1
+        if self.pool.tryTake(task): self._forget(task)
+        elif task.key is not None and self._in_flight.get(task.key) is task: del self._in_flight[task.key]
+        futures, task.futures = task.futures, []
+        for future in futures: future._resolve(False, "任务超时")
+
+    def _deliver(self, task, success, data):
+        self._forget(task)
+        stats = self._stats[task.name]
+        run_time = task.finished_at - task.started_at
+        if task.timed_out:
+            pass # 已经按超时结束并计数
+        elif task.context.is_cancelled():
+            stats.cancelled += 1
+        else:
+            if success: stats.succeeded += 1
+            else: stats.failed += 1
+            stats.wait_total += task.started_at - task.submitted_at
+            stats.run_total += run_time
+            stats.run_max = max(stats.run_max, run_time)
+        if run_time * 1000 >= TASK_SLOW_LOG_MS:
+            print(f"[Tasks] {task.name} took {run_time * 1000:.0f} ms (waited {(task.started_at - task.submitted_at) * 1000:.0f} ms).")
+        futures, task.futures = task.futures, []
+        for future in futures: future._resolve(success, data)
+
+    def _deliver_progress(self, task, value):
+        for future in list(task.futures): future.progress.emit(value)
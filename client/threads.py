@@ -1,34 +1,120 @@
 # threads.py
-import socket
+import json
+import random
 import time
 import requests
-from PySide6.QtCore import QThread, Signal, QByteArray
+from PySide6.QtCore import QThread, Signal
 from api.base import BaseClient
+from tasks import TaskCancelled
 from utils import _get_value_from_path # 从 utils.py 导入
 
-# --- 子线程定义 ---
-class PingThread(QThread):
-    result_ready = Signal(int, float)
-    def __init__(self, nodes, parent=None): super().__init__(parent); self.nodes = nodes
-    def run(self):
-        for i, node in enumerate(self.nodes):
-            try:
-                addr = node.get('server_addr'); port = int(node.get('server_port')); start_time = time.time()
-                sock = socket.create_connection((addr, port), timeout=2); end_time = time.time(); sock.close()
-                self.result_ready.emit(i, (end_time - start_time) * 1000)
-            except Exception: self.result_ready.emit(i, -1)
-
-class RefreshThread(QThread):
-    finished = Signal(bool, dict)
-    def __init__(self, config_api_client, token, parent=None):
+# --- 后台任务 ---
+# 以下函数交给 tasks.TaskExecutor 执行（with_context=True），第一个参数是 TaskContext，返回 (success, data)。
+
+IMAGE_DOWNLOAD_CHUNK = 64 * 1024 # 下载图片时每读取这么多字节检查一次是否已取消
+
+# 服务器事件流监听线程，代替定时轮询会话状态和配置
+class EventListenerThread(QThread):
+    """
+    与服务器保持一条 SSE 长连接，收到事件后通知主线程。
+    断线后按指数退避（带随机抖动）自动重连；服务器不支持事件流时发出 unsupported，由调用方退回定时轮询。
+    """
+    connected = Signal(str)             # 连接建立，参数为服务器当前的配置ETag
+    config_changed = Signal()
+    share_revoked = Signal(str)         # 被撤销的 share_id
+    session_invalidated = Signal(str)   # 失效原因：displaced / logout / expired，或服务器返回的错误信息
+    unsupported = Signal()
+
+    BACKOFF_INITIAL = 1
+    BACKOFF_MAX = 60
+
+    def __init__(self, events_api_client, token, parent=None):
         super().__init__(parent)
-        self.config_api_client = config_api_client # 重命名成员变量以反映其具体职责
+        self.events_api_client = events_api_client
         self.token = token
- 
+        self._stopped = False
+        self._response = None
+
+    def stop(self):
+        """停止监听，不等待线程结束。"""
+        self._stopped = True
+        response = self._response
+        if response is not None: self._interrupt_read(response)
+
+    @staticmethod
+    def _interrupt_read(response):
+        """
+        打断监听线程正在阻塞的读取，连接随后由监听线程自己 close()。
+        在别的线程里直接 close() 响应会等那次读取返回（最长一个心跳间隔），调用方（主线程）会因此卡住；
+        urllib3 的 shutdown() 只关闭套接字的读方向，读取立即返回。连接已被释放等情况下不做处理，
+        线程会在下一个心跳或读超时后自行退出。
+        """
+        try:
+            response.raw.shutdown()
+        except (AttributeError, ValueError, RuntimeError, OSError):
+            pass
+
     def run(self):
-        # 直接调用传递进来的具体客户端的方法，不再需要 .config 前缀
-        success, data = self.config_api_client.get_all_configs(self.token)
-        self.finished.emit(success, data)
+        backoff = self.BACKOFF_INITIAL
+        while not self._stopped:
+            success, result = self.events_api_client.open_stream(self.token)
+            if success:
+                self._response = result
+                try:
+                    for event_type, data in self._iter_events(result):
+                        if self._stopped: return
+                        backoff = self.BACKOFF_INITIAL
+                        if self._dispatch(event_type, data): return
+                except Exception as e:
+                    # 网络中断、读超时或 stop() 关闭了连接，都在下面统一重连或退出
+                    if not self._stopped: print(f"[EventListener] Stream interrupted: {e}")
+                finally:
+                    self._response = None
+                    result.close()
+            else:
+                status_code, message = result
+                if self._stopped: return
+                if status_code == 401:
+                    self.session_invalidated.emit(str(message)); return
+                if status_code in (404, 405):
+                    self.unsupported.emit(); return
+                print(f"[EventListener] Connect failed: {message}")
+
+            # 退避等待，分段睡眠以便及时响应 stop()
+            deadline = time.monotonic() + backoff * random.uniform(0.5, 1.0)
+            while not self._stopped and time.monotonic() < deadline:
+                time.sleep(0.2)
+            backoff = min(backoff * 2, self.BACKOFF_MAX)
+
+    def _dispatch(self, event_type, data):
+        """发出对应的信号，返回 True 表示事件流应当结束。"""
+        if event_type == 'hello':
+            self.connected.emit(data.get('etag') or '')
+        elif event_type == 'config_changed':
+            self.config_changed.emit()
+        elif event_type == 'share_revoked':
+            self.share_revoked.emit(data.get('share_id', ''))
+        elif event_type == 'session_invalidated':
+            self.session_invalidated.emit(data.get('reason', ''))
+            return True
+        return False
+
+    @staticmethod
+    def _iter_events(response):
+        """按 text/event-stream 格式解析出 (event, data)。以冒号开头的心跳行直接忽略。"""
+        event_type, data_lines = 'message', []
+        # 事件很小且间隔很长，逐字节读取才能在事件到达时立即处理，而不是等缓冲区填满
+        for line in response.iter_lines(chunk_size=1, decode_unicode=True):
+            if not line:
+                if data_lines:
+                    yield event_type, json.loads("\n".join(data_lines))
+                event_type, data_lines = 'message', []
+                continue
+            if line.startswith(':'): continue
+            field, _, value = line.partition(':')
+            if value.startswith(' '): value = value[1:]
+            if field == 'event': event_type = value
+            elif field == 'data': data_lines.append(value)
 
 # 用于读取子进程日志的线程
 class LogReaderThread(QThread):
@@ -49,82 +135,73 @@ class LogReaderThread(QThread):
         finally:
             self.pipe.close()
 
-# 用于异步获取网络图片的线程
-class ImageFetcherThread(QThread):
+# 异步获取网络图片
+def _download(context, session, url, timeout, headers):
+    """分块下载，块与块之间检查取消，被取消的下载最多再读一个块就结束。"""
+    with session.get(url, timeout=timeout, headers=headers, stream=True) as response:
+        response.raise_for_status()
+        chunks = []
+        for chunk in response.iter_content(IMAGE_DOWNLOAD_CHUNK):
+            context.check()
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+def fetch_image(context, source):
     """
-    一个通用的图片获取线程。
-    现在它使用全局共享的、不受系统代理影响的Session。
+    通用的图片获取任务，使用全局共享的、不受系统代理影响的Session。
+    成功时返回 (True, 图片字节)，失败时返回 (False, 错误信息)。
     """
-    image_ready = Signal(QByteArray)
-    error_occurred = Signal(str)
- 
-    def __init__(self, source_object: dict, parent=None): # 不再需要 settings 参数
-        """
-        构造函数现在只需要源对象。
-        """
-        super().__init__(parent)
-        self.source = source_object
-        self.is_running = True
- 
-    def run(self):
-        # 直接从 BaseClient 获取纯净的会话对象
-        session = BaseClient._get_active_session() 
-        log_msg = ""
-        if BaseClient._current_proxy_mode == 'system':
-            log_msg = " (via system proxy)"
-        elif BaseClient._current_proxy_mode == 'custom' and session.proxies:
-            log_msg = f" (via custom proxy: {session.proxies.get('http')})"
- 
-        headers = {'User-Agent': 'MoeFRP-Client/1.0'}
-        source_url = self.source.get("url")
-        if not source_url:
-            self.error_occurred.emit("图片源配置错误，缺少 'url' 键。")
-            return
- 
-        try:
-            image_data = None
-            
-            if self.source.get("is_api"):
-                # --- API类型处理 ---
-                print(f"[ImageFetcher] Stage 1: Fetching JSON from {source_url}{log_msg}")
-                api_response = session.get(source_url, timeout=10, headers=headers)
-                api_response.raise_for_status()
-                data = api_response.json()
-                
-                json_path = self.source.get("json_path")
-                if not json_path:
-                    raise ValueError(f"API源 {source_url} 缺少 'json_path' 配置")
- 
-                final_image_url = _get_value_from_path(data, json_path)
-                if not final_image_url or not isinstance(final_image_url, str):
-                    raise ValueError(f"无法根据路径 '{json_path}' 在API响应中找到有效的图片URL")
- 
-                print(f"[ImageFetcher] Stage 2: Fetching image from {final_image_url}{log_msg}")
-                image_response = session.get(final_image_url, timeout=15, headers=headers)
-                image_response.raise_for_status()
-                image_data = image_response.content
-            
-            else:
-                # --- 普通图片源处理 ---
-                print(f"[ImageFetcher] Direct Fetch: from {source_url}{log_msg}")
-                response = session.get(source_url, timeout=15, headers=headers)
-                response.raise_for_status()
-                image_data = response.content
- 
-            if image_data:
-                self.image_ready.emit(QByteArray(image_data))
-            else:
-                raise ValueError("最终未能获取到任何图片数据。")
- 
-        except requests.exceptions.ProxyError as e:
-             # 捕获SOCKS代理依赖问题
-            if "SOCKS support" in str(e):
-                error_msg = ("SOCKS代理依赖缺失！\n\n请在命令行运行:\n 'pip install \"requests[socks]\"' \n\n然后重启程序。")
-                self.error_occurred.emit(error_msg)
-            else:
-                self.error_occurred.emit(f"应用内代理错误: {e}")
-        except Exception as e:
-            self.error_occurred.emit(f"获取图片失败: {e}")
- 
-    def stop(self):
-        self.is_running = True
\ No newline at end of file
+    # 直接从 BaseClient 获取纯净的会话对象
+    session = BaseClient._get_active_session()
+    log_msg = ""
+    if BaseClient._current_proxy_mode == 'system':
+        log_msg = " (via system proxy)"
+    elif BaseClient._current_proxy_mode == 'custom' and session.proxies:
+        log_msg = f" (via custom proxy: {session.proxies.get('http')})"
+
+    headers = {'User-Agent': 'MoeFRP-Client/1.0'}
+    source_url = source.get("url")
+    if not source_url:
+        return False, "图片源配置错误，缺少 'url' 键。"
+
+    try:
+        image_data = None
+
+        if source.get("is_api"):
+            # --- API类型处理 ---
+            print(f"[ImageFetcher] Stage 1: Fetching JSON from {source_url}{log_msg}")
+            data = json.loads(_download(context, session, source_url, 10, headers))
+
+            json_path = source.get("json_path")
+            if not json_path:
+                raise ValueError(f"API源 {source_url} 缺少 'json_path' 配置")
+
+            final_image_url = _get_value_from_path(data, json_path)
+            if not final_image_url or not isinstance(final_image_url, str):
+                raise ValueError(f"无法根据路径 '{json_path}' 在API响应中找到有效的图片URL")
+
+            context.check()
+            print(f"[ImageFetcher] Stage 2: Fetching image from {final_image_url}{log_msg}")
+            image_data = _download(context, session, final_image_url, 15, headers)
+
+        else:
+            # --- 普通图片源处理 ---
+            print(f"[ImageFetcher] Direct Fetch: from {source_url}{log_msg}")
+            image_data = _download(context, session, source_url, 15, headers)
+
+        if image_data:
+            return True, image_data
+        else:
+            raise ValueError("最终未能获取到任何图片数据。")
+
+    except requests.exceptions.ProxyError as e:
+         # 捕获SOCKS代理依赖问题
+        if "SOCKS support" in str(e):
+            error_msg = ("SOCKS代理依赖缺失！\n\n请在命令行运行:\n 'pip install \"requests[socks]\"' \n\n然后重启程序。")
+            return False, error_msg
+        else:
+            return False, f"应用内代理错误: {e}"
+    except TaskCancelled:
+        raise
+    except Exception as e:
+        return False, f"获取图片失败: {e}"
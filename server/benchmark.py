@@ -0,0 +1,447 @@
+# benchmark.py
+# 云端 API 的负载测试与延迟基准。
+# 在临时目录中用合成数据库（数千用户、分享和订阅）启动 server.py，
+# 按真实客户端的请求组合施压，输出各路由的 p50/p95/p99 延迟、吞吐量和错误率。
+#
+# 用法示例：
+#   python benchmark.py                                     # 默认 2000 用户、32 个并发客户端、压测 30 秒
+#   python benchmark.py --clients 64 --duration 60 --json result.json
+#   python benchmark.py --baseline result.json              # 与之前保存的结果比较，p95 变慢超过容差时返回非零退出码
+#   python benchmark.py --mix configs=20,session=20,share_use=30,ticket=25,login=5
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import requests
+
+from blobs import migrate_rows_to_blobs
+
+APP_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 压测专用的客户端身份，只注入到压测启动的服务器进程中
+BENCH_VERSION = "1000"
+BENCH_SECRET = "bench-version-secret"
+BENCH_DLL_HASH = "bench-dll-hash"
+BENCH_PASSWORD = "bench-password"
+
+# 各操作的默认权重，对应桌面客户端的实际行为
+DEFAULT_MIX = {
+    "configs": 40,      # 后台刷新 GET /api/configs（带 If-None-Match）
+    "session": 40,      # POST /api/session/check
+    "share_use": 10,    # 切换到分享配置 / 启动前编译分享
+    "ticket": 8,        # request_config_ticket + 两次 get_temp_config（frpc 启动）
+    "login": 2,         # get_challenge + login
+}
+TICKET_RATE_LIMIT_SECONDS = 3.1  # 服务器对每个用户申请票据的限速是3秒
+
+
+# --- 服务器进程部分 ---
+
+def nickname_for(index):
+    return f"bench_{index}"
+
+def share_id_for(index):
+    return f"share-bench-{index}"
+
+def make_nodes(rng, count):
+    return [{"remark": f"node-{i}", "server_addr": f"10.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{i + 1}",
+             "server_port": 7000, "token": secrets_hex(rng)} for i in range(count)]
+
+def make_proxies(rng, count):
+    proxies = []
+    for i in range(count):
+        if rng.random() < 0.3:
+            proxies.append({"name": f"web-{i}", "type": "http", "local_ip": "127.0.0.1", "local_port": str(8000 + i),
+                            "remote_port": "", "custom_domains": f"site{i}.example.com"})
+        else:
+            proxies.append({"name": f"tcp-{i}", "type": "tcp", "local_ip": "127.0.0.1", "local_port": str(2000 + i),
+                            "remote_port": str(rng.randint(10000, 60000)), "custom_domains": ""})
+    return proxies
+
+def secrets_hex(rng):
+    return "%032x" % rng.getrandbits(128)
+
+def populate_database(db, users, shares, seed, password_hash):
+    """写入合成数据。用户昵称和分享ID按序号生成，压测端无需读取数据库即可知道它们。"""
+    rng = random.Random(seed)
+    user_uuids = [str(uuid.UUID(int=rng.getrandbits(128), version=4)) for _ in range(users)]
+    db.executemany('INSERT INTO users (uuid, nickname, password_hash) VALUES (?, ?, ?)',
+                   [(user_uuid, nickname_for(i), password_hash) for i, user_uuid in enumerate(user_uuids)])
+
+    personal_rows = []
+    for user_uuid in user_uuids:
+        for k in range(rng.randint(1, 3)):
+            config = {"nodes": make_nodes(rng, rng.randint(1, 3)), "proxies": make_proxies(rng, rng.randint(2, 8))}
+            personal_rows.append((f"conf-{secrets_hex(rng)}", user_uuid, f"配置 {k + 1}", json.dumps(config)))
+    db.executemany('INSERT INTO personal_configs (config_id, owner_uuid, profile_name, config_json) VALUES (?, ?, ?, ?)', personal_rows)
+
+    share_rows = []
+    for i in range(shares):
+        is_template = i % 2 == 1
+        if is_template:
+            config_data = {"nodes": make_nodes(rng, rng.randint(2, 5))}
+        else:
+            node = make_nodes(rng, 1)[0]
+            config_data = {"serverAddr": node["server_addr"], "serverPort": node["server_port"], "auth": {"token": node["token"]},
+                           "proxies": [{"name": p["name"], "type": p["type"], "localIP": p["local_ip"], "localPort": int(p["local_port"]),
+                                        "remotePort": int(p["remote_port"] or 0), "custom_domains": p["custom_domains"]}
+                                       for p in make_proxies(rng, rng.randint(1, 6))]}
+        share_rows.append((share_id_for(i), rng.choice(user_uuids), f"分享 {i}", is_template, json.dumps(config_data)))
+    db.executemany('INSERT INTO shares (share_id, owner_uuid, share_name, is_template, config_data_json) VALUES (?, ?, ?, ?, ?)', share_rows)
+
+    subscription_rows = []
+    for user_uuid in user_uuids:
+        for share_index in rng.sample(range(shares), min(shares, rng.randint(0, 3))):
+            user_params = {"node_remark": "node-0", "proxies": make_proxies(rng, rng.randint(1, 4))} if share_index % 2 == 1 else {}
+            subscription_rows.append((f"sub-{secrets_hex(rng)}", user_uuid, share_id_for(share_index), json.dumps(user_params)))
+    db.executemany('INSERT INTO subscriptions (subscription_id, user_uuid, share_id, user_params_json) VALUES (?, ?, ?, ?)', subscription_rows)
+    # 先按旧的文本列写入，再用迁移步骤转存到 config_blobs，与线上旧库升级后的状态一致
+    migrate_rows_to_blobs(db)
+    db.commit()
+    return len(personal_rows), len(subscription_rows)
+
+def serve(args):
+    """在工作目录中导入 server.py、准备合成数据库并启动多线程 HTTP 服务。由压测主进程以子进程方式调用。"""
+    import logging
+    import sqlite3
+    from werkzeug.serving import make_server
+
+    os.chdir(args.workdir)
+    sys.path.insert(0, APP_BASE_DIR)
+    import server
+
+    server.TRUSTED_SECRET_MAP[BENCH_SECRET] = {"version": BENCH_VERSION, "secret": BENCH_SECRET, "dll_hash": BENCH_DLL_HASH}
+    server.MIN_CLIENT_VERSION = 0
+    if not args.keep_limits:
+        server.limiter.enabled = False
+    server.init_db()
+
+    db = sqlite3.connect(server.DATABASE)
+    if db.execute('SELECT COUNT(*) FROM users').fetchone()[0] == 0:
+        started_at = time.time()
+        password_hash = server.ph.local_hasher.hash(BENCH_PASSWORD)
+        configs, subscriptions = populate_database(db, args.users, args.shares, args.seed, password_hash)
+        db.execute('ANALYZE')
+        print(f"Synthetic database: {args.users} users, {configs} personal configs, {args.shares} shares, "
+              f"{subscriptions} subscriptions ({time.time() - started_at:.1f}s)", flush=True)
+    db.close()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    http_server = make_server('127.0.0.1', args.port, server.app, threaded=True)
+    # 收到 terminate() 时正常退出，让 atexit 关闭哈希进程池，否则其工作进程会成为孤儿进程
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("BENCH_READY", flush=True)
+    # 就绪之后不再向管道写任何内容，避免主进程不读取时管道写满而阻塞
+    sys.stdout = open(os.devnull, 'w')
+    http_server.serve_forever()
+
+
+# --- 压测端部分 ---
+
+class RouteStats:
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.statuses = {}
+
+class VirtualClient:
+    """模拟一个已登录的桌面客户端，使用独立的 keep-alive 连接。"""
+    def __init__(self, base_url, index, shares, rng, record):
+        self.base_url = base_url
+        self.index = index
+        self.shares = shares
+        self.rng = rng
+        self.record = record
+        self.session = requests.Session()
+        self.session.trust_env = False
+        self.token = None
+        self.configs_etag = None
+        self.last_ticket_at = 0.0
+
+    def request(self, route, method, path, expect=(200,), **kwargs):
+        started_at = time.perf_counter()
+        try:
+            response = self.session.request(method, f"{self.base_url}{path}", timeout=30, **kwargs)
+            status = response.status_code
+        except requests.exceptions.RequestException:
+            response, status = None, 0
+        self.record(route, time.perf_counter() - started_at, status, status in expect)
+        return response if status in expect else None
+
+    def auth_headers(self):
+        return {"Authorization": f"Bearer {self.token}"}
+
+    def login(self):
+        nickname = nickname_for(self.index)
+        response = self.request("POST /api/login/get_challenge", "POST", "/api/login/get_challenge", json={"nickname": nickname})
+        if response is None:
+            return False
+        challenge = response.json()["challenge"]
+        proof = hashlib.sha256(f"{BENCH_SECRET}:{BENCH_DLL_HASH}:{BENCH_VERSION}:{challenge}".encode('utf-8')).hexdigest()
+        response = self.request("POST /api/login", "POST", "/api/login", json={
+            "nickname": nickname, "password": BENCH_PASSWORD, "version": BENCH_VERSION,
+            "version_secret": BENCH_SECRET, "dll_hash": BENCH_DLL_HASH, "challenge": challenge, "proof": proof,
+        })
+        if response is None:
+            return False
+        self.token = response.json()["session_token"]
+        self.configs_etag = None
+        return True
+
+    def poll_configs(self):
+        headers = self.auth_headers()
+        if self.configs_etag:
+            headers["If-None-Match"] = self.configs_etag
+        response = self.request("GET /api/configs", "GET", "/api/configs", expect=(200, 304), headers=headers)
+        if response is not None and response.status_code == 200:
+            self.configs_etag = response.headers.get("ETag")
+
+    def check_session(self):
+        self.request("POST /api/session/check", "POST", "/api/session/check", headers=self.auth_headers())
+
+    def use_share(self):
+        share_index = self.rng.randrange(self.shares)
+        user_params = {"node_remark": "node-0", "proxies": make_proxies(self.rng, 3)} if share_index % 2 == 1 else {}
+        self.request("POST /api/share/use", "POST", "/api/share/use", json={"share_id": share_id_for(share_index), "user_params": user_params})
+
+    def start_frpc(self):
+        # 服务器限制每个用户3秒只能申请一次票据，限速窗口内改为一次普通轮询
+        if time.monotonic() - self.last_ticket_at < TICKET_RATE_LIMIT_SECONDS:
+            self.poll_configs()
+            return
+        self.last_ticket_at = time.monotonic()
+        response = self.request("POST /api/request_config_ticket", "POST", "/api/request_config_ticket",
+                                headers=self.auth_headers(), json={"config_content": 'serverAddr = "127.0.0.1"\nserverPort = 7000\n'})
+        if response is None:
+            return
+        config_id = response.json()["config_id"]
+        # frpc 启动时会先后两次读取配置
+        for _ in range(2):
+            self.request("GET /api/get_temp_config/<id>", "GET", f"/api/get_temp_config/{config_id}")
+
+    def run_operation(self, name):
+        if name == "login":
+            self.login()
+        elif name == "configs":
+            self.poll_configs()
+        elif name == "session":
+            self.check_session()
+        elif name == "share_use":
+            self.use_share()
+        elif name == "ticket":
+            self.start_frpc()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def summarize(stats, elapsed):
+    def summary(latencies, errors, statuses):
+        latencies = sorted(latencies)
+        count = len(latencies)
+        return {
+            "count": count,
+            "errors": errors,
+            "error_rate": errors / count if count else 0.0,
+            "throughput": count / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "max_ms": (latencies[-1] * 1000) if latencies else 0.0,
+            "statuses": {str(code): n for code, n in sorted(statuses.items())},
+        }
+    routes = {route: summary(s.latencies, s.errors, s.statuses) for route, s in sorted(stats.items())}
+    all_statuses = {}
+    for s in stats.values():
+        for code, n in s.statuses.items():
+            all_statuses[code] = all_statuses.get(code, 0) + n
+    total = summary([l for s in stats.values() for l in s.latencies], sum(s.errors for s in stats.values()), all_statuses)
+    return routes, total
+
+def print_report(routes, total):
+    header = f"{'route':<36} {'count':>8} {'err%':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}"
+    print(header)
+    print("-" * len(header))
+    for route, r in list(routes.items()) + [("TOTAL", total)]:
+        print(f"{route:<36} {r['count']:>8} {r['error_rate'] * 100:>6.2f}% {r['throughput']:>9.1f} "
+              f"{r['p50_ms']:>9.2f} {r['p95_ms']:>9.2f} {r['p99_ms']:>9.2f} {r['max_ms']:>9.2f}")
+        bad = {code: n for code, n in r['statuses'].items() if not code.startswith(('2', '3'))}
+        if bad and route != "TOTAL":
+            print(f"{'':<36} 非2xx/3xx状态: {bad}")
+
+def compare_with_baseline(routes, baseline_path, tolerance):
+    """与基线结果比较，返回退化的路由列表。"""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)["routes"]
+    regressions = []
+    print(f"\n与基线 {baseline_path} 比较（p95 容差 {tolerance * 100:.0f}%）：")
+    for route, r in routes.items():
+        old = baseline.get(route)
+        if not old or not old["p95_ms"]:
+            continue
+        ratio = r["p95_ms"] / old["p95_ms"]
+        flags = []
+        if ratio > 1 + tolerance:
+            flags.append("p95 退化")
+        if r["error_rate"] > old["error_rate"] + 0.01:
+            flags.append("错误率上升")
+        print(f"  {route:<36} p95 {old['p95_ms']:.2f} -> {r['p95_ms']:.2f} ms ({(ratio - 1) * 100:+.1f}%)"
+              f"  错误率 {old['error_rate'] * 100:.2f}% -> {r['error_rate'] * 100:.2f}%  {' '.join(flags)}")
+        if flags:
+            regressions.append(route)
+    return regressions
+
+def parse_mix(text):
+    mix = dict(DEFAULT_MIX)
+    if text:
+        mix = {name: 0 for name in DEFAULT_MIX}
+        for part in text.split(','):
+            name, _, weight = part.partition('=')
+            name = name.strip()
+            if name not in DEFAULT_MIX:
+                raise argparse.ArgumentTypeError(f"未知的操作 '{name}'，可选：{', '.join(DEFAULT_MIX)}")
+            mix[name] = float(weight)
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("请求组合的权重之和不能为0")
+    return mix
+
+def find_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_server(args, workdir, port):
+    command = [sys.executable, os.path.abspath(__file__), '--serve', '--workdir', workdir, '--port', str(port),
+               '--users', str(args.users), '--shares', str(args.shares), '--seed', str(args.seed)]
+    if args.keep_limits:
+        command.append('--keep-limits')
+    # 服务器的控制台日志写入工作目录，不与压测报告混在一起
+    stderr_path = os.path.join(workdir, 'server-stderr.log')
+    with open(stderr_path, 'w', encoding='utf-8') as stderr_log:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_log, text=True, encoding='utf-8')
+    for line in process.stdout:
+        line = line.rstrip()
+        if line == "BENCH_READY":
+            return process
+        print(f"[server] {line}")
+    raise RuntimeError(f"服务器进程启动失败，退出码 {process.wait()}，详见 {stderr_path}")
+
+def run_load(args, base_url, mix):
+    names, weights = list(mix), list(mix.values())
+    stop_at = time.monotonic() + args.warmup + args.duration
+    measure_from = time.monotonic() + args.warmup
+    results = []
+
+    def worker(index):
+        rng = random.Random(args.seed * 1000003 + index)
+        stats = {}
+        def record(route, latency, status, ok):
+            if time.monotonic() < measure_from:
+                return
+            route_stats = stats.get(route)
+            if route_stats is None:
+                route_stats = stats[route] = RouteStats()
+            route_stats.latencies.append(latency)
+            route_stats.statuses[status] = route_stats.statuses.get(status, 0) + 1
+            if not ok:
+                route_stats.errors += 1
+        client = VirtualClient(base_url, index % args.users, args.shares, rng, record)
+        client.login()
+        while time.monotonic() < stop_at:
+            if client.token is None:
+                client.login()
+            else:
+                client.run_operation(rng.choices(names, weights)[0])
+            if args.think_ms:
+                time.sleep(rng.uniform(0, 2 * args.think_ms) / 1000)
+        results.append(stats)
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    merged = {}
+    for stats in results:
+        for route, s in stats.items():
+            target = merged.setdefault(route, RouteStats())
+            target.latencies.extend(s.latencies)
+            target.errors += s.errors
+            for code, n in s.statuses.items():
+                target.statuses[code] = target.statuses.get(code, 0) + n
+    return merged
+
+def main():
+    parser = argparse.ArgumentParser(description="FRP高级客户端 - 云端API负载测试与延迟基准", formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--users', type=int, default=2000, help="合成数据库中的用户数（默认 2000）。")
+    parser.add_argument('--shares', type=int, default=500, help="合成数据库中的分享数（默认 500，一半为模板分享）。")
+    parser.add_argument('--clients', type=int, default=32, help="并发的虚拟客户端数（默认 32）。")
+    parser.add_argument('--duration', type=float, default=30, help="计入统计的压测时长，单位秒（默认 30）。")
+    parser.add_argument('--warmup', type=float, default=3, help="预热时长，期间的请求不计入统计（默认 3）。")
+    parser.add_argument('--think-ms', type=float, default=0, help="每次操作后的平均等待时间，0 表示不等待、测最大吞吐（默认 0）。")
+    parser.add_argument('--mix', type=parse_mix, default=dict(DEFAULT_MIX), help=f"请求组合权重，默认 {','.join(f'{k}={v}' for k, v in DEFAULT_MIX.items())}")
+    parser.add_argument('--seed', type=int, default=42, help="随机种子，相同参数可复现同样的数据和请求序列。")
+    parser.add_argument('--keep-limits', action='store_true', help="保留 Flask-Limiter 的速率限制（默认关闭，否则大部分请求会被429）。")
+    parser.add_argument('--workdir', help="服务器工作目录。指定后数据库会保留并在下次复用；默认使用临时目录并在结束后删除。")
+    parser.add_argument('--json', metavar='FILE', help="将结果写入JSON文件，可作为之后比较的基线。")
+    parser.add_argument('--baseline', metavar='FILE', help="与之前保存的JSON结果比较。")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="与基线比较时 p95 允许变慢的比例（默认 0.2）。")
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="moefrp-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    port = find_free_port()
+    print(f"工作目录: {workdir}")
+    process = start_server(args, workdir, port)
+    try:
+        print(f"压测中：{args.clients} 个客户端，预热 {args.warmup:g}s + 统计 {args.duration:g}s，请求组合 {args.mix}")
+        started_at = time.monotonic()
+        stats = run_load(args, f"http://127.0.0.1:{port}", args.mix)
+        elapsed = time.monotonic() - started_at - args.warmup
+    finally:
+        process.terminate()
+        try: process.wait(timeout=10)
+        except subprocess.TimeoutExpired: process.kill()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    routes, total = summarize(stats, elapsed)
+    print()
+    print_report(routes, total)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({"params": {k: v for k, v in vars(args).items() if k not in ('serve', 'port', 'json', 'baseline')},
+                       "routes": routes, "total": total}, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已写入 {args.json}")
+
+    if args.baseline:
+        regressions = compare_with_baseline(routes, args.baseline, args.tolerance)
+        if regressions:
+            print(f"\n发现 {len(regressions)} 个路由性能退化。")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
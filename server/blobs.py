@@ -0,0 +1,97 @@
+# blobs.py
+# 按内容寻址的配置存储：个人配置、分享和订阅参数的 JSON 文本按 SHA-256 去重，较大的文本用 zlib 压缩后存放。
+# 引用这些内容的行只保存哈希；引用计数由触发器维护，最后一个引用消失时内容随之删除。
+
+import hashlib
+import zlib
+
+COMPRESSION_MIN_BYTES = 128  # 小于此长度的文本（如默认配置 '{}'）压缩收益为负，原样存放
+COMPRESSION_LEVEL = 6
+
+# (表, 引用列, 旧的文本列)。旧列在迁移后清空而不删除：DROP COLUMN 需要 SQLite 3.35 以上
+BLOB_REFERENCES = (
+    ('personal_configs', 'config_blob', 'config_json'),
+    ('shares', 'config_blob', 'config_data_json'),
+    ('subscriptions', 'user_params_blob', 'user_params_json'),
+)
+
+
+def encode_blob(text):
+    """返回 (哈希, 编码方式, 存储的字节)。"""
+    raw = text.encode('utf-8')
+    digest = hashlib.sha256(raw).hexdigest()
+    if len(raw) >= COMPRESSION_MIN_BYTES:
+        compressed = zlib.compress(raw, COMPRESSION_LEVEL)
+        if len(compressed) < len(raw):
+            return digest, 'zlib', compressed
+    return digest, 'raw', raw
+
+
+def decode_blob(encoding, data):
+    if data is None:
+        return None
+    if encoding == 'zlib':
+        data = zlib.decompress(data)
+    return bytes(data).decode('utf-8')
+
+
+def store_blob(db, text):
+    """
+    保存一段 JSON 文本并返回它的哈希，供调用方写入引用列（不提交事务）。text 为 None 时返回 None。
+    内容已存在时不再压缩和写入。新内容的引用计数从 0 开始，必须在同一事务中写入引用它的行，
+    否则会留下无人引用的内容。
+    """
+    if text is None:
+        return None
+    digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    if db.execute('SELECT 1 FROM config_blobs WHERE hash = ?', (digest,)).fetchone() is None:
+        digest, encoding, data = encode_blob(text)
+        db.execute('INSERT OR IGNORE INTO config_blobs (hash, encoding, data, size) VALUES (?, ?, ?, ?)',
+                   (digest, encoding, data, len(text.encode('utf-8'))))
+    return digest
+
+
+def blob_reference_triggers(table, column):
+    """为引用列生成维护引用计数的触发器。外键级联删除（如删除用户）同样会触发。"""
+    release = f"""
+            UPDATE config_blobs SET ref_count = ref_count - 1 WHERE hash = OLD.{column};
+            DELETE FROM config_blobs WHERE hash = OLD.{column} AND ref_count <= 0;"""
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS trg_{table}_{column}_insert AFTER INSERT ON {table}
+        WHEN NEW.{column} IS NOT NULL BEGIN
+            UPDATE config_blobs SET ref_count = ref_count + 1 WHERE hash = NEW.{column};
+        END;""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_{table}_{column}_update AFTER UPDATE OF {column} ON {table}
+        WHEN NEW.{column} IS NOT OLD.{column} BEGIN
+            UPDATE config_blobs SET ref_count = ref_count + 1 WHERE hash = NEW.{column};{release}
+        END;""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_{table}_{column}_delete AFTER DELETE ON {table}
+        WHEN OLD.{column} IS NOT NULL BEGIN{release}
+        END;""",
+    ]
+
+
+def migrate_rows_to_blobs(db, batch_size=500):
+    """把旧的 JSON 文本列搬进 config_blobs，并清空旧列。在迁移事务中执行。"""
+    for table, column, legacy_column in BLOB_REFERENCES:
+        # 旧列有 NOT NULL 约束的清空为 ''，可为空的置为 NULL
+        cleared = "NULL" if table == 'subscriptions' else "''"
+        while True:
+            rows = db.execute(f'SELECT rowid, {legacy_column} FROM {table} WHERE {column} IS NULL AND {legacy_column} IS NOT NULL LIMIT ?',
+                              (batch_size,)).fetchall()
+            if not rows:
+                break
+            db.executemany(f'UPDATE {table} SET {column} = ?, {legacy_column} = {cleared} WHERE rowid = ?',
+                           [(store_blob(db, text), rowid) for rowid, text in rows])
+
+
+def blob_stats(db):
+    row = db.execute('SELECT COUNT(*), COALESCE(SUM(ref_count), 0), COALESCE(SUM(size), 0), COALESCE(SUM(LENGTH(data)), 0) FROM config_blobs').fetchone()
+    blobs, references, raw_bytes, stored_bytes = row
+    return {
+        "blobs": blobs,
+        "references": references,
+        "raw_bytes": raw_bytes,
+        "stored_bytes": stored_bytes,
+        "compression_ratio": (stored_bytes / raw_bytes) if raw_bytes else 1.0,
+    }
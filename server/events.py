@@ -0,0 +1,83 @@
+# events.py
+# 按用户分发的变更事件总线，供 /api/events 事件流 (SSE) 使用
+
+import json
+import queue
+import threading
+
+
+class EventSubscriber:
+    """一条事件流连接。每个连接有自己的队列，并记住它是用哪个会话令牌建立的。"""
+    def __init__(self, user_uuid, token, max_pending=64):
+        self.user_uuid = user_uuid
+        self.token = token
+        self.invalidated_reason = None
+        self._queue = queue.Queue(maxsize=max_pending)
+
+    def put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            # 队列满说明客户端已有同类事件未读；config_changed 之类的事件是幂等的，丢弃不影响最终一致
+            pass
+
+    def get(self, timeout):
+        """等待下一个事件，超时返回 None（调用方借此发送心跳）。"""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventHub:
+    """
+    进程内的事件总线：user_uuid -> 当前打开的事件流。
+    只在数据库提交成功之后发布事件，客户端收到事件后再回源拉取，事件本身不携带配置内容。
+    """
+    def __init__(self, max_pending=64):
+        self.max_pending = max_pending
+        self._subscribers = {}  # user_uuid -> set(EventSubscriber)
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_uuid, token):
+        subscriber = EventSubscriber(user_uuid, token, self.max_pending)
+        with self._lock:
+            self._subscribers.setdefault(user_uuid, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.user_uuid)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[subscriber.user_uuid]
+
+    def _targets(self, user_uuid):
+        with self._lock:
+            return list(self._subscribers.get(user_uuid, ()))
+
+    def publish(self, user_uuid, event_type, data=None):
+        for subscriber in self._targets(user_uuid):
+            subscriber.put((event_type, data or {}))
+
+    def publish_many(self, user_uuids, event_type, data=None):
+        for user_uuid in set(user_uuids):
+            self.publish(user_uuid, event_type, data)
+
+    def invalidate_sessions(self, user_uuid, reason, keep_token=None):
+        """通知该用户除 keep_token 以外的所有事件流：会话已失效（被其他设备登录顶掉或已退出）。"""
+        for subscriber in self._targets(user_uuid):
+            if subscriber.token == keep_token:
+                continue
+            subscriber.invalidated_reason = reason
+            subscriber.put(('session_invalidated', {"reason": reason}))
+
+    def connection_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+
+def format_sse(event_type, data):
+    """按 text/event-stream 格式编码一个事件。"""
+    return f"event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
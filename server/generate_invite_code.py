@@ -1,10 +1,11 @@
 import sqlite3
 import sys
 import os
+import csv
 import secrets
 import string
 import argparse
-from datetime import datetime
+from datetime import datetime, timedelta
 import requests
 import json
 import hashlib
@@ -15,6 +16,10 @@ APP_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATABASE = os.path.join(APP_BASE_DIR, 'users.db')
 SERVER_URL = "http://127.0.0.1:5000"
 
+STATUS_LIMIT = 50       # 查看状态时每类最多显示的条数，完整列表请用 --csv 导出
+PRINT_LIMIT = 50        # 生成的邀请码超过此数量时不再逐个打印
+SQL_BATCH_SIZE = 500    # IN (...) 查询每批的参数个数，低于旧版 SQLite 999 个变量的上限
+
 # 从服务器端复制过来的客户端识别信息，必须保持一致
 # 这些可以放到一个共享的配置文件中
 CLIENT_VERSION = ""
@@ -41,39 +46,116 @@ def generate_secure_code():
     return f"FRPT-{full_code[:4]}-{full_code[4:]}"
 
 # --- 数据库操作函数 ---
-def add_codes_to_db(db, count=1):
-    if count<=0: return
-    c=db.cursor(); g=[]
-    print("-" * 30 + "\n[操作] 生成新邀请码")
-    for _ in range(count):
-        while True:
+def find_existing_codes(db, codes):
+    """返回 codes 中已存在于数据库的邀请码，按批查询，不把整张表读入内存"""
+    codes = list(codes); existing = set()
+    for i in range(0, len(codes), SQL_BATCH_SIZE):
+        batch = codes[i:i + SQL_BATCH_SIZE]
+        placeholders = ",".join("?" * len(batch))
+        existing.update(row[0] for row in db.execute(f"SELECT code FROM invitation_codes WHERE code IN ({placeholders})", batch))
+    return existing
+
+def generate_unique_codes(db, count):
+    """生成 count 个互不重复、且数据库中不存在的邀请码。冲突先在内存集合中排除，再按批与数据库比对"""
+    codes = {}  # 用 dict 保持生成顺序
+    while len(codes) < count:
+        batch = set()
+        while len(codes) + len(batch) < count:
             new_code = generate_secure_code()
-            try: c.execute("INSERT INTO invitation_codes (code) VALUES (?)", (new_code,)); g.append(new_code); break
-            except sqlite3.IntegrityError: print("警告: 邀请码冲突，正在重新生成...")
-    if g: print(f"成功生成 {len(g)} 个新邀请码:\n" + "\n".join([f"  {x}" for x in g]))
-    else: print("未能生成新邀请码。")
-    db.commit()
-
-def display_codes_status(db):
-    c=db.cursor(); c.execute("SELECT ic.code,ic.is_used,ic.created_at,ic.used_at,u.nickname FROM invitation_codes ic LEFT JOIN users u ON ic.used_by_uuid=u.uuid ORDER BY ic.created_at DESC")
-    a=c.fetchall(); u=[r for r in a if not r[1]]; d=[r for r in a if r[1]]
-    print("-" * 30 + f"\n[状态] 邀请码总览 (总数: {len(a)})\n" + "-" * 30)
-    print(f"\n✅ 未使用 ({len(u)} 个):")
-    if not u: print("  (无)")
-    else:
-        for code, _, created_at, _, _ in u:
-            ct="时间未知";
-            if created_at: ct=datetime.fromisoformat(created_at).strftime('%Y-%m-%d %H:%M')
-            print(f"  {code:<20} (创建于: {ct})")
-    print(f"\n❌ 已使用 ({len(d)} 个):")
-    if not d: print("  (无)")
-    else:
-        for code, _, _, used_at, nickname in d:
-            ui=nickname if nickname else "未知用户"; ut="时间未知"
-            if used_at:
-                try: ut=datetime.fromisoformat(used_at).strftime('%Y-%m-%d %H:%M')
-                except (ValueError, TypeError): ut="格式错误"
-            print(f"  {code:<20} (使用者: {ui}, 使用于: {ut})")
+            if new_code not in codes: batch.add(new_code)
+        existing = find_existing_codes(db, batch)
+        if existing: print(f"警告: {len(existing)} 个邀请码与已有的冲突，正在重新生成...")
+        codes.update((c, None) for c in batch if c not in existing)
+    return list(codes)
+
+def add_codes_to_db(db, count=1, csv_path=None):
+    """批量生成邀请码：在一个事务中查重并用 executemany 一次写入，返回生成的邀请码列表"""
+    if count<=0: return []
+    print("-" * 30 + "\n[操作] 生成新邀请码")
+    # 先加写锁，查重和写入之间不会有其他进程插入同样的码
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        g = generate_unique_codes(db, count)
+        db.executemany("INSERT INTO invitation_codes (code) VALUES (?)", ((x,) for x in g))
+        db.commit()
+    except BaseException:
+        db.rollback(); raise
+    if len(g) <= PRINT_LIMIT: print(f"成功生成 {len(g)} 个新邀请码:\n" + "\n".join([f"  {x}" for x in g]))
+    else: print(f"成功生成 {len(g)} 个新邀请码（数量较多，仅显示前 {PRINT_LIMIT} 个）:\n" + "\n".join([f"  {x}" for x in g[:PRINT_LIMIT]]))
+    if csv_path:
+        rows = ((x, 0, None, None, None) for x in g)
+        write_codes_csv(csv_path, rows); print(f"已导出到 {csv_path}")
+    return g
+
+def parse_date_arg(value, end_of_day=False):
+    """把 YYYY-MM-DD 或 YYYY-MM-DD HH:MM[:SS] 转为与 created_at (UTC) 相同格式的字符串，便于直接比较。
+    只给日期时，作为截止日期表示包含当天全天"""
+    value = value.strip()
+    try:
+        parsed = datetime.strptime(value, '%Y-%m-%d')
+        if end_of_day: parsed += timedelta(days=1)
+    except ValueError:
+        parsed = datetime.fromisoformat(value)
+    return parsed.strftime('%Y-%m-%d %H:%M:%S')
+
+def build_code_filter(status=None, since=None, until=None):
+    """status 为 'used'/'unused'/None；since/until 按创建时间过滤，until 为开区间"""
+    conditions = []; params = []
+    if status == 'used': conditions.append("ic.is_used = 1")
+    elif status == 'unused': conditions.append("ic.is_used = 0")
+    if since: conditions.append("ic.created_at >= ?"); params.append(since)
+    if until: conditions.append("ic.created_at < ?"); params.append(until)
+    return (" WHERE " + " AND ".join(conditions) if conditions else ""), params
+
+def count_codes(db, since=None, until=None):
+    """返回 (总数, 未使用数, 已使用数)，由数据库汇总而不是取回所有行"""
+    where, params = build_code_filter(since=since, until=until)
+    total, used = db.execute(f"SELECT COUNT(*), COALESCE(SUM(ic.is_used), 0) FROM invitation_codes ic{where}", params).fetchone()
+    return total, total - used, used
+
+def iter_codes(db, status=None, since=None, until=None, limit=None):
+    """逐行返回 (code, is_used, created_at, used_at, nickname)，游标按需读取，适合大量邀请码"""
+    where, params = build_code_filter(status, since, until)
+    query = f"SELECT ic.code,ic.is_used,ic.created_at,ic.used_at,u.nickname FROM invitation_codes ic LEFT JOIN users u ON ic.used_by_uuid=u.uuid{where} ORDER BY ic.created_at DESC, ic.code"
+    if limit is not None: query += " LIMIT ?"; params.append(limit)
+    return db.execute(query, params)
+
+def write_codes_csv(path, rows):
+    """流式写出 CSV，'-' 表示标准输出。带 BOM 以便 Excel 正确识别中文昵称"""
+    header = ["code", "is_used", "created_at", "used_at", "used_by"]
+    if path == '-':
+        writer = csv.writer(sys.stdout); writer.writerow(header); writer.writerows(rows); return
+    with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.writer(f); writer.writerow(header); writer.writerows(rows)
+
+def export_codes_csv(db, path, status=None, since=None, until=None):
+    write_codes_csv(path, iter_codes(db, status, since, until))
+    if path != '-': print(f"已导出到 {path}")
+
+def format_time(value):
+    if not value: return "时间未知"
+    try: return datetime.fromisoformat(value).strftime('%Y-%m-%d %H:%M')
+    except (ValueError, TypeError): return "格式错误"
+
+def display_codes_status(db, status=None, since=None, until=None, limit=STATUS_LIMIT):
+    """显示邀请码总览。每类最多显示 limit 条（按创建时间从新到旧），其余的用 --csv 导出查看"""
+    total, unused_count, used_count = count_codes(db, since, until)
+    title = "邀请码总览" + (f" ({since or '...'} ~ {until or '...'})" if since or until else "")
+    print("-" * 30 + f"\n[状态] {title} (总数: {total})\n" + "-" * 30)
+    if status != 'used':
+        print(f"\n✅ 未使用 ({unused_count} 个):")
+        if not unused_count: print("  (无)")
+        for code, _, created_at, _, _ in iter_codes(db, 'unused', since, until, limit):
+            print(f"  {code:<20} (创建于: {format_time(created_at)})")
+        if unused_count > limit: print(f"  ... 还有 {unused_count - limit} 个未显示")
+    if status != 'unused':
+        print(f"\n❌ 已使用 ({used_count} 个):")
+        if not used_count: print("  (无)")
+        for code, _, _, used_at, nickname in iter_codes(db, 'used', since, until, limit):
+            print(f"  {code:<20} (使用者: {nickname if nickname else '未知用户'}, 使用于: {format_time(used_at)})")
+        if used_count > limit: print(f"  ... 还有 {used_count - limit} 个未显示")
+    shown = {'used': used_count, 'unused': unused_count}.get(status, max(unused_count, used_count))
+    if shown > limit: print("\n提示: 使用 -s --csv FILE 导出完整列表。")
     print("\n" + "-" * 30)
 
 def delete_code(db, target):
@@ -289,6 +371,11 @@ def main():
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-g', '--generate', nargs='?', type=int, const=1, default=None, metavar='COUNT', help="生成邀请码。不带数量则生成1个。")
     group.add_argument('-s', '--status', action='store_true', help="显示邀请码和用户状态。")
+    parser.add_argument('--only', choices=['used', 'unused'], help="查看状态或导出时只包含已使用/未使用的邀请码。")
+    parser.add_argument('--since', metavar='DATE', help="只包含此时间之后创建的邀请码，格式 YYYY-MM-DD 或 'YYYY-MM-DD HH:MM'（UTC）。")
+    parser.add_argument('--until', metavar='DATE', help="只包含此时间之前创建的邀请码；只给日期时包含当天。")
+    parser.add_argument('--limit', type=int, default=STATUS_LIMIT, help=f"查看状态时每类最多显示的条数（默认 {STATUS_LIMIT}）。")
+    parser.add_argument('--csv', metavar='FILE', help="与 -s 一起使用时导出完整列表；与 -g 一起使用时导出新生成的邀请码。'-' 表示输出到屏幕。")
     group.add_argument('-du', '--delete-user', metavar='TARGET', help="删除用户。TARGET可以是昵称或'all'。")
     group.add_argument('-dc', '--delete-code', metavar='TARGET', help="删除邀请码。TARGET可以是码或'all'。")
     parser.add_argument('-rp', '--reset-password', metavar='NICKNAME', help="为指定用户生成密码重置令牌。")
@@ -298,19 +385,26 @@ def main():
         if not os.path.exists(DATABASE): print(f"错误: 数据库 '{DATABASE}' 不存在。"); return
         try:
             db = sqlite3.connect(DATABASE, timeout=10); db.execute("PRAGMA foreign_keys = ON")
+            since = parse_date_arg(args.since) if args.since else None
+            until = parse_date_arg(args.until, end_of_day=True) if args.until else None
             if args.delete_user: delete_user(db, args.delete_user)
             elif args.delete_code: delete_code(db, args.delete_code)
-            elif args.status: display_codes_status(db)
-            elif args.generate is not None: add_codes_to_db(db, args.generate); display_codes_status(db)
+            elif args.status:
+                if args.csv: export_codes_csv(db, args.csv, args.only, since, until)
+                else: display_codes_status(db, args.only, since, until, args.limit)
+            elif args.generate is not None:
+                add_codes_to_db(db, args.generate, args.csv)
+                if args.generate <= PRINT_LIMIT: display_codes_status(db, limit=args.limit)
             if args.reset_password:
                 # 命令行重置密码也需要登录，并传入api_client
                 admin_token = admin_login_for_token(api_client)
                 if admin_token:
                     # 注意：命令行模式下，我们直接调用API，不需要db对象
                     request_password_reset_token(admin_token, args.reset_password)
-            else: parser.print_help()
+            elif not (args.delete_user or args.delete_code or args.status or args.generate is not None): parser.print_help()
             db.close()
         except sqlite3.Error as e: print(f"数据库操作失败: {e}")
+        except (ValueError, OSError) as e: print(f"错误: {e}")
     else:
         if not os.path.exists(DATABASE): print(f"错误: 数据库 '{DATABASE}' 不存在。"); return
         try:
@@ -0,0 +1,36 @@
+# gunicorn.conf.py
+# 在 server 目录下运行 gunicorn server:app 时会自动读取本文件。
+#
+# 每个已登录的客户端都保持一条 /api/events 事件流 (SSE) 长连接，一条连接在断开前一直占用一个工作线程。
+# 默认的 sync 工作模式每个进程只有一个线程，4 个空闲的客户端就会占满 -w 4 的全部进程，其他 API 请求全部挂起，
+# 因此必须使用多线程的 gthread 模式（或 gevent 等异步模式），并按同时在线的客户端数量设置线程数：
+#   workers * threads >= 同时在线的客户端数 + 普通请求的并发余量
+# 多进程运行时临时状态必须放在共享的 SQLite 中，否则各进程的登录挑战码、票据和限流计数互不相通，
+# 因此本文件把 MOEFRP_EPHEMERAL_BACKEND 默认设为 "sqlite"（在环境中显式设为 "memory" 时只能以单进程运行）。
+# 数据库结构的升级由下面的 on_starting 在派生工作进程之前执行一次。
+
+import os
+import subprocess
+import sys
+
+os.environ.setdefault('MOEFRP_EPHEMERAL_BACKEND', 'sqlite')
+
+workers = 4
+worker_class = 'gthread'
+threads = 64              # 每个进程的线程数，4 个进程合计约 250 条事件流 + 普通请求
+bind = '127.0.0.1:5000'   # 放在反向代理后面；代理对 /api/events 的读超时需大于心跳间隔 (EVENT_HEARTBEAT_SECONDS)
+
+
+def on_starting(server):
+    """
+    主进程启动时、派生工作进程之前检查临时状态后端，并升级数据库结构（与直接运行 server.py 时的 init_db() 相同）。
+    迁移放在一个临时子进程中执行：主进程自己导入 server.py 的话，日志线程和数据库连接会随 fork 带进每个工作进程。
+    迁移失败时抛出异常，gunicorn 随之退出，不会带着旧的表结构开始服务。
+    """
+    backend = os.environ['MOEFRP_EPHEMERAL_BACKEND']
+    if server.cfg.workers > 1 and backend != 'sqlite':
+        raise RuntimeError(f"MOEFRP_EPHEMERAL_BACKEND={backend!r} 时各工作进程的临时状态互不相通，"
+                           f"以 {server.cfg.workers} 个进程运行需设为 'sqlite'（或改用 -w 1）")
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    server.log.info("Migrating database schema before forking workers")
+    subprocess.run([sys.executable, '-c', f"import sys; sys.path.insert(0, {app_dir!r}); import server; server.init_db()"], check=True)
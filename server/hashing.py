@@ -0,0 +1,171 @@
+# hashing.py
+# 把 Argon2 密码哈希放到独立的进程池中执行，并对排队深度做准入控制
+
+import math
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError
+
+# --- 子进程部分 ---
+# 这些函数在工作进程中执行，必须定义在模块顶层，且本模块不能导入 server.py（Windows 下子进程会重新导入本模块）
+_worker_hasher = None
+
+def _init_worker(hasher_params):
+    global _worker_hasher
+    _worker_hasher = PasswordHasher(**hasher_params)
+
+def _worker_hash(password):
+    started_at = time.time()
+    result = _worker_hasher.hash(password)
+    return result, started_at, time.time() - started_at
+
+def _worker_verify(password_hash, password):
+    started_at = time.time()
+    try:
+        matched = _worker_hasher.verify(password_hash, password)
+    except VerifyMismatchError:
+        matched = False
+    return matched, started_at, time.time() - started_at
+
+
+class HashingBusyError(Exception):
+    """
+    哈希暂时无法完成，调用方应返回 503 并让客户端稍后重试。
+    reason: "saturated"（进程池已满）、"timeout"（等待结果超时）或 "broken"（工作进程异常退出，进程池已重建）。
+    """
+    def __init__(self, retry_after, reason="saturated"):
+        super().__init__(f"Password hashing unavailable ({reason}), retry after {retry_after}s")
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class PasswordHashingPool:
+    """
+    Argon2 哈希进程池。
+    工作进程数取 CPU核数/并行度 与 内存预算/单次哈希内存 中较小者，
+    正在执行和排队的任务总数超过上限时直接拒绝，而不是让请求线程无限堆积。
+    """
+    def __init__(self, hasher_params, memory_budget_mb=512, max_queue=32, timeout=30, observer=None):
+        self.hasher_params = dict(hasher_params)
+        # 每完成一次哈希调用 observer(排队秒数, 计算秒数)，供指标统计使用
+        self.observer = observer
+        parallelism = self.hasher_params.get('parallelism', 1)
+        memory_cost_kib = self.hasher_params.get('memory_cost', 64 * 1024)
+        by_cpu = max(1, (os.cpu_count() or 1) // parallelism)
+        by_memory = max(1, (memory_budget_mb * 1024) // memory_cost_kib)
+        self.max_workers = min(by_cpu, by_memory)
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.max_workers + max_queue)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        # 本地实例只用于 check_needs_rehash 这类不做哈希计算的操作
+        self.local_hasher = PasswordHasher(**self.hasher_params)
+
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "completed": 0,
+            "rejected": 0,
+            "timed_out": 0,
+            "pool_restarts": 0,
+            "in_flight": 0,
+            "queue_wait_seconds_total": 0.0,
+            "hash_seconds_total": 0.0,
+            "queue_wait_seconds_max": 0.0,
+            "hash_seconds_max": 0.0,
+        }
+
+    def _get_executor(self):
+        # 延迟到第一次使用时再创建进程池，避免导入模块时就派生子进程
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.max_workers,
+                        initializer=_init_worker,
+                        initargs=(self.hasher_params,)
+                    )
+        return self._executor
+
+    def _discard_executor(self, executor):
+        with self._executor_lock:
+            if self._executor is not executor: return # 其他线程已经重建过
+            self._executor = None
+            with self._stats_lock:
+                self._stats["pool_restarts"] += 1
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._stats_lock:
+                self._stats["rejected"] += 1
+            raise HashingBusyError(self.estimate_retry_after())
+        with self._stats_lock:
+            self._stats["in_flight"] += 1
+        submitted_at = time.time()
+        executor = self._get_executor()
+        try:
+            future = executor.submit(fn, *args)
+            result, started_at, hash_seconds = future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel() # 尚未开始时从队列中移除；已经开始的哈希无法中断，结果被丢弃
+            with self._stats_lock:
+                self._stats["timed_out"] += 1
+            raise HashingBusyError(self.estimate_retry_after(), "timeout")
+        except BrokenProcessPool:
+            # 有工作进程异常退出（例如被 OOM 终止）后，整个进程池不再可用，丢弃它，下次使用时重新创建
+            self._discard_executor(executor)
+            raise HashingBusyError(1, "broken")
+        finally:
+            with self._stats_lock:
+                self._stats["in_flight"] -= 1
+            self._slots.release()
+        queue_wait = max(0.0, started_at - submitted_at)
+        with self._stats_lock:
+            self._stats["completed"] += 1
+            self._stats["queue_wait_seconds_total"] += queue_wait
+            self._stats["hash_seconds_total"] += hash_seconds
+            self._stats["queue_wait_seconds_max"] = max(self._stats["queue_wait_seconds_max"], queue_wait)
+            self._stats["hash_seconds_max"] = max(self._stats["hash_seconds_max"], hash_seconds)
+        if self.observer is not None:
+            self.observer(queue_wait, hash_seconds)
+        return result
+
+    def hash(self, password):
+        return self._submit(_worker_hash, password)
+
+    def verify(self, password_hash, password):
+        """与 PasswordHasher.verify 行为一致：密码不匹配时抛出 VerifyMismatchError。"""
+        if not self._submit(_worker_verify, password_hash, password):
+            raise VerifyMismatchError()
+        return True
+
+    def check_needs_rehash(self, password_hash):
+        return self.local_hasher.check_needs_rehash(password_hash)
+
+    def estimate_retry_after(self):
+        """按平均哈希耗时估算当前队列排空所需的秒数，用于 Retry-After 响应头。"""
+        with self._stats_lock:
+            completed = self._stats["completed"]
+            avg_hash = self._stats["hash_seconds_total"] / completed if completed else 1.0
+            in_flight = self._stats["in_flight"]
+        return max(1, math.ceil(avg_hash * in_flight / self.max_workers))
+
+    def stats(self):
+        with self._stats_lock:
+            snapshot = dict(self._stats)
+        completed = snapshot["completed"]
+        snapshot["max_workers"] = self.max_workers
+        snapshot["max_queue"] = self.max_queue
+        snapshot["queue_wait_seconds_avg"] = snapshot["queue_wait_seconds_total"] / completed if completed else 0.0
+        snapshot["hash_seconds_avg"] = snapshot["hash_seconds_total"] / completed if completed else 0.0
+        return snapshot
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,166 @@
+# logs.py
+# 非阻塞的日志管线：请求线程只把日志记录放进队列，由后台监听线程写文件；
+# 日志文件按大小和时间轮转，轮转出的旧文件由另一个后台线程压缩为 .gz
+
+import datetime
+import gzip
+import json
+import logging
+import os
+import queue
+import re
+import shutil
+import sys
+import threading
+import time
+from logging.handlers import BaseRotatingHandler, QueueHandler, QueueListener
+
+
+class TextLogFormatter(logging.Formatter):
+    """原来的文本格式。记录带有英文说明 (message_en) 时追加在同一行，不再单独写一行英文日志。"""
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s: %(message)s [IP: %(remote_addr)s]')
+
+    def formatMessage(self, record):
+        line = super().formatMessage(record)
+        message_en = getattr(record, 'message_en', None)
+        return f"{line} | {message_en}" if message_en else line
+
+
+class JsonLogFormatter(logging.Formatter):
+    """每个事件输出一行 JSON，便于日志采集工具直接解析。"""
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "remote_addr": getattr(record, 'remote_addr', '-'),
+        }
+        message_en = getattr(record, 'message_en', None)
+        if message_en:
+            entry["message_en"] = message_en
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    队列满时丢弃日志并计数，而不是阻塞请求线程或向 stderr 打印异常。
+    只有磁盘长时间卡住、监听线程跟不上时才会发生。
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # 在请求线程上把参数合并进消息、把异常堆栈转成文本，避免跨线程引用请求里的可变对象；
+        # 时间、级别等字段原样保留，由文件端的格式化器决定输出文本还是 JSON
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class CompressingRotatingFileHandler(BaseRotatingHandler):
+    """
+    文件超过 max_bytes 或距上次轮转超过 interval_seconds 时轮转。
+    旧文件改名为 <文件名>.<时间戳> 后交给后台线程压缩为 .gz，只保留最近 backup_count 个。
+    """
+    def __init__(self, filename, max_bytes, interval_seconds, backup_count, encoding='utf-8'):
+        super().__init__(filename, 'a', encoding=encoding)
+        self.max_bytes = max_bytes
+        self.interval_seconds = interval_seconds
+        self.backup_count = backup_count
+        self.rollover_at = time.time() + interval_seconds
+        self._rotated_pattern = re.compile(re.escape(os.path.basename(self.baseFilename)) + r'\.(\d{8}-\d{6})(?:-(\d+))?$')
+        self._compress_queue = queue.Queue()
+        self._compressor = threading.Thread(target=self._compress_loop, name="log-compressor", daemon=True)
+        self._compressor.start()
+        # 上次运行中没来得及压缩的旧文件
+        for name in self._rotated_files(compressed=False):
+            self._compress_queue.put(name)
+
+    def shouldRollover(self, record):
+        if self.stream is None:
+            self.stream = self._open()
+        if self.interval_seconds and time.time() >= self.rollover_at:
+            return True
+        if self.max_bytes:
+            self.stream.seek(0, 2)
+            return self.stream.tell() >= self.max_bytes
+        return False
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        rotated = f"{self.baseFilename}.{stamp}"
+        suffix = 1
+        while os.path.exists(rotated) or os.path.exists(rotated + '.gz'):
+            rotated = f"{self.baseFilename}.{stamp}-{suffix}"
+            suffix += 1
+        if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+            os.replace(self.baseFilename, rotated)
+            self._compress_queue.put(rotated)
+        self.stream = self._open()
+        self.rollover_at = time.time() + self.interval_seconds
+
+    def _rotated_files(self, compressed):
+        directory = os.path.dirname(self.baseFilename)
+        rotated = []
+        for name in os.listdir(directory):
+            base = name[:-3] if name.endswith('.gz') else name
+            match = self._rotated_pattern.match(base)
+            if name.endswith('.gz') == compressed and match:
+                # 按 (时间戳, 同一秒内的序号) 排序，从旧到新
+                rotated.append(((match.group(1), int(match.group(2) or 0)), os.path.join(directory, name)))
+        return [path for _, path in sorted(rotated)]
+
+    def _compress_loop(self):
+        while True:
+            path = self._compress_queue.get()
+            try:
+                with open(path, 'rb') as source, gzip.open(path + '.gz', 'wb') as target:
+                    shutil.copyfileobj(source, target)
+                os.remove(path)
+                if self.backup_count:
+                    for old in self._rotated_files(compressed=True)[:-self.backup_count]:
+                        os.remove(old)
+            except OSError as e:
+                # 压缩失败时保留未压缩的文件，下次启动时会再次尝试
+                print(f"压缩日志文件 {path} 失败: {e}", file=sys.stderr)
+            finally:
+                self._compress_queue.task_done()
+
+    def wait_for_compression(self):
+        """等待已轮转的文件全部压缩完毕（进程退出前调用）"""
+        self._compress_queue.join()
+
+
+def start_queued_logging(logger, file_handler, filters=(), max_queue=10000):
+    """
+    给 logger 挂上队列处理器并启动后台监听线程，返回 (queue_handler, listener)。
+    filters 在请求线程上执行（如注入请求IP），其余格式化和写盘都在监听线程中完成。
+    """
+    log_queue = queue.Queue(maxsize=max_queue)
+    queue_handler = DroppingQueueHandler(log_queue)
+    for log_filter in filters:
+        queue_handler.addFilter(log_filter)
+    listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    logger.addHandler(queue_handler)
+    return queue_handler, listener
@@ -0,0 +1,217 @@
+# maintenance.py
+# 后台维护调度器：在一个守护线程中按各自的间隔（带随机抖动）依次执行维护任务，
+# 例如清理过期的令牌和会话、更新查询规划统计、WAL 检查点和增量 VACUUM。
+# 每个任务有时间预算：批量任务在批次之间检查截止时间，单条耗时语句由 SQLite 的进度回调在超时时中断。
+# 写操作都拆成小批次的短事务，不会长时间占用写锁，请求线程最多等待一个批次。
+
+import heapq
+import logging
+import random
+import sqlite3
+import threading
+import time
+
+PROGRESS_HANDLER_STEPS = 10000  # 每执行这么多条虚拟机指令检查一次是否超出预算
+
+
+class MaintenanceBudgetExceeded(Exception):
+    """任务用完了时间预算，剩余的工作留到下一次执行。"""
+
+
+class MaintenanceJob:
+    def __init__(self, name, func, interval_seconds, budget_seconds, uses_db=True):
+        self.name = name
+        self.func = func
+        self.interval_seconds = interval_seconds
+        self.budget_seconds = budget_seconds
+        self.uses_db = uses_db
+        self.runs = 0
+        self.last_duration = None
+        self.last_outcome = None
+
+
+class MaintenanceContext:
+    """传给任务函数的参数：数据库连接（不使用数据库的任务为 None）和本次执行的截止时间。"""
+    def __init__(self, db, deadline):
+        self.db = db
+        self.deadline = deadline
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+    def check_budget(self):
+        if time.monotonic() >= self.deadline:
+            raise MaintenanceBudgetExceeded()
+
+
+class MaintenanceScheduler:
+    """
+    维护任务调度器。任务函数接收 MaintenanceContext，返回本次处理的条目数（可为 None）。
+    observer(任务名, 耗时秒数, 结果, 条目数) 在每次执行后调用，结果为 ok / budget_exceeded / error。
+    每个进程各自运行一份；任务都是幂等的，多进程部署时重复执行只是多做一次无用功。
+    """
+    def __init__(self, pool, jitter=0.1, observer=None, logger=None):
+        self.pool = pool
+        self.jitter = jitter
+        self.observer = observer
+        self.logger = logger or logging.getLogger(__name__)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, name, func, interval_seconds, budget_seconds=5.0, uses_db=True):
+        """登记一个任务。interval_seconds 为 0 或 None 时不启用。"""
+        if not interval_seconds:
+            return None
+        job = MaintenanceJob(name, func, interval_seconds, budget_seconds, uses_db)
+        self._jobs[name] = job
+        return job
+
+    def start(self):
+        """启动调度线程，可重复调用。首次调用时才启动，这样无论直接运行还是由 WSGI 服务器加载都能工作。"""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="maintenance", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join(timeout)
+
+    def _next_delay(self, interval):
+        # 随机抖动，避免多个工作进程或多个任务总在同一时刻一起执行
+        return interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def _run(self):
+        now = time.monotonic()
+        # 首次执行也加上抖动后的一个完整间隔，不与启动时的迁移和预热抢资源
+        schedule = [(now + self._next_delay(job.interval_seconds), name) for name, job in self._jobs.items()]
+        heapq.heapify(schedule)
+        while schedule:
+            due, name = schedule[0]
+            if self._stop.wait(max(0.0, due - time.monotonic())):
+                return
+            heapq.heappop(schedule)
+            job = self._jobs[name]
+            self.run_job(job)
+            heapq.heappush(schedule, (time.monotonic() + self._next_delay(job.interval_seconds), name))
+
+    def run_now(self, name):
+        """立即执行一个任务（在调用方线程中），返回 (结果, 条目数)。"""
+        return self.run_job(self._jobs[name])
+
+    def run_job(self, job):
+        started = time.monotonic()
+        context = MaintenanceContext(None, started + job.budget_seconds)
+        items = None
+        db = self.pool.acquire() if job.uses_db else None
+        try:
+            if db is not None:
+                context.db = db
+                # 超出预算时中断正在执行的语句（ANALYZE 等），SQLite 会回滚该语句并抛出 OperationalError
+                db.set_progress_handler(lambda: time.monotonic() >= context.deadline, PROGRESS_HANDLER_STEPS)
+            items = job.func(context)
+            outcome = 'ok'
+        except MaintenanceBudgetExceeded:
+            outcome = 'budget_exceeded'
+        except sqlite3.OperationalError as e:
+            if 'interrupted' in str(e) and time.monotonic() >= context.deadline:
+                outcome = 'budget_exceeded'
+            else:
+                outcome = 'error'
+                self.logger.error(f"维护任务 {job.name} 失败: {e}", exc_info=True)
+        except Exception as e:
+            outcome = 'error'
+            self.logger.error(f"维护任务 {job.name} 失败: {e}", exc_info=True)
+        finally:
+            if db is not None:
+                db.set_progress_handler(None, 0)
+                self.pool.release(db)
+        duration = time.monotonic() - started
+        job.runs += 1
+        job.last_duration = duration
+        job.last_outcome = outcome
+        if outcome == 'budget_exceeded':
+            self.logger.warning(f"维护任务 {job.name} 超出时间预算 ({job.budget_seconds}s)，剩余工作留到下次执行。")
+        if self.observer is not None:
+            self.observer(job.name, duration, outcome, items or 0)
+        return outcome, items
+
+    def stats(self):
+        return {name: {"interval_seconds": job.interval_seconds, "budget_seconds": job.budget_seconds, "runs": job.runs,
+                       "last_duration": job.last_duration, "last_outcome": job.last_outcome}
+                for name, job in self._jobs.items()}
+
+
+# --- 通用的 SQLite 维护任务 ---
+
+def delete_in_batches(context, select_sql, delete_sql, params=(), batch_size=500):
+    """
+    分批删除或更新过期的行，返回处理的行数。
+    select_sql 返回候选行的 rowid（不加写锁）；delete_sql 以 rowid 为最后一个参数，应再次带上过期条件，
+    避免误删在两次语句之间被续期或改写的行。每批一个短事务，批次之间检查预算。
+    """
+    db = context.db
+    total = 0
+    while True:
+        context.check_budget()
+        rowids = [row[0] for row in db.execute(select_sql, (*params, batch_size))]
+        if not rowids:
+            return total
+        db.executemany(delete_sql, [(*params, rowid) for rowid in rowids])
+        db.commit()
+        total += len(rowids)
+        if len(rowids) < batch_size:
+            return total
+
+
+def wal_checkpoint(context):
+    """PASSIVE 检查点不等待读者也不阻塞写者，只把当前能搬的页写回主库，防止 WAL 文件无限增长。"""
+    busy, log_frames, checkpointed = context.db.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+    return max(checkpointed, 0)
+
+
+def optimize(context, analysis_limit=400):
+    """PRAGMA optimize 只对统计信息过时的表重新 ANALYZE；analysis_limit 限制每个索引的采样行数。"""
+    context.db.execute(f"PRAGMA analysis_limit = {int(analysis_limit)}")
+    context.db.execute("PRAGMA optimize")
+
+
+def analyze(context, analysis_limit=1000):
+    """重新收集全部表和索引的统计信息。采样上限让大表上的耗时也保持在毫秒级，仍受时间预算约束。"""
+    context.db.execute(f"PRAGMA analysis_limit = {int(analysis_limit)}")
+    context.db.execute("ANALYZE")
+    context.db.commit()
+
+
+class IncrementalVacuum:
+    """
+    每次释放一部分空闲页，直到没有空闲页或用完预算。
+    需要数据库以 auto_vacuum = INCREMENTAL 创建；旧库需离线执行一次 VACUUM 才能转换，未转换时跳过并提示一次。
+    """
+    def __init__(self, pages_per_step=256, logger=None):
+        self.pages_per_step = pages_per_step
+        self.logger = logger or logging.getLogger(__name__)
+        self._warned = False
+
+    def __call__(self, context):
+        db = context.db
+        if db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            if not self._warned:
+                self._warned = True
+                self.logger.info("数据库未启用增量 VACUUM，跳过空间回收。如需启用，请在停机时执行 "
+                                 "PRAGMA auto_vacuum = INCREMENTAL; VACUUM;")
+            return 0
+        initial = free_pages = db.execute("PRAGMA freelist_count").fetchone()[0]
+        while free_pages:
+            context.check_budget()
+            # execute() 只单步执行一次，每次只释放一页；executescript 会把语句执行完
+            db.executescript(f"PRAGMA incremental_vacuum({int(self.pages_per_step)})")
+            free_pages = db.execute("PRAGMA freelist_count").fetchone()[0]
+        return initial - free_pages
@@ -0,0 +1,166 @@
+# negotiation.py
+# 按请求头协商的传输压缩和编码：
+#   - 请求体：Content-Encoding 为 gzip/deflate 时在 WSGI 层解压，视图函数无需改动
+#   - 响应体：客户端的 Accept-Encoding 含 gzip/deflate 且响应足够大时压缩
+#   - 编码：Accept 中 application/msgpack 优先时，jsonify 直接输出 MessagePack；请求体也可以是 MessagePack
+# 响应头 Accept-Encoding (RFC 7694) 告诉客户端本服务器接受压缩的请求体，旧服务器不会发送它，客户端据此决定是否压缩上传。
+
+import io
+import json
+import zlib
+
+from flask import has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+from flask.wrappers import Request
+from werkzeug.http import HTTP_STATUS_CODES
+
+try:
+    import msgpack
+except ImportError:  # 未安装时只提供 JSON
+    msgpack = None
+
+MSGPACK_MIMETYPE = 'application/msgpack'
+SUPPORTED_ENCODINGS = ('gzip', 'deflate')
+COMPRESSIBLE_MIMETYPES = {'application/json', MSGPACK_MIMETYPE, 'text/plain', 'text/html'}
+
+
+class BodyDecodingError(Exception):
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+def _decompress(compressed, encoding, max_size):
+    """解压请求体，解压后超过 max_size 时拒绝（防止压缩炸弹）。"""
+    if encoding == 'gzip':
+        candidates = [zlib.MAX_WBITS | 16]
+    else:
+        # deflate 按规范是 zlib 格式，但不少客户端发送的是裸 deflate 数据
+        candidates = [zlib.MAX_WBITS, -zlib.MAX_WBITS]
+    for wbits in candidates:
+        decompressor = zlib.decompressobj(wbits)
+        try:
+            body = decompressor.decompress(compressed, max_size + 1)
+        except zlib.error:
+            continue
+        if len(body) > max_size or decompressor.unconsumed_tail:
+            raise BodyDecodingError("请求体解压后过大", 413)
+        if not decompressor.eof:
+            raise BodyDecodingError("请求体压缩数据不完整", 400)
+        return body
+    raise BodyDecodingError("请求体压缩数据无法解析", 400)
+
+
+class RequestDecompressionMiddleware:
+    """WSGI 中间件：解压带 Content-Encoding 的请求体，并把请求还原成普通的未压缩请求交给应用。"""
+    def __init__(self, app, max_size):
+        self.app = app
+        self.max_size = max_size
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if encoding and encoding != 'identity':
+            try:
+                if encoding not in SUPPORTED_ENCODINGS:
+                    raise BodyDecodingError(f"不支持的请求体编码: {encoding}", 415)
+                try:
+                    length = int(environ.get('CONTENT_LENGTH') or 0)
+                except ValueError:
+                    raise BodyDecodingError("Content-Length 格式不正确", 400)
+                if length > self.max_size:
+                    raise BodyDecodingError("请求体过大", 413)
+                body = _decompress(environ['wsgi.input'].read(length), encoding, self.max_size)
+            except BodyDecodingError as e:
+                # 此时还没有进入 Flask，按接口统一的 {"error": ...} 格式直接返回
+                payload = json.dumps({"error": str(e)}, ensure_ascii=False).encode('utf-8')
+                start_response(f"{e.status} {HTTP_STATUS_CODES[e.status]}",
+                               [('Content-Type', 'application/json'), ('Content-Length', str(len(payload)))])
+                return [payload]
+            environ['wsgi.input'] = io.BytesIO(body)
+            environ['CONTENT_LENGTH'] = str(len(body))
+            del environ['HTTP_CONTENT_ENCODING']
+        return self.app(environ, start_response)
+
+
+def _reject_ext(code, data):
+    raise ValueError(f"MessagePack 扩展类型 {code} 无法转换为 JSON")
+
+
+def _check_json_compatible(data):
+    """
+    MessagePack 还能表示 bin（bytes）、扩展类型和非字符串的键，JSON 里都没有对应的类型。
+    这些值会一路传到保存时的 json.dumps 才报错，因此在解码后就拒绝，按请求体格式错误处理。
+    """
+    stack = [data]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            for key in value:
+                if not isinstance(key, str):
+                    raise ValueError("MessagePack 对象的键必须是字符串")
+            stack.extend(value.values())
+        elif isinstance(value, list):
+            stack.extend(value)
+        elif value is not None and not isinstance(value, (str, bool, int, float)):
+            raise ValueError(f"MessagePack 中的 {type(value).__name__} 无法转换为 JSON")
+
+
+class NegotiatingRequest(Request):
+    """get_json() 同时接受 JSON 和 MessagePack 请求体，视图函数无需区分。"""
+    def get_json(self, force=False, silent=False, cache=True):
+        if msgpack is None or self.mimetype != MSGPACK_MIMETYPE:
+            return super().get_json(force=force, silent=silent, cache=cache)
+        cached = self.__dict__.get('_cached_msgpack')
+        if cache and cached is not None:
+            return cached
+        try:
+            data = msgpack.unpackb(self.get_data(cache=cache), raw=False, ext_hook=_reject_ext)
+            _check_json_compatible(data)
+        except (ValueError, msgpack.UnpackException) as e:
+            if silent:
+                return None
+            # 与 JSON 解析失败一样返回 400
+            return self.on_json_loading_failed(e)
+        if cache:
+            self._cached_msgpack = data
+        return data
+
+
+def prefers_msgpack():
+    if msgpack is None or not has_request_context():
+        return False
+    return request.accept_mimetypes.best_match(['application/json', MSGPACK_MIMETYPE]) == MSGPACK_MIMETYPE
+
+
+class NegotiatingJSONProvider(DefaultJSONProvider):
+    """jsonify() 按 Accept 头输出 JSON 或 MessagePack，序列化规则（日期等）与 JSON 相同。"""
+    def response(self, *args, **kwargs):
+        if not prefers_msgpack():
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(msgpack.packb(obj, default=self.default, use_bin_type=True), mimetype=MSGPACK_MIMETYPE)
+
+
+def compress_response(response, min_size, level):
+    """after_request 中调用：按 Accept-Encoding 压缩响应体。流式响应（事件流）、已编码或过小的响应保持原样。"""
+    response.headers['Accept-Encoding'] = ', '.join(SUPPORTED_ENCODINGS)
+    if response.mimetype in ('application/json', MSGPACK_MIMETYPE):
+        response.vary.add('Accept')
+    if (response.direct_passthrough or response.is_streamed or response.status_code < 200
+            or response.status_code in (204, 304) or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(SUPPORTED_ENCODINGS)
+    if encoding is None or request.accept_encodings[encoding] == 0:
+        return response
+    body = response.get_data()
+    if len(body) < min_size:
+        return response
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    else:
+        compressor = zlib.compressobj(level)
+    response.set_data(compressor.compress(body) + compressor.flush())
+    response.headers['Content-Encoding'] = encoding
+    return response
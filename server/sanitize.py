@@ -0,0 +1,213 @@
+# sanitize.py
+# 配置文档的校验与清洗：由下面的结构描述在导入时编译成一组嵌套的闭包，
+# 每次保存只遍历一遍文档，同时完成类型、长度、数组大小检查和 HTML 清洗。
+# 只含安全字符的字符串（绝大多数备注和规则名）直接通过，不再经过 bleach 的 HTML 解析器。
+
+import json
+import re
+
+import bleach
+
+MAX_CONFIG_JSON_LENGTH = 256 * 1024  # 单个 config_json 的最大长度，超出时不解析直接拒绝
+MAX_STRING_LENGTH = 1024    # 未单独声明的字符串字段的最大长度
+MAX_OBJECT_KEYS = 64        # 单个对象的最大键数
+MAX_LIST_ITEMS = 256        # 未单独声明的数组的最大长度
+MAX_DEPTH = 8               # 未声明字段的最大嵌套深度
+MAX_NODES = 256
+MAX_PROXIES = 512
+NAME_LENGTH = 50            # 备注、规则名、配置名清洗后截断到的长度（与原来一致）
+
+# bleach.clean 原样返回的字符：不含 < > &、控制字符、代理项和 Unicode 非字符
+_SAFE_TEXT = re.compile(r'[^<>&\x00-\x1f\x7f-\x9f\ud800-\udfff\ufdd0-\ufdef\ufffe\uffff]*').fullmatch
+
+
+class ConfigValidationError(Exception):
+    """配置文档不符合结构要求，调用方应返回 400。path 指出出错的位置，如 nodes[3].remark。"""
+    def __init__(self, message, path=''):
+        super().__init__(message)
+        self.message = message
+        self.path = path
+
+    def prepend(self, segment):
+        # 出错时才逐层拼接路径，正常路径上没有额外开销
+        if not self.path:
+            self.path = segment
+        elif self.path.startswith('['):
+            self.path = segment + self.path
+        else:
+            self.path = f"{segment}.{self.path}"
+        return self
+
+    def __str__(self):
+        return f"{self.path}: {self.message}" if self.path else self.message
+
+
+def sanitize_text(value, max_length=None):
+    """清洗一段纯文本。只含安全字符时跳过 bleach；max_length 为清洗后截断的长度。"""
+    if not isinstance(value, str):
+        raise ConfigValidationError("应为字符串")
+    cleaned = value if _SAFE_TEXT(value) else bleach.clean(value)
+    return cleaned[:max_length] if max_length else cleaned
+
+
+# --- 结构描述的编译 ---
+# 每个编译结果都是 validate(value) -> (新值, 是否有改动)。
+# 对象和数组原地修改，改动标记用于在整个文档都没变时跳过重新序列化。
+
+def text(max_length=MAX_STRING_LENGTH, sanitize=False):
+    """字符串字段。sanitize=True 时做 HTML 清洗并截断到 max_length；否则超长直接报错。"""
+    if sanitize:
+        def validate(value):
+            cleaned = sanitize_text(value, max_length)
+            return cleaned, cleaned != value
+    else:
+        def validate(value):
+            if not isinstance(value, str):
+                raise ConfigValidationError("应为字符串")
+            if len(value) > max_length:
+                raise ConfigValidationError(f"长度不能超过 {max_length}")
+            return value, False
+    return validate
+
+
+def port():
+    """端口号。客户端的表格里端口是字符串，因此整数和不超过 16 个字符的字符串都接受。"""
+    def validate(value):
+        if value is None or (isinstance(value, int) and not isinstance(value, bool)):
+            return value, False
+        if isinstance(value, str) and len(value) <= 16:
+            return value, False
+        raise ConfigValidationError("端口格式不正确")
+    return validate
+
+
+def any_value(depth=MAX_DEPTH):
+    """未声明的字段原样保留，只检查长度、数量和嵌套深度。"""
+    def validate(value, level=0):
+        if isinstance(value, str):
+            if len(value) > MAX_STRING_LENGTH:
+                raise ConfigValidationError(f"长度不能超过 {MAX_STRING_LENGTH}")
+        elif isinstance(value, (dict, list)):
+            if level >= depth:
+                raise ConfigValidationError("嵌套层数过多")
+            if len(value) > (MAX_OBJECT_KEYS if isinstance(value, dict) else MAX_LIST_ITEMS):
+                raise ConfigValidationError("元素过多")
+            items = value.items() if isinstance(value, dict) else enumerate(value)
+            for key, item in items:
+                try:
+                    validate(item, level + 1)
+                except ConfigValidationError as e:
+                    raise e.prepend(f"[{key}]" if isinstance(value, list) else str(key))
+        return value, False
+    return validate
+
+
+def list_of(item_validator, max_items):
+    def validate(value):
+        if not isinstance(value, list):
+            raise ConfigValidationError("应为数组")
+        if len(value) > max_items:
+            raise ConfigValidationError(f"最多允许 {max_items} 项")
+        changed = False
+        for index, item in enumerate(value):
+            try:
+                cleaned, item_changed = item_validator(item)
+            except ConfigValidationError as e:
+                raise e.prepend(f"[{index}]")
+            if item_changed:
+                value[index] = cleaned
+                changed = True
+        return value, changed
+    return validate
+
+
+def record(fields, extra=any_value()):
+    """对象。fields 中声明的字段按各自的规则处理，其余字段交给 extra。"""
+    def validate(value):
+        if not isinstance(value, dict):
+            raise ConfigValidationError("应为对象")
+        if len(value) > MAX_OBJECT_KEYS:
+            raise ConfigValidationError("字段过多")
+        changed = False
+        for key, item in value.items():
+            try:
+                cleaned, item_changed = fields.get(key, extra)(item)
+            except ConfigValidationError as e:
+                raise e.prepend(str(key))
+            if item_changed:
+                value[key] = cleaned
+                changed = True
+        return value, changed
+    return validate
+
+
+# --- 配置文档的结构 ---
+# 同时兼容客户端保存的下划线键名和完整分享使用的 frpc 驼峰键名
+PROXY = record({
+    'name': text(NAME_LENGTH, sanitize=True),
+    'type': text(16),
+    'local_ip': text(255), 'localIP': text(255),
+    'local_port': port(), 'localPort': port(),
+    'remote_port': port(), 'remotePort': port(),
+})
+NODE = record({
+    'remark': text(NAME_LENGTH, sanitize=True),
+    'server_addr': text(255),
+    'server_port': port(),
+    'token': text(MAX_STRING_LENGTH),
+})
+PROXIES = list_of(PROXY, MAX_PROXIES)
+# 个人配置和分享的 config_data：模板/多节点配置用 nodes，完整分享用 serverAddr/serverPort/auth
+CONFIG_DOCUMENT = record({
+    'nodes': list_of(NODE, MAX_NODES),
+    'proxies': PROXIES,
+    'serverAddr': text(255), 'server_addr': text(255),
+    'serverPort': port(), 'server_port': port(),
+})
+# 订阅的 user_params
+USER_PARAMS = record({
+    'node_remark': text(MAX_STRING_LENGTH),
+    'proxies': PROXIES,
+})
+
+
+def sanitize_config_document(document):
+    """校验并原地清洗一个已解析的配置文档，返回它本身。"""
+    return CONFIG_DOCUMENT(document)[0]
+
+
+def sanitize_user_params(user_params):
+    """校验并原地清洗订阅的 user_params，返回它本身。"""
+    return USER_PARAMS(user_params)[0]
+
+
+def sanitize_personal_config(config):
+    """清洗客户端上传的单个个人配置（原地修改并返回）。"""
+    if 'profile_name' in config:
+        try:
+            config['profile_name'] = sanitize_text(config['profile_name'], NAME_LENGTH)
+        except ConfigValidationError as e:
+            raise e.prepend('profile_name')
+    if 'config_json' in config:
+        config['config_json'] = sanitize_config_json(config['config_json'])
+    return config
+
+
+def sanitize_config_json(config_json):
+    """
+    校验并清洗序列化后的配置文档，返回要写入数据库的字符串。
+    无法解析的 JSON 与原来一样替换为 '{}'；清洗后没有任何改动时原样返回，省去重新序列化。
+    """
+    if not isinstance(config_json, str):
+        raise ConfigValidationError("应为字符串", 'config_json')
+    if len(config_json) > MAX_CONFIG_JSON_LENGTH:
+        raise ConfigValidationError(f"长度不能超过 {MAX_CONFIG_JSON_LENGTH}", 'config_json')
+    try:
+        document = json.loads(config_json)
+    except json.JSONDecodeError:
+        return '{}'
+    try:
+        document, changed = CONFIG_DOCUMENT(document)
+    except ConfigValidationError as e:
+        raise e.prepend('config_json')
+    return json.dumps(document) if changed else config_json
@@ -0,0 +1,83 @@
+# sanitize_benchmark.py
+# 比较配置保存时的校验清洗开销：原来逐字段调用 bleach 的实现 与 sanitize.py 中编译后的结构校验。
+# 只测 CPU，不涉及数据库和网络。
+#
+# 用法示例：
+#   python sanitize_benchmark.py                       # 默认 8 个节点、20 条代理规则
+#   python sanitize_benchmark.py --nodes 32 --proxies 100 --iterations 2000
+
+import argparse
+import copy
+import json
+import random
+import time
+
+import bleach
+
+from benchmark import make_nodes, make_proxies
+from sanitize import sanitize_personal_config
+
+
+# --- 原来的实现（保留在这里作为比较基准） ---
+def legacy_clean_proxies(proxies_list):
+    if not isinstance(proxies_list, list): return []
+    for proxy in proxies_list:
+        if isinstance(proxy, dict) and 'name' in proxy: proxy['name'] = bleach.clean(proxy.get('name', ''))[:50]
+    return proxies_list
+
+def legacy_clean_personal_config(config):
+    if 'profile_name' in config: config['profile_name'] = bleach.clean(config.get('profile_name', ''))[:50]
+    if 'config_json' in config:
+        try:
+            config_data = json.loads(config['config_json'])
+            if 'nodes' in config_data:
+                for node in config_data.get('nodes', []):
+                    if 'remark' in node: node['remark'] = bleach.clean(node.get('remark', ''))[:50]
+            if 'proxies' in config_data: config_data['proxies'] = legacy_clean_proxies(config_data.get('proxies', []))
+            config['config_json'] = json.dumps(config_data)
+        except json.JSONDecodeError: config['config_json'] = '{}'
+    return config
+
+
+def make_config(rng, nodes, proxies, unsafe_ratio):
+    """生成一份个人配置。unsafe_ratio 比例的名称里带有 HTML 字符，会走 bleach 的慢路径。"""
+    node_list = make_nodes(rng, nodes)
+    proxy_list = make_proxies(rng, proxies)
+    for item, key in [(n, 'remark') for n in node_list] + [(p, 'name') for p in proxy_list]:
+        if rng.random() < unsafe_ratio:
+            item[key] = f"<b>{item[key]}</b> & co"
+    return {"config_id": "conf-bench", "profile_name": "我的云端配置",
+            "config_json": json.dumps({"nodes": node_list, "proxies": proxy_list})}
+
+
+def measure(clean, config, iterations):
+    """返回每次保存的平均 CPU 时间（微秒）。每轮都用新的副本，避免上一轮的清洗结果影响下一轮。"""
+    copies = [copy.deepcopy(config) for _ in range(iterations)]
+    started = time.process_time()
+    for item in copies:
+        clean(item)
+    return (time.process_time() - started) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比较配置保存时校验清洗的 CPU 开销。")
+    parser.add_argument('--nodes', type=int, default=8, help="每份配置的节点数（默认 8）。")
+    parser.add_argument('--proxies', type=int, default=20, help="每份配置的代理规则数（默认 20）。")
+    parser.add_argument('--iterations', type=int, default=1000, help="每种情况重复的次数（默认 1000）。")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    print(f"每份配置 {args.nodes} 个节点、{args.proxies} 条代理规则，重复 {args.iterations} 次")
+    print(f"{'名称含HTML字符的比例':<22}{'原实现(us/次)':>16}{'新实现(us/次)':>16}{'加速':>8}")
+    for unsafe_ratio in (0.0, 0.1, 1.0):
+        config = make_config(random.Random(args.seed), args.nodes, args.proxies, unsafe_ratio)
+        # 两种实现的结果必须一致（新实现在没有改动时保留原字符串，比较解析后的内容）
+        legacy, current = legacy_clean_personal_config(copy.deepcopy(config)), sanitize_personal_config(copy.deepcopy(config))
+        assert legacy['profile_name'] == current['profile_name'] and json.loads(legacy['config_json']) == json.loads(current['config_json'])
+        before = measure(legacy_clean_personal_config, config, args.iterations)
+        after = measure(sanitize_personal_config, config, args.iterations)
+        print(f"{unsafe_ratio:<30.0%}{before:>16.1f}{after:>16.1f}{before / after:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,35 @@
+import os
 import sqlite3
 import json
 import time
 import uuid
-import os
 import re
 import datetime
 import string
 import secrets
-import bleach
 import threading
 import hashlib
-from flask import Flask, request, jsonify, g, abort, make_response
+import queue
+import atexit
+from flask import Flask, request, jsonify, g, abort, make_response, Response, request_started
 from werkzeug.middleware.proxy_fix import ProxyFix
-from argon2 import PasswordHasher
+from werkzeug.http import quote_etag
 from argon2.exceptions import VerifyMismatchError
 import logging
-from logging.handlers import RotatingFileHandler
-from collections import OrderedDict
 from functools import wraps
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+from sessions import SessionCache, SessionExpiryWriter
+from hashing import PasswordHashingPool, HashingBusyError
+from stores import SharedDatabase, SharedInvalidations, create_store
+from events import EventHub, format_sse
+from blobs import blob_reference_triggers, blob_stats, decode_blob, migrate_rows_to_blobs, store_blob
+from shares import CompiledShare, ShareCache, ShareCompileError, compile_template_share, frpc_config_summary, render_frpc_toml
+from metrics import MetricsRegistry, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from sanitize import ConfigValidationError, sanitize_text, sanitize_personal_config, sanitize_user_params, sanitize_config_document
+from logs import CompressingRotatingFileHandler, JsonLogFormatter, TextLogFormatter, start_queued_logging
+from negotiation import NegotiatingJSONProvider, NegotiatingRequest, RequestDecompressionMiddleware, compress_response
+from maintenance import MaintenanceScheduler, IncrementalVacuum, delete_in_batches, wal_checkpoint, optimize, analyze
 
 # 这是一个列表，每个元素代表一个受信任的版本
 
@@ -40,17 +50,35 @@ MIN_CLIENT_VERSION = 999
 LATEST_CLIENT_VERSION = 999
 LATEST_CLIENT_VERSION_STR = "v9.9.9"
 
-one_time_configs = {}
-configs_lock = threading.Lock() # 为字典操作创建一个锁
+# --- 临时状态存储 ---
+# 由环境变量 MOEFRP_EPHEMERAL_BACKEND 选择：
+# "memory"（默认）：保存在本进程内存中，只适合单进程运行。
+# "sqlite"：保存在共享的 SQLite 文件中（包括 Flask-Limiter 的计数器），
+#           这样才能在反向代理后面以多个工作进程运行，例如 gunicorn -w 4 -k gthread --threads 64 server:app
+#           （server 目录下的 gunicorn.conf.py 已包含这些设置，并会把该变量设为 sqlite）。
+# 每个已登录的客户端都会长期占用一个工作线程接收 /api/events 事件流，不能使用默认的 sync 工作模式：
+# 那样几个空闲客户端就会占满所有工作进程，其他请求全部挂起。线程总数需大于同时在线的客户端数。
+EPHEMERAL_BACKEND = os.environ.get("MOEFRP_EPHEMERAL_BACKEND", "memory")
+if EPHEMERAL_BACKEND not in ("memory", "sqlite"):
+    raise RuntimeError(f"MOEFRP_EPHEMERAL_BACKEND 只能是 \"memory\" 或 \"sqlite\"，当前为 {EPHEMERAL_BACKEND!r}")
+EPHEMERAL_DATABASE = 'ephemeral.db'
+shared_db = SharedDatabase(EPHEMERAL_DATABASE) if EPHEMERAL_BACKEND == "sqlite" else None
+LIMITER_STORAGE_URI = f"sqlite:///{EPHEMERAL_DATABASE}" if shared_db else "memory://"
+
+# 条目到期自动清理，数量达到上限时淘汰最早过期的条目
+TICKET_LIFETIME_SECONDS = 10
+# 票据过期后再保留一段时间，过期访问才能返回410并记录使用历史，而不是直接404
+one_time_configs = create_store("config_tickets", TICKET_LIFETIME_SECONDS + 60, 10000, shared_db)
 
-reset_tokens = {}
 reset_tokens_lock = threading.Lock()
 
-login_challenges = {}
-challenges_lock = threading.Lock()
+login_challenges = create_store("login_challenges", 60, 10000, shared_db)
+
+TICKET_RATE_LIMIT_SECONDS = 3.0
+# 记录每个用户最近一次申请票据的时间，只需保留到限速窗口结束
+rate_limit_tracker = create_store("ticket_rate_limit", TICKET_RATE_LIMIT_SECONDS, 100000, shared_db)
 
-rate_limit_tracker = {}
-rate_limit_lock = threading.Lock()
+EPHEMERAL_STORES = (one_time_configs, login_challenges, rate_limit_tracker)
 
 # --- 应用初始化 ---
 app = Flask(__name__)
@@ -64,23 +92,101 @@ app.wsgi_app = ProxyFix(
     app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_port=1, x_prefix=1
 )
 
+# --- 传输压缩与编码协商 ---
+# 客户端可以上传 gzip/deflate 压缩的请求体，并通过 Accept / Accept-Encoding 选择 MessagePack 和压缩的响应
+MAX_REQUEST_BODY_BYTES = 16 * 1024 * 1024   # 压缩请求体解压后的上限
+RESPONSE_COMPRESSION_MIN_BYTES = 1024       # 小于此大小的响应压缩收益不抵开销
+RESPONSE_COMPRESSION_LEVEL = 6
+app.wsgi_app = RequestDecompressionMiddleware(app.wsgi_app, MAX_REQUEST_BODY_BYTES)
+app.request_class = NegotiatingRequest
+app.json = NegotiatingJSONProvider(app)
+
+# --- 运行指标 ---
+# 通过 /metrics 以 Prometheus 文本格式输出，只允许本机的采集器访问
+METRICS_ALLOWED_ADDRS = {"127.0.0.1", "::1"}
+metrics = MetricsRegistry(logger=app.logger)
+http_request_seconds = metrics.histogram('moefrp_http_request_duration_seconds', '各接口的请求处理耗时（事件流只计到开始推送为止）', ('method', 'route'))
+http_requests_total = metrics.counter('moefrp_http_requests_total', '各接口的请求数，按状态码区分', ('method', 'route', 'status'))
+# sqlite：执行语句和提交；argon2：工作进程内的哈希计算；sanitize：配置的JSON解析与bleach清洗
+subsystem_seconds = metrics.histogram('moefrp_subsystem_duration_seconds', '各子系统的耗时', ('subsystem',))
+argon2_queue_wait_seconds = metrics.histogram('moefrp_argon2_queue_wait_seconds', '密码哈希任务在进程池中的排队时间')
+ticket_outcomes_total = metrics.counter('moefrp_config_ticket_outcomes_total', '配置票据的申请与使用结果', ('outcome',))
+limiter_rejections_total = metrics.counter('moefrp_rate_limit_rejections_total', 'Flask-Limiter 拒绝的请求数', ('endpoint',))
+
+@request_started.connect_via(app)
+def start_request_timer(sender, **extra):
+    # 在 before_request（包括限流检查）之前开始计时，被限流拒绝的请求也能计入
+    g._request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('_request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else '<unmatched>'
+        http_request_seconds.observe(time.perf_counter() - started, request.method, route)
+        http_requests_total.inc(request.method, route, response.status_code)
+    return response
+
+@app.after_request
+def negotiate_response_encoding(response):
+    # 在计时的钩子之前执行（after_request 按注册的相反顺序调用），压缩耗时计入请求耗时
+    return compress_response(response, RESPONSE_COMPRESSION_MIN_BYTES, RESPONSE_COMPRESSION_LEVEL)
+
+def on_rate_limit_breach(request_limit):
+    limiter_rejections_total.inc(request.endpoint or '<unmatched>')
+    return None # 沿用 Flask-Limiter 默认的 429 响应
+
+def timed(subsystem):
+    """把被装饰函数的耗时计入指定子系统"""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with subsystem_seconds.time(subsystem):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
 # 初始化 Limiter
 limiter = Limiter(
     get_remote_address, # 使用真实IP地址作为识别用户的键
     app=app,
     default_limits=["200 per hour", "50 per minute"], # 全局默认限制
-    storage_uri="memory://", # 使用内存作为存储，简单高效
-    strategy="fixed-window" # 固定时间窗口策略
+    storage_uri=LIMITER_STORAGE_URI, # 单进程用内存，多进程用共享的 SQLite 文件
+    strategy="fixed-window", # 固定时间窗口策略
+    on_breach=on_rate_limit_breach
 )
 
-# 创建全局 PasswordHasher 实例
-ph = PasswordHasher(
+# Argon2 参数
+ARGON2_PARAMS = dict(
     time_cost=3,
     memory_cost=64 * 1024, # 64 MiB
     parallelism=2,
     hash_len=32,
     salt_len=16
 )
+HASH_MEMORY_BUDGET_MB = 512 # 所有哈希进程同时运行时允许占用的内存上限，决定工作进程数
+HASH_MAX_QUEUE = 32 # 允许排队等待哈希的请求数，超出后直接返回503
+
+def observe_password_hash(queue_wait, hash_seconds):
+    argon2_queue_wait_seconds.observe(queue_wait)
+    subsystem_seconds.observe(hash_seconds, 'argon2')
+
+# 密码哈希在独立的进程池中执行，不再占用 Flask 的工作线程
+ph = PasswordHashingPool(ARGON2_PARAMS, memory_budget_mb=HASH_MEMORY_BUDGET_MB, max_queue=HASH_MAX_QUEUE, observer=observe_password_hash)
+atexit.register(ph.shutdown)
+
+@app.errorhandler(HashingBusyError)
+def handle_hashing_busy(e):
+    reasons = {"saturated": "进程池已满", "timeout": "等待哈希结果超时", "broken": "工作进程异常退出，进程池已重建"}
+    app.logger.warning(f"密码哈希暂不可用（{reasons.get(e.reason, e.reason)}），请求被拒绝。Retry-After: {e.retry_after}s")
+    response = jsonify({"error": "服务器繁忙，请稍后重试。"})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+@app.errorhandler(ConfigValidationError)
+def handle_invalid_config(e):
+    return jsonify({"error": f"配置格式不正确（{e}）"}), 400
 
 # --- 自定义日志过滤器，用于注入请求信息 ---
 class RequestContextFilter(logging.Filter):
@@ -94,18 +200,21 @@ class RequestContextFilter(logging.Filter):
         return True
 
 # --- 生产环境日志配置 ---
+LOG_FILE = 'server.log'
+LOG_FORMAT = "text"                 # "json"：每个事件输出一行 JSON
+LOG_MAX_BYTES = 10 * 1024 * 1024    # 单个日志文件超过此大小时轮转
+LOG_ROTATE_SECONDS = 24 * 3600      # 最长每天轮转一次
+LOG_BACKUP_COUNT = 30               # 保留的 .gz 旧日志个数
+LOG_QUEUE_SIZE = 10000              # 待写日志的队列上限，写盘跟不上时丢弃并计数
+log_queue_handler = None
 if not app.debug:
-    # 为日志格式化器添加 remote_addr
-    formatter = logging.Formatter(
-        '%(asctime)s %(levelname)s: %(message)s [IP: %(remote_addr)s]'
-    )
-    handler = RotatingFileHandler('server.log', maxBytes=102400, backupCount=10)
-    handler.setFormatter(formatter)
-    
-    # 为处理器添加自定义过滤器
-    handler.addFilter(RequestContextFilter())
-    
-    app.logger.addHandler(handler)
+    # 请求线程只负责把记录放入队列，格式化、写盘、轮转都在后台线程中完成
+    log_file_handler = CompressingRotatingFileHandler(LOG_FILE, LOG_MAX_BYTES, LOG_ROTATE_SECONDS, LOG_BACKUP_COUNT)
+    log_file_handler.setFormatter(JsonLogFormatter() if LOG_FORMAT == "json" else TextLogFormatter())
+    # 过滤器在请求线程上执行，这样才能取到请求的IP地址
+    log_queue_handler, log_listener = start_queued_logging(app.logger, log_file_handler, filters=[RequestContextFilter()], max_queue=LOG_QUEUE_SIZE)
+    # 退出时先把队列中剩余的日志写完
+    atexit.register(log_listener.stop)
     app.logger.setLevel(logging.INFO)
 
     app.logger.info('FRP Server Started')
@@ -121,104 +230,320 @@ def validate_invite_code_format(code):
     return True,"验证通过"
 
 # --- 数据库操作 ---
+class InstrumentedConnection(sqlite3.Connection):
+    """为 execute/executemany/commit 计时的连接，计入 sqlite 子系统（遍历结果集的时间不在其中）"""
+    def execute(self, *args):
+        started = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            subsystem_seconds.observe(time.perf_counter() - started, 'sqlite')
+
+    def executemany(self, *args):
+        started = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            subsystem_seconds.observe(time.perf_counter() - started, 'sqlite')
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            subsystem_seconds.observe(time.perf_counter() - started, 'sqlite')
+
+class ConnectionPool:
+    """
+    一个简单的SQLite连接池。
+    连接在请求开始时借出、请求结束时归还，避免每个请求都重新建立连接和执行PRAGMA。
+    """
+    def __init__(self, database, max_idle=16, busy_timeout_ms=15000):
+        self.database = database
+        self.busy_timeout_ms = busy_timeout_ms
+        # 后进先出，让最近用过的（页缓存最热的）连接优先被复用
+        self._idle = queue.LifoQueue(maxsize=max_idle)
+
+    def _connect(self):
+        db = sqlite3.connect(self.database, timeout=self.busy_timeout_ms / 1000, check_same_thread=False, factory=InstrumentedConnection)
+        db.row_factory = sqlite3.Row
+        # 只对新建的数据库生效（必须在建表和切换WAL之前设置），让后台维护可以增量回收空闲页；已有的库保持不变
+        db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        # WAL模式下读者不会再被写者阻塞；该设置会持久化到数据库文件中
+        db.execute("PRAGMA journal_mode = WAL")
+        # WAL模式下 NORMAL 已足够安全，且每次提交不再需要 fsync
+        db.execute("PRAGMA synchronous = NORMAL")
+        db.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+        db.execute("PRAGMA foreign_keys = ON")
+        db.execute("PRAGMA temp_store = MEMORY")
+        return db
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, db):
+        # 归还前回滚未提交的事务，防止把半截的写操作带给下一个请求
+        try:
+            if db.in_transaction:
+                db.rollback()
+        except sqlite3.Error:
+            db.close()
+            return
+        try:
+            self._idle.put_nowait(db)
+        except queue.Full:
+            db.close()
+
+db_pool = ConnectionPool(DATABASE)
+
 def get_db():
-    db = sqlite3.connect(DATABASE, timeout=15);db.row_factory = sqlite3.Row;db.execute("PRAGMA foreign_keys = ON");return db
+    """返回当前请求的数据库连接。同一请求内（装饰器和视图函数）共享一个连接，请求结束时自动归还连接池。"""
+    db = g.get('_db')
+    if db is None:
+        db = g._db = db_pool.acquire()
+    return db
+
+@app.teardown_appcontext
+def release_db(exception):
+    db = g.pop('_db', None)
+    if db is not None:
+        db_pool.release(db)
+
+# --- 会话缓存 ---
+# 多进程部署时，注销、登录顶替等失效按用户记录在共享数据库中，各进程定期取回，只丢弃相关用户的缓存
+SESSION_INVALIDATION_POLL_SECONDS = 0.5 # 其他进程中的注销最多滞后这么久生效
+session_cache = SessionCache(max_entries=10000, ttl_seconds=60, invalidations=SharedInvalidations(shared_db, 'sessions') if shared_db else None,
+                             poll_interval=SESSION_INVALIDATION_POLL_SECONDS)
+session_expiry_writer = SessionExpiryWriter(db_pool, flush_interval=5.0, logger=app.logger)
+# 进程退出前把尚未写回的续期落盘
+atexit.register(session_expiry_writer.flush)
+
+# --- 变更事件流 ---
+# 客户端保持一条事件流连接，代替原来每30秒一次的会话检查和配置轮询
+event_hub = EventHub(max_pending=64)
+EVENT_HEARTBEAT_SECONDS = 25    # 心跳间隔，需小于客户端和反向代理的读超时
+# 长连接期间按此间隔重新校验（并续期）会话。
+# 事件总线只在本进程内分发，多进程部署时其他进程产生的变更收不到，改为每次心跳都回源检查会话和配置ETag
+EVENT_SESSION_RECHECK_SECONDS = 300 if shared_db is None else EVENT_HEARTBEAT_SECONDS
+
+# --- 分享编译缓存 ---
+# 热门分享的解析和编译结果常驻内存；撤销时失效
+share_cache = ShareCache(max_entries=1024, ttl_seconds=300)
+SHARE_BATCH_MAX_IDS = 100   # 批量查询分享公开信息时一次最多的ID数
+
+# --- 抓取时读取的指标 ---
+# 这些数值本来就由各组件统计，只在 /metrics 被访问时读取一次，请求路径上没有额外开销
+metrics.gauge_callback('moefrp_ephemeral_store_entries', '票据、挑战码、票据限速等临时存储的当前条目数',
+                       lambda: {(store.name,): len(store) for store in EPHEMERAL_STORES}, ('store',))
+metrics.counter_callback('moefrp_ephemeral_store_removed_total', '临时存储因过期或容量上限被移除的条目数',
+                         lambda: {(store.name, reason): stats[reason] for store in EPHEMERAL_STORES for stats in [store.stats()] for reason in ('expired', 'evicted')}, ('store', 'reason'))
+metrics.gauge_callback('moefrp_session_cache_entries', '会话缓存的当前条目数', lambda: len(session_cache))
+metrics.gauge_callback('moefrp_share_cache_entries', '分享编译缓存的当前条目数', lambda: share_cache.stats()['entries'])
+metrics.counter_callback('moefrp_share_cache_lookups_total', '分享编译缓存的查询次数',
+                         lambda: {(result,): share_cache.stats()[result] for result in ('hits', 'misses')}, ('result',))
+metrics.gauge_callback('moefrp_event_stream_connections', '当前打开的事件流连接数', event_hub.connection_count)
+metrics.gauge_callback('moefrp_argon2_in_flight', '正在执行或排队的密码哈希任务数', lambda: ph.stats()['in_flight'])
+metrics.counter_callback('moefrp_argon2_rejected_total', '因进程池已满被拒绝（返回503）的密码哈希任务数', lambda: ph.stats()['rejected'])
+metrics.counter_callback('moefrp_argon2_timed_out_total', '等待结果超时（返回503）的密码哈希任务数', lambda: ph.stats()['timed_out'])
+metrics.counter_callback('moefrp_argon2_pool_restarts_total', '工作进程异常退出后重建密码哈希进程池的次数', lambda: ph.stats()['pool_restarts'])
+if log_queue_handler is not None:
+    metrics.counter_callback('moefrp_log_records_dropped_total', '日志队列已满被丢弃的日志条数', lambda: log_queue_handler.dropped)
+
+# --- 数据库结构迁移 ---
+# 每个元素为 (版本号, 说明, SQL语句列表)，当前版本记录在 PRAGMA user_version 中。
+# 需要在 Python 中处理数据的步骤可以写成接收数据库连接的函数，与SQL语句在同一事务中执行。
+# 已上线的迁移不要再修改，结构变更只能在列表末尾追加新版本。
+SCHEMA_MIGRATIONS = [
+    (1, "初始表结构", [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            uuid TEXT PRIMARY KEY, 
+            nickname TEXT UNIQUE NOT NULL, 
+            password_hash TEXT NOT NULL,
+            current_session_token TEXT, 
+            session_token_expiry TEXT,
+            role TEXT NOT NULL DEFAULT 'user'
+        );
+        ''',
+        'CREATE TABLE IF NOT EXISTS personal_configs (config_id TEXT PRIMARY KEY, owner_uuid TEXT NOT NULL, profile_name TEXT NOT NULL, config_json TEXT NOT NULL, FOREIGN KEY (owner_uuid) REFERENCES users (uuid) ON DELETE CASCADE);',
+        'CREATE TABLE IF NOT EXISTS shares (share_id TEXT PRIMARY KEY, owner_uuid TEXT NOT NULL, share_name TEXT NOT NULL, is_template BOOLEAN NOT NULL, config_data_json TEXT NOT NULL, FOREIGN KEY (owner_uuid) REFERENCES users (uuid) ON DELETE CASCADE);',
+        'CREATE TABLE IF NOT EXISTS subscriptions (subscription_id TEXT PRIMARY KEY, user_uuid TEXT NOT NULL, share_id TEXT NOT NULL, user_params_json TEXT, FOREIGN KEY (user_uuid) REFERENCES users (uuid) ON DELETE CASCADE, FOREIGN KEY (share_id) REFERENCES shares (share_id) ON DELETE CASCADE);',
+        'CREATE TABLE IF NOT EXISTS invitation_codes (code TEXT PRIMARY KEY, is_used BOOLEAN NOT NULL DEFAULT 0, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, used_by_uuid TEXT, used_at TIMESTAMP, FOREIGN KEY (used_by_uuid) REFERENCES users (uuid) ON DELETE SET NULL);',
+        '''
+        CREATE TABLE IF NOT EXISTS password_reset_tokens (
+            token TEXT PRIMARY KEY,
+            user_uuid TEXT NOT NULL,
+            expires_at TEXT NOT NULL,
+            FOREIGN KEY (user_uuid) REFERENCES users (uuid) ON DELETE CASCADE
+        );
+        ''',
+    ]),
+    (2, "为热点查询和外键添加索引", [
+        'CREATE INDEX IF NOT EXISTS idx_users_session_token ON users (current_session_token);',
+        'CREATE INDEX IF NOT EXISTS idx_personal_configs_owner ON personal_configs (owner_uuid);',
+        'CREATE INDEX IF NOT EXISTS idx_subscriptions_user ON subscriptions (user_uuid);',
+        'CREATE INDEX IF NOT EXISTS idx_subscriptions_share ON subscriptions (share_id);',
+        'CREATE INDEX IF NOT EXISTS idx_shares_owner ON shares (owner_uuid);',
+        'CREATE INDEX IF NOT EXISTS idx_reset_tokens_user ON password_reset_tokens (user_uuid);',
+        'CREATE INDEX IF NOT EXISTS idx_invitation_codes_used_by ON invitation_codes (used_by_uuid);',
+    ]),
+    (3, "为个人配置和订阅添加修订号，用于增量同步的乐观并发控制", [
+        'ALTER TABLE personal_configs ADD COLUMN revision INTEGER NOT NULL DEFAULT 1;',
+        'ALTER TABLE subscriptions ADD COLUMN revision INTEGER NOT NULL DEFAULT 1;',
+    ]),
+    (4, "为用户添加配置版本计数器，用于 /api/configs 的 ETag", [
+        'ALTER TABLE users ADD COLUMN config_revision INTEGER NOT NULL DEFAULT 0;',
+    ]),
+    (5, "配置、分享和订阅参数改为按内容去重并压缩存放在 config_blobs 中", [
+        '''
+        CREATE TABLE IF NOT EXISTS config_blobs (
+            hash TEXT PRIMARY KEY,
+            encoding TEXT NOT NULL,
+            data BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            ref_count INTEGER NOT NULL DEFAULT 0
+        );
+        ''',
+        'ALTER TABLE personal_configs ADD COLUMN config_blob TEXT REFERENCES config_blobs (hash);',
+        'ALTER TABLE shares ADD COLUMN config_blob TEXT REFERENCES config_blobs (hash);',
+        'ALTER TABLE subscriptions ADD COLUMN user_params_blob TEXT REFERENCES config_blobs (hash);',
+        # 删除内容时外键检查要按引用列查找，需要索引
+        'CREATE INDEX IF NOT EXISTS idx_personal_configs_blob ON personal_configs (config_blob);',
+        'CREATE INDEX IF NOT EXISTS idx_shares_blob ON shares (config_blob);',
+        'CREATE INDEX IF NOT EXISTS idx_subscriptions_params_blob ON subscriptions (user_params_blob);',
+        *blob_reference_triggers('personal_configs', 'config_blob'),
+        *blob_reference_triggers('shares', 'config_blob'),
+        *blob_reference_triggers('subscriptions', 'user_params_blob'),
+        migrate_rows_to_blobs,
+    ]),
+    (6, "为邀请码的按状态、按创建时间查询添加索引", [
+        'CREATE INDEX IF NOT EXISTS idx_invitation_codes_status ON invitation_codes (is_used, created_at);',
+    ]),
+]
+
+def migrate_db(db):
+    """把数据库结构升级到最新版本。每个版本在独立事务中执行，失败时整体回滚，可安全地对线上旧库重复执行。"""
+    for version, description, statements in SCHEMA_MIGRATIONS:
+        # 先加写锁再读版本号，避免多个进程同时启动时重复执行同一个迁移
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            current_version = db.execute("PRAGMA user_version").fetchone()[0]
+            if version <= current_version:
+                db.rollback()
+                continue
+            for statement in statements:
+                if callable(statement):
+                    statement(db)
+                else:
+                    db.execute(statement)
+            db.execute(f"PRAGMA user_version = {int(version)}")
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        print(f"Database migrated to version {version}: {description}")
+
 def init_db():
-    if not os.path.exists(DATABASE):
-        with app.app_context():
-            db=get_db()
-            db.execute('''
-                CREATE TABLE users (
-                    uuid TEXT PRIMARY KEY, 
-                    nickname TEXT UNIQUE NOT NULL, 
-                    password_hash TEXT NOT NULL,
-                    current_session_token TEXT, 
-                    session_token_expiry TEXT,
-                    role TEXT NOT NULL DEFAULT 'user'
-                );
-            ''')
-            db.execute('CREATE TABLE personal_configs (config_id TEXT PRIMARY KEY, owner_uuid TEXT NOT NULL, profile_name TEXT NOT NULL, config_json TEXT NOT NULL, FOREIGN KEY (owner_uuid) REFERENCES users (uuid) ON DELETE CASCADE);')
-            db.execute('CREATE TABLE shares (share_id TEXT PRIMARY KEY, owner_uuid TEXT NOT NULL, share_name TEXT NOT NULL, is_template BOOLEAN NOT NULL, config_data_json TEXT NOT NULL, FOREIGN KEY (owner_uuid) REFERENCES users (uuid) ON DELETE CASCADE);')
-            db.execute('CREATE TABLE subscriptions (subscription_id TEXT PRIMARY KEY, user_uuid TEXT NOT NULL, share_id TEXT NOT NULL, user_params_json TEXT, FOREIGN KEY (user_uuid) REFERENCES users (uuid) ON DELETE CASCADE, FOREIGN KEY (share_id) REFERENCES shares (share_id) ON DELETE CASCADE);')
-            db.execute('CREATE TABLE invitation_codes (code TEXT PRIMARY KEY, is_used BOOLEAN NOT NULL DEFAULT 0, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, used_by_uuid TEXT, used_at TIMESTAMP, FOREIGN KEY (used_by_uuid) REFERENCES users (uuid) ON DELETE SET NULL);')
-            db.execute('''
-                CREATE TABLE password_reset_tokens (
-                    token TEXT PRIMARY KEY,
-                    user_uuid TEXT NOT NULL,
-                    expires_at TEXT NOT NULL,
-                    FOREIGN KEY (user_uuid) REFERENCES users (uuid) ON DELETE CASCADE
-                );
-            ''')
-            db.commit();print("Database initialized (simplified for 'Remember Password' feature).")
+    with app.app_context():
+        migrate_db(get_db())
 
 # --- 认证装饰器 ---
+def resolve_session(token):
+    """
+    校验会话令牌，必要时滑动续期。
+    返回 (user, None)；令牌无效或已过期时返回 (None, (错误信息, 状态码))。
+    事件流会在请求结束后的长连接里周期性调用它，因此这里只依赖应用上下文，不访问 request。
+    """
+    cached = session_cache.get(token)
+    if cached is not None:
+        user, expiry_time = cached
+    else:
+        # 缓存未命中才查库；连接取自本次请求从连接池借出的连接，被装饰的视图函数会复用它
+        # 查库前取得失效标记：查询和写入缓存之间若有注销或重新登录，结果不会写入缓存
+        loaded_at = session_cache.begin_load()
+        db = get_db()
+        row = db.execute('SELECT uuid, nickname, role, session_token_expiry FROM users WHERE current_session_token = ?', (token,)).fetchone()
+        
+        if row is None:
+            app.logger.warning(f"无效的Token被使用: {token[:8]}...")
+            return None, ("会话无效或已过期", 401)
+
+        user = dict(row)
+        session_expiry_str = user.pop('session_token_expiry')
+        if not session_expiry_str:
+            app.logger.error(f"用户(uuid:{user['uuid']})缺少会话过期时间。", extra={"message_en": f"Missing session expiry for user: {user['nickname']}"})
+            return None, ("会话状态异常，请重新登录", 401)
+
+        # --- 时间验证逻辑 ---
+        # fromisoformat 的格式错误由调用方统一捕获
+        expiry_time = datetime.datetime.fromisoformat(session_expiry_str)
+        if expiry_time.tzinfo is None:
+            expiry_time = expiry_time.replace(tzinfo=datetime.timezone.utc)
+
+        # 库中的值可能还没追上后台写入器里排队的续期
+        pending_expiry = session_expiry_writer.pending_expiry(token)
+        if pending_expiry and pending_expiry > expiry_time:
+            expiry_time = pending_expiry
+        session_cache.put(token, user, expiry_time, loaded_at)
+    
+    current_time_utc = datetime.datetime.now(datetime.timezone.utc)
+    
+    if expiry_time < current_time_utc:
+        session_cache.invalidate_token(token)
+        app.logger.info(f"用户(uuid:{user['uuid']}, name:{user['nickname']})的会话已过期。", extra={"message_en": f"Session expired for user: {user['nickname']}"})
+        return None, ("会话已过期，请重新登录", 401)
+    
+    # --- 会话滑动窗口续期 ---
+    # 如果剩余时间少于6小时，就自动续期为12小时。
+    # 请求线程只更新缓存并登记续期，由后台写入器批量写回数据库。
+    if expiry_time - current_time_utc < datetime.timedelta(hours=6):
+        new_expiry_date = current_time_utc + datetime.timedelta(hours=12)
+        session_cache.update_expiry(token, new_expiry_date)
+        session_expiry_writer.schedule(user['uuid'], token, new_expiry_date)
+        app.logger.info(f"为用户(uuid:{user['uuid']}, name:{user['nickname']})的会话(session:{token[:8]}...)自动续期。")
+    # --- 续期逻辑结束 ---
+    return user, None
+
+def get_bearer_token():
+    auth_header = request.headers.get('Authorization')
+    if not auth_header:
+        return None
+    try:
+        return auth_header.split(" ")[1]
+    except IndexError:
+        return auth_header
+
 def token_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        auth_header = request.headers.get('Authorization')
-        if not auth_header:
+        token = get_bearer_token()
+        if not token:
             app.logger.warning(f"Auth header missing from IP: {request.remote_addr}")
             return jsonify({"error": "需要认证"}), 401
-        
-        try:
-            token = auth_header.split(" ")[1]
-        except IndexError:
-            token = auth_header
 
-        db = None # 初始化db，以便在finally中安全地关闭
         try:
-            db = get_db()
-            user = db.execute('SELECT * FROM users WHERE current_session_token = ?', (token,)).fetchone()
-            
-            if user is None:
-                app.logger.warning(f"无效的Token被使用: {token[:8]}...")
-                app.logger.warning(f"Invalid token used from IP: {request.remote_addr}")
-                return jsonify({"error": "会话无效或已过期"}), 401
-
-            session_expiry_str = user['session_token_expiry']
-            if not session_expiry_str:
-                app.logger.error(f"用户(uuid:{user['uuid']})缺少会话过期时间。")
-                app.logger.error(f"Missing session expiry for user: {user['nickname']}")
-                return jsonify({"error": "会话状态异常，请重新登录"}), 401
-
-            # --- 时间验证逻辑 (移入try...except块) ---
-            expiry_time = datetime.datetime.fromisoformat(session_expiry_str)
-            if expiry_time.tzinfo is None:
-                expiry_time = expiry_time.replace(tzinfo=datetime.timezone.utc)
-            
-            current_time_utc = datetime.datetime.now(datetime.timezone.utc)
-            
-            if expiry_time < current_time_utc:
-                app.logger.info(f"用户(uuid:{user['uuid']}, name:{user['nickname']})的会话已过期。")
-                app.logger.info(f"Session expired for user: {user['nickname']}")
-                return jsonify({"error": "会话已过期，请重新登录"}), 401
-            
-            # --- 会话滑动窗口续期 ---
-            # 如果剩余时间少于6小时，就自动续期为12小时
-            if expiry_time - current_time_utc < datetime.timedelta(hours=6):
-                new_expiry_date = current_time_utc + datetime.timedelta(hours=12)
-                db.execute('UPDATE users SET session_token_expiry = ? WHERE uuid = ?',
-                           (new_expiry_date.isoformat(), user['uuid']))
-                db.commit()
-                app.logger.info(f"为用户(uuid:{user['uuid']}, name:{user['nickname']})的会话(session:{token[:8]}...)自动续期。")
-                app.logger.info(f"Session for user '{user['nickname']}' has been refreshed (slid forward).")
-            # --- 续期逻辑结束 ---
+            user, error = resolve_session(token)
+            if error:
+                app.logger.warning(f"Rejected session from IP: {request.remote_addr}")
+                return jsonify({"error": error[0]}), error[1]
             
             # 将 user 对象传递给被装饰的视图函数
             return f(user, *args, **kwargs)
 
+        except ConfigValidationError:
+            # 交给 handle_invalid_config 返回400
+            raise
         except (ValueError, TypeError) as e:
             # 捕获 fromisoformat 可能的错误
-            app.logger.error(f"Invalid session expiry format for user: {user.get('nickname', 'Unknown')}, format: '{session_expiry_str}', error: {e}")
+            app.logger.error(f"Invalid session expiry format for token: {token[:8]}..., error: {e}")
             return jsonify({"error": "会话状态异常，请重新登录"}), 401
         except Exception as e:
             # 捕获其他所有潜在错误
             app.logger.error(f"An unexpected error occurred during token verification: {e}", exc_info=True)
             return jsonify({"error": "服务器内部错误"}), 500
-        finally:
-            # 确保数据库连接在任何情况下都会被关闭
-            if db:
-                db.close()
     
     return decorated_function
 
@@ -238,11 +563,25 @@ def admin_required(f):
     return decorated_function
 
 # --- 辅助清理函数 ---
-def clean_proxies(proxies_list):
-    if not isinstance(proxies_list,list):return[]
-    for proxy in proxies_list:
-        if isinstance(proxy,dict)and'name'in proxy:proxy['name']=bleach.clean(proxy.get('name',''))[:50]
-    return proxies_list
+# 校验规则见 sanitize.py；格式不正确时抛出 ConfigValidationError，由上面的错误处理器返回400
+@timed('sanitize')
+def clean_personal_config(config):
+    """清洗客户端上传的单个个人配置（原地修改并返回）"""
+    return sanitize_personal_config(config)
+
+@timed('sanitize')
+def clean_user_params(user_params):
+    """清洗订阅的 user_params（原地修改并返回）"""
+    return sanitize_user_params(user_params)
+
+# --- 配置版本 (ETag) ---
+def bump_config_revision(db, user_uuids):
+    """用户的个人配置、订阅或所订阅的分享发生变化时调用，使其 /api/configs 的 ETag 失效（不提交事务）"""
+    db.executemany('UPDATE users SET config_revision = config_revision + 1 WHERE uuid = ?', [(u,) for u in user_uuids])
+
+def get_config_etag(db, user_uuid):
+    row = db.execute('SELECT config_revision FROM users WHERE uuid = ?', (user_uuid,)).fetchone()
+    return f"{user_uuid[:8]}-{row[0] if row else 0}"
 
 # --- API 接口 ---
 
@@ -255,11 +594,8 @@ def get_login_challenge():
         return jsonify({"error": "需要提供用户名以获取挑战码。"}), 400
         
     challenge_string = secrets.token_hex(32)
-    with challenges_lock:
-        login_challenges[challenge_string] = {
-            "nickname": nickname,
-            "expires_at": datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=60)
-        }
+    # 挑战码60秒后自动过期
+    login_challenges.set(challenge_string, {"nickname": nickname})
     return jsonify({"challenge": challenge_string})
 
 @app.route('/api/register', methods=['POST'])
@@ -268,30 +604,29 @@ def register():
     data = request.get_json();
     if not data: return jsonify({"error": "请求体不能为空"}), 400
     nickname = data.get('nickname'); password = data.get('password'); invite_code = data.get('invite_code', '').strip().upper()
-    nickname = bleach.clean(nickname).strip()
+    nickname = sanitize_text(nickname or '').strip()
     if nickname.lower() == 'all': return jsonify({"error": "昵称 'all' 是保留关键字，不允许注册。"}), 400
     if not re.match(r'^[a-zA-Z0-9_]{3,20}$', nickname): return jsonify({"error": "昵称格式不正确，只允许3-20位的字母、数字和下划线。"}), 400
     is_valid, message = validate_invite_code_format(invite_code)
     if not is_valid: return jsonify({"error": message}), 403
     db=get_db();code_row = db.execute('SELECT * FROM invitation_codes WHERE code = ?', (invite_code,)).fetchone()
-    if code_row is None: db.close(); return jsonify({"error": "邀请码无效或不存在"}), 403
-    if code_row['is_used']: db.close(); return jsonify({"error": "此邀请码已被使用"}), 403
-    if db.execute('SELECT uuid FROM users WHERE nickname = ?', (nickname,)).fetchone() is not None: db.close(); return jsonify({"error": "此昵称已被注册"}), 409
+    if code_row is None: return jsonify({"error": "邀请码无效或不存在"}), 403
+    if code_row['is_used']: return jsonify({"error": "此邀请码已被使用"}), 403
+    if db.execute('SELECT uuid FROM users WHERE nickname = ?', (nickname,)).fetchone() is not None: return jsonify({"error": "此昵称已被注册"}), 409
     password_hash = ph.hash(password); new_uuid = str(uuid.uuid4())
     db.execute('INSERT INTO users (uuid, nickname, password_hash) VALUES (?, ?, ?)', (new_uuid, nickname, password_hash))
     default_config_id = f'conf-{uuid.uuid4()}'; default_profile_name = '我的云端配置'; default_config_json = '{}'
-    db.execute('INSERT INTO personal_configs (config_id, owner_uuid, profile_name, config_json) VALUES (?, ?, ?, ?)', (default_config_id, new_uuid, default_profile_name, default_config_json))
+    db.execute('INSERT INTO personal_configs (config_id, owner_uuid, profile_name, config_json, config_blob) VALUES (?, ?, ?, \'\', ?)', (default_config_id, new_uuid, default_profile_name, store_blob(db, default_config_json)))
     db.execute('UPDATE invitation_codes SET is_used = 1, used_by_uuid = ?, used_at = CURRENT_TIMESTAMP WHERE code = ?', (new_uuid, invite_code))
-    db.commit(); db.close()
-    app.logger.info(f"新用户注册成功: {nickname} (uuid: {new_uuid})")
-    app.logger.info(f"New user registered: {nickname}")
+    db.commit()
+    app.logger.info(f"新用户注册成功: {nickname} (uuid: {new_uuid})", extra={"message_en": f"New user registered: {nickname}"})
     return jsonify({"success": True, "message": "注册成功"})
 
 @app.route('/api/perform_password_reset', methods=['POST'])
 @limiter.limit("5/minute") # 对此接口进行速率限制
 def perform_password_reset():
     data = request.get_json()
-    nickname = bleach.clean(data.get('nickname', '')).strip()
+    nickname = sanitize_text(data.get('nickname') or '').strip()
     reset_token = data.get('reset_token', '').strip()
     new_password = data.get('new_password')
 
@@ -303,25 +638,25 @@ def perform_password_reset():
     token_data = db.execute("SELECT user_uuid, expires_at FROM password_reset_tokens WHERE token = ?", (reset_token,)).fetchone()
 
     if not token_data:
-        db.close(); return jsonify({"error": "密码重置令牌无效或已使用。"}), 404
+        return jsonify({"error": "密码重置令牌无效或已使用。"}), 404
 
     # 2. 检查令牌是否过期
     expiry_time = datetime.datetime.fromisoformat(token_data['expires_at'])
     if expiry_time < datetime.datetime.now(datetime.timezone.utc):
-        db.execute("DELETE FROM password_reset_tokens WHERE token = ?", (reset_token,)); db.commit(); db.close()
+        db.execute("DELETE FROM password_reset_tokens WHERE token = ?", (reset_token,)); db.commit()
         return jsonify({"error": "密码重置令牌已过期。"}), 410
 
     # 3. 验证令牌是否属于该用户
     user = db.execute("SELECT nickname FROM users WHERE uuid = ?", (token_data['user_uuid'],)).fetchone()
     if not user or user['nickname'] != nickname:
-        db.close(); return jsonify({"error": "令牌与用户信息不匹配。"}), 403
+        return jsonify({"error": "令牌与用户信息不匹配。"}), 403
 
     # 4. 所有验证通过，更新密码并删除令牌
     new_password_hash = ph.hash(new_password)
     db.execute("UPDATE users SET password_hash = ? WHERE uuid = ?", (new_password_hash, token_data['user_uuid']))
     db.execute("DELETE FROM password_reset_tokens WHERE token = ?", (reset_token,))
     db.commit()
-    db.close()
+    session_cache.invalidate_user(token_data['user_uuid'])
     
     app.logger.info(f"用户 {nickname} 成功使用令牌重置了密码。")
     return jsonify({"success": True, "message": "密码已成功重置！请使用新密码登录。"})
@@ -336,7 +671,6 @@ def initiate_password_reset(user): # user 对象由装饰器传入
     
     db = get_db()
     target_user = db.execute("SELECT uuid FROM users WHERE nickname = ?", (target_nickname,)).fetchone()
-    db.close()
 
     if not target_user:
         return jsonify({"error": "目标用户不存在"}), 404
@@ -351,7 +685,6 @@ def initiate_password_reset(user): # user 对象由装饰器传入
         db.execute("INSERT INTO password_reset_tokens (token, user_uuid, expires_at) VALUES (?, ?, ?)",
                    (reset_token, target_user['uuid'], expires_at.isoformat()))
         db.commit()
-        db.close()
     
     app.logger.info(f"管理员 '{user['nickname']}' 为用户 '{target_nickname}' 创建了密码重置令牌并清理了旧令牌。")
     return jsonify({"success": True, "reset_token": reset_token})
@@ -404,9 +737,8 @@ def login():
         return jsonify({"error": "核心组件与客户端版本不匹配。"}), 403
 
     # 5. 验证挑战码
-    with challenges_lock:
-        challenge_data = login_challenges.pop(challenge, None)
-    if not challenge_data or datetime.datetime.now(datetime.timezone.utc) > challenge_data['expires_at']:
+    challenge_data = login_challenges.pop(challenge)
+    if not challenge_data:
         return jsonify({"error": "无效或已过期的挑战码。"}), 403
         
     # 6. 验证 Proof
@@ -442,9 +774,7 @@ def login():
     user = db.execute('SELECT * FROM users WHERE nickname = ?', (nickname,)).fetchone()
 
     if user is None:
-        db.close()
-        app.logger.warning(f"不存在的用户 '{nickname}' 尝试登录。")
-        app.logger.warning(f"Login failed for non-existent user: {nickname}")
+        app.logger.warning(f"不存在的用户 '{nickname}' 尝试登录。", extra={"message_en": f"Login failed for non-existent user: {nickname}"})
         return jsonify({"error": "昵称或密码错误"}), 401
     
     try:
@@ -458,9 +788,7 @@ def login():
             db.commit()
             app.logger.info(f"Password hash rehashed for user: {user['nickname']}")
     except VerifyMismatchError:
-        db.close()
-        app.logger.warning(f"用户(uuid:{user['uuid']}, name:{user['nickname']})登录时密码错误。")
-        app.logger.warning(f"Login failed (wrong password) for user: {nickname}")
+        app.logger.warning(f"用户(uuid:{user['uuid']}, name:{user['nickname']})登录时密码错误。", extra={"message_en": f"Login failed (wrong password) for user: {nickname}"})
         return jsonify({"error": "昵称或密码错误"}), 401
     
     # 所有验证都通过，创建并返回新的 session_token
@@ -468,7 +796,10 @@ def login():
     response_data = {"success": True, "session_token": session_token}
     
     db.commit()
-    db.close()
+    # 新会话会顶掉旧会话，提交后旧令牌也不能再从缓存中通过验证
+    session_cache.invalidate_user(user['uuid'])
+    # 通知其他设备上仍连着事件流的旧会话：已被本次登录顶掉
+    event_hub.invalidate_sessions(user['uuid'], "displaced", keep_token=session_token)
     app.logger.info(
         f"用户成功登录并通过所有安全校验: name='{nickname}', "
         f"uuid='{user['uuid']}', "
@@ -476,65 +807,333 @@ def login():
     )
     return jsonify(response_data)
 
+@app.route('/api/logout', methods=['POST'])
+@token_required
+def logout(user):
+    """注销当前会话，令牌立即失效"""
+    db = get_db()
+    db.execute('UPDATE users SET current_session_token = NULL, session_token_expiry = NULL WHERE uuid = ?', (user['uuid'],))
+    db.commit()
+    session_cache.invalidate_user(user['uuid'])
+    event_hub.invalidate_sessions(user['uuid'], "logout")
+    app.logger.info(f"用户(uuid:{user['uuid']}, name:{user['nickname']})已退出登录。")
+    return jsonify({"success": True})
+
+@app.route('/api/admin/hash_stats', methods=['GET'])
+@token_required
+@admin_required
+def hash_stats(user):
+    """密码哈希进程池的运行指标（排队等待时间与哈希计算时间），只有管理员可调用"""
+    return jsonify(ph.stats())
+
+@app.route('/api/admin/blob_stats', methods=['GET'])
+@token_required
+@admin_required
+def config_blob_stats(user):
+    """配置内容存储的去重与压缩情况（内容数、引用数、原始与实际占用字节），只有管理员可调用"""
+    return jsonify(blob_stats(get_db()))
+
+@app.route('/api/admin/store_stats', methods=['GET'])
+@token_required
+@admin_required
+def store_stats(user):
+    """临时状态存储的条目数、命中、过期与淘汰计数，只有管理员可调用"""
+    return jsonify({store.name: store.stats() for store in EPHEMERAL_STORES})
+
+@app.route('/metrics', methods=['GET'])
+@limiter.exempt
+def metrics_endpoint():
+    """Prometheus 文本格式的运行指标，只允许本机访问（经反向代理转发的外部请求会被拒绝）"""
+    if request.remote_addr not in METRICS_ALLOWED_ADDRS:
+        abort(404)
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
 @app.route('/api/session/check', methods=['POST'])
 @token_required
 def check_session(user): return jsonify({"valid": True})
 
+@app.route('/api/events', methods=['GET'])
+@token_required
+def event_stream(user):
+    """
+    按用户推送变更事件的 SSE 长连接：
+    hello（附当前配置ETag，便于断线重连后对齐）、config_changed、share_revoked、session_invalidated。
+    """
+    token = get_bearer_token()
+    etag = quote_etag(get_config_etag(get_db(), user['uuid']), weak=True)
+    subscriber = event_hub.subscribe(user['uuid'], token)
+    # 长连接期间不占用连接池里的数据库连接，生成器之后需要查库时再单独借用
+    release_db(None)
+
+    def generate():
+        last_check = time.monotonic()
+        last_etag = etag
+        try:
+            yield "retry: 5000\n" + format_sse('hello', {"etag": etag})
+            while True:
+                event = subscriber.get(timeout=EVENT_HEARTBEAT_SECONDS)
+                if event is not None:
+                    yield format_sse(*event)
+                    if event[0] == 'session_invalidated':
+                        return
+                    continue
+                # 心跳：SSE 注释行，顺带让服务器及时发现已断开的连接
+                yield ": keepalive\n\n"
+                if time.monotonic() - last_check >= EVENT_SESSION_RECHECK_SECONDS:
+                    last_check = time.monotonic()
+                    current_etag = last_etag
+                    try:
+                        with app.app_context():
+                            _, error = resolve_session(token)
+                            if shared_db is not None and not error:
+                                current_etag = quote_etag(get_config_etag(get_db(), user['uuid']), weak=True)
+                    except (ValueError, TypeError):
+                        error = ("会话状态异常，请重新登录", 401)
+                    if error:
+                        yield format_sse('session_invalidated', {"reason": "expired", "error": error[0]})
+                        return
+                    if current_etag != last_etag:
+                        last_etag = current_etag
+                        yield format_sse('config_changed', {})
+        finally:
+            event_hub.unsubscribe(subscriber)
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # 关闭 Nginx 对事件流的缓冲
+    return response
+
 @app.route('/api/configs', methods=['GET', 'POST'])
 @token_required
 def handle_configs(user):
     db = get_db()
     if request.method == 'GET':
-        configs_cursor=db.execute('SELECT * FROM personal_configs WHERE owner_uuid = ?',(user['uuid'],));personal_configs=[dict(row)for row in configs_cursor];subs_cursor=db.execute('SELECT T1.subscription_id, T1.share_id, T1.user_params_json, T2.share_name, T2.is_template, T2.config_data_json as share_config_json FROM subscriptions T1 JOIN shares T2 ON T1.share_id = T2.share_id WHERE T1.user_uuid = ?',(user['uuid'],));subscriptions=[dict(row)for row in subs_cursor];db.close();return jsonify({'personal_configs':personal_configs,'subscriptions':subscriptions})
+        # 先比较版本号，客户端的缓存仍然有效时直接返回304，不再查询和序列化全部配置
+        etag = get_config_etag(db, user['uuid'])
+        # 同一版本会以 JSON/MessagePack、压缩/未压缩等不同形式发送，逐字节并不相同，只能用弱 ETag
+        if request.if_none_match.contains_weak(etag):
+            response = make_response('', 304)
+            response.set_etag(etag, weak=True)
+            return response
+        # JSON 文本按内容存放在 config_blobs 中，这里解压还原为原来的字段
+        configs_cursor=db.execute('SELECT P.config_id, P.owner_uuid, P.profile_name, P.revision, B.encoding, B.data FROM personal_configs P LEFT JOIN config_blobs B ON B.hash = P.config_blob WHERE P.owner_uuid = ?',(user['uuid'],))
+        personal_configs=[{'config_id':row['config_id'],'owner_uuid':row['owner_uuid'],'profile_name':row['profile_name'],'config_json':decode_blob(row['encoding'],row['data']),'revision':row['revision']}for row in configs_cursor]
+        subs_cursor=db.execute('SELECT T1.subscription_id, T1.share_id, T1.revision, T2.share_name, T2.is_template, PB.encoding AS params_encoding, PB.data AS params_data, SB.encoding AS share_encoding, SB.data AS share_data FROM subscriptions T1 JOIN shares T2 ON T1.share_id = T2.share_id LEFT JOIN config_blobs PB ON PB.hash = T1.user_params_blob LEFT JOIN config_blobs SB ON SB.hash = T2.config_blob WHERE T1.user_uuid = ?',(user['uuid'],))
+        subscriptions=[{'subscription_id':row['subscription_id'],'share_id':row['share_id'],'user_params_json':decode_blob(row['params_encoding'],row['params_data']),'revision':row['revision'],'share_name':row['share_name'],'is_template':row['is_template'],'share_config_json':decode_blob(row['share_encoding'],row['share_data'])}for row in subs_cursor]
+        response = jsonify({'personal_configs':personal_configs,'subscriptions':subscriptions,'etag':quote_etag(etag, weak=True)})
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
     if request.method == 'POST':
+        # 旧版客户端使用的全量同步：删除该用户的所有配置后重新插入
         data=request.get_json();personal_configs=data.get('personal_configs',[]);subscriptions=data.get('subscriptions',{})
-        for config in personal_configs:
-            if'profile_name'in config:config['profile_name']=bleach.clean(config.get('profile_name',''))[:50]
-            if'config_json'in config:
-                try:
-                    config_data=json.loads(config['config_json'])
-                    if'nodes'in config_data:
-                        for node in config_data.get('nodes',[]):
-                            if'remark'in node:node['remark']=bleach.clean(node.get('remark',''))[:50]
-                    if'proxies'in config_data:config_data['proxies']=clean_proxies(config_data.get('proxies',[]))
-                    config['config_json']=json.dumps(config_data)
-                except json.JSONDecodeError:config['config_json']='{}'
+        for config in personal_configs:clean_personal_config(config)
         for sub_id,sub_data in subscriptions.items():
-            if'user_params'in sub_data:
-                user_params=sub_data['user_params']
-                if'proxies'in user_params:user_params['proxies']=clean_proxies(user_params.get('proxies',[]))
-                sub_data['user_params']=user_params
+            if'user_params'in sub_data:sub_data['user_params']=clean_user_params(sub_data['user_params'])
         db.execute('DELETE FROM personal_configs WHERE owner_uuid = ?',(user['uuid'],));db.execute('DELETE FROM subscriptions WHERE user_uuid = ?',(user['uuid'],))
-        for config in personal_configs:db.execute('INSERT INTO personal_configs (config_id, owner_uuid, profile_name, config_json) VALUES (?, ?, ?, ?)',(config['config_id'],user['uuid'],config['profile_name'],config['config_json']))
-        for sub_id,sub_data in subscriptions.items():db.execute('INSERT INTO subscriptions (subscription_id, user_uuid, share_id, user_params_json) VALUES (?, ?, ?, ?)',(sub_id,user['uuid'],sub_data.get('share_id'),json.dumps(sub_data.get('user_params',{}))))
-        db.commit();db.close();return jsonify({"success":True,"message":"配置已成功保存"})
+        for config in personal_configs:db.execute('INSERT INTO personal_configs (config_id, owner_uuid, profile_name, config_json, config_blob) VALUES (?, ?, ?, \'\', ?)',(config['config_id'],user['uuid'],config['profile_name'],store_blob(db,config['config_json'])))
+        for sub_id,sub_data in subscriptions.items():db.execute('INSERT INTO subscriptions (subscription_id, user_uuid, share_id, user_params_blob) VALUES (?, ?, ?, ?)',(sub_id,user['uuid'],sub_data.get('share_id'),store_blob(db,json.dumps(sub_data.get('user_params',{})))))
+        bump_config_revision(db,[user['uuid']]);db.commit();event_hub.publish(user['uuid'],'config_changed');return jsonify({"success":True,"message":"配置已成功保存"})
+
+@app.route('/api/configs', methods=['PATCH'])
+@token_required
+def sync_configs(user):
+    """
+    增量同步配置。客户端只提交新增、修改或删除的条目，每项附带它所基于的 base_revision（新建时为 null）：
+    {"personal_configs": {"upsert": [...], "delete": [...]}, "subscriptions": {"upsert": [...], "delete": [...]}}
+    所有变更在一个事务内执行；任一条目的版本与服务器不一致时整体回滚并返回 409。
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "请求体不能为空"}), 400
+    personal_changes = data.get('personal_configs') or {}
+    subscription_changes = data.get('subscriptions') or {}
+    config_upserts = personal_changes.get('upsert', []); config_deletes = personal_changes.get('delete', [])
+    sub_upserts = subscription_changes.get('upsert', []); sub_deletes = subscription_changes.get('delete', [])
+
+    # 先做格式校验，避免在事务中途才发现请求不合法
+    for config in config_upserts:
+        if not (isinstance(config, dict) and config.get('config_id') and isinstance(config.get('profile_name'), str) and isinstance(config.get('config_json'), str)):
+            return jsonify({"error": "个人配置格式不正确"}), 400
+    for sub in sub_upserts:
+        if not (isinstance(sub, dict) and sub.get('subscription_id') and sub.get('share_id')):
+            return jsonify({"error": "订阅格式不正确"}), 400
+    for item in config_deletes + sub_deletes:
+        if not (isinstance(item, dict) and isinstance(item.get('base_revision'), int)):
+            return jsonify({"error": "删除列表格式不正确"}), 400
+    for item in config_upserts + sub_upserts:
+        if item.get('base_revision') is not None and not isinstance(item.get('base_revision'), int):
+            return jsonify({"error": "base_revision 格式不正确"}), 400
+
+    user_uuid = user['uuid']
+    conflicts = []
+    revisions = {'personal_configs': {}, 'subscriptions': {}}
+
+    def current_revision(query, item_id):
+        row = db.execute(query, (item_id, user_uuid)).fetchone()
+        return row[0] if row else None
+
+    config_revision_query = 'SELECT revision FROM personal_configs WHERE config_id = ? AND owner_uuid = ?'
+    sub_revision_query = 'SELECT revision FROM subscriptions WHERE subscription_id = ? AND user_uuid = ?'
+
+    db = get_db()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        for config in config_upserts:
+            config = clean_personal_config(config)
+            config_id = config['config_id']; base_revision = config.get('base_revision')
+            if base_revision is None:
+                try:
+                    db.execute('INSERT INTO personal_configs (config_id, owner_uuid, profile_name, config_json, config_blob, revision) VALUES (?, ?, ?, \'\', ?, 1)',
+                               (config_id, user_uuid, config['profile_name'], store_blob(db, config['config_json'])))
+                    revisions['personal_configs'][config_id] = 1
+                except sqlite3.IntegrityError:
+                    conflicts.append({"kind": "personal_config", "id": config_id, "current_revision": current_revision(config_revision_query, config_id)})
+            else:
+                cursor = db.execute('UPDATE personal_configs SET profile_name = ?, config_blob = ?, revision = revision + 1 WHERE config_id = ? AND owner_uuid = ? AND revision = ?',
+                                    (config['profile_name'], store_blob(db, config['config_json']), config_id, user_uuid, base_revision))
+                if cursor.rowcount == 0:
+                    conflicts.append({"kind": "personal_config", "id": config_id, "current_revision": current_revision(config_revision_query, config_id)})
+                else:
+                    revisions['personal_configs'][config_id] = base_revision + 1
+
+        for item in config_deletes:
+            config_id = item.get('config_id')
+            cursor = db.execute('DELETE FROM personal_configs WHERE config_id = ? AND owner_uuid = ? AND revision = ?', (config_id, user_uuid, item.get('base_revision')))
+            if cursor.rowcount == 0:
+                # 已经不存在视为删除成功；仍然存在说明被其他设备修改过
+                revision = current_revision(config_revision_query, config_id)
+                if revision is not None:
+                    conflicts.append({"kind": "personal_config", "id": config_id, "current_revision": revision})
+
+        for sub in sub_upserts:
+            sub_id = sub['subscription_id']; base_revision = sub.get('base_revision')
+            user_params_blob = store_blob(db, json.dumps(clean_user_params(sub.get('user_params') or {})))
+            if base_revision is None:
+                try:
+                    db.execute('INSERT INTO subscriptions (subscription_id, user_uuid, share_id, user_params_blob, revision) VALUES (?, ?, ?, ?, 1)',
+                               (sub_id, user_uuid, sub['share_id'], user_params_blob))
+                    revisions['subscriptions'][sub_id] = 1
+                except sqlite3.IntegrityError:
+                    # 主键冲突或所订阅的分享已不存在
+                    conflicts.append({"kind": "subscription", "id": sub_id, "current_revision": current_revision(sub_revision_query, sub_id)})
+            else:
+                cursor = db.execute('UPDATE subscriptions SET user_params_blob = ?, revision = revision + 1 WHERE subscription_id = ? AND user_uuid = ? AND revision = ?',
+                                    (user_params_blob, sub_id, user_uuid, base_revision))
+                if cursor.rowcount == 0:
+                    conflicts.append({"kind": "subscription", "id": sub_id, "current_revision": current_revision(sub_revision_query, sub_id)})
+                else:
+                    revisions['subscriptions'][sub_id] = base_revision + 1
+
+        for item in sub_deletes:
+            sub_id = item.get('subscription_id')
+            cursor = db.execute('DELETE FROM subscriptions WHERE subscription_id = ? AND user_uuid = ? AND revision = ?', (sub_id, user_uuid, item.get('base_revision')))
+            if cursor.rowcount == 0:
+                revision = current_revision(sub_revision_query, sub_id)
+                if revision is not None:
+                    conflicts.append({"kind": "subscription", "id": sub_id, "current_revision": revision})
+
+        if conflicts:
+            db.rollback()
+            app.logger.info(f"用户(uuid:{user_uuid}, name:{user['nickname']})的增量同步因 {len(conflicts)} 处版本冲突被拒绝。")
+            return jsonify({"error": "配置已在其他设备上被修改，请重新加载后再保存。", "conflicts": conflicts}), 409
+        bump_config_revision(db, [user_uuid])
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    event_hub.publish(user_uuid, 'config_changed')
+    return jsonify({"success": True, "message": "配置已成功保存", "revisions": revisions})
 
 @app.route('/api/share/create', methods=['POST'])
 @token_required
 def create_share(user):
-    data=request.get_json();share_name=bleach.clean(data.get('share_name',''))[:50];is_template=data.get('is_template',False);config_data=data.get('config_data')
+    data=request.get_json();share_name=sanitize_text(data.get('share_name') or '',50);is_template=data.get('is_template',False);config_data=data.get('config_data')
     if not(share_name and config_data is not None):return jsonify({"error":"缺少分享名称或配置数据"}),400
-    if isinstance(config_data,dict):
-        if'nodes'in config_data:
-            for node in config_data.get('nodes',[]):
-                if'remark'in node:node['remark']=bleach.clean(node.get('remark',''))[:50]
-        if'proxies'in config_data:config_data['proxies']=clean_proxies(config_data.get('proxies',[]))
-    share_id=f"share-{uuid.uuid4()}";owner_uuid=user['uuid'];config_data_json=json.dumps(config_data);db=get_db()
-    db.execute('INSERT INTO shares (share_id, owner_uuid, share_name, is_template, config_data_json) VALUES (?, ?, ?, ?, ?)',(share_id,owner_uuid,share_name,is_template,config_data_json));db.commit();db.close();return jsonify({"success":True,"share_id":share_id})
+    with subsystem_seconds.time('sanitize'):
+        try:config_data_json=json.dumps(sanitize_config_document(config_data))
+        except ConfigValidationError as e:raise e.prepend('config_data')
+    share_id=f"share-{uuid.uuid4()}";owner_uuid=user['uuid'];db=get_db()
+    db.execute('INSERT INTO shares (share_id, owner_uuid, share_name, is_template, config_data_json, config_blob) VALUES (?, ?, ?, ?, \'\', ?)',(share_id,owner_uuid,share_name,is_template,store_blob(db,config_data_json)));db.commit();return jsonify({"success":True,"share_id":share_id})
 
 @app.route('/api/share/list', methods=['GET'])
 @token_required
-def list_shares(user):db=get_db();shares=db.execute('SELECT share_id, share_name, is_template FROM shares WHERE owner_uuid = ?',(user['uuid'],)).fetchall();db.close();return jsonify([dict(row)for row in shares])
+def list_shares(user):db=get_db();shares=db.execute('SELECT share_id, share_name, is_template FROM shares WHERE owner_uuid = ?',(user['uuid'],)).fetchall();return jsonify([dict(row)for row in shares])
 @app.route('/api/share/revoke', methods=['POST'])
 @token_required
-def revoke_share(user): data = request.get_json(); share_id = data.get('share_id') or abort(make_response(jsonify({"error": "缺少 share_id"}), 400)); db = get_db(); db.execute('DELETE FROM shares WHERE share_id = ? AND owner_uuid = ?', (share_id, user['uuid'])); db.commit(); db.close(); return jsonify({"success": True})
+def revoke_share(user):
+    data = request.get_json(); share_id = data.get('share_id') or abort(make_response(jsonify({"error": "缺少 share_id"}), 400)); db = get_db()
+    # 撤销会级联删除所有订阅，订阅者的配置版本需要随之变化
+    subscriber_uuids = [row[0] for row in db.execute('SELECT DISTINCT T1.user_uuid FROM subscriptions T1 JOIN shares T2 ON T1.share_id = T2.share_id WHERE T2.share_id = ? AND T2.owner_uuid = ?', (share_id, user['uuid']))]
+    cursor = db.execute('DELETE FROM shares WHERE share_id = ? AND owner_uuid = ?', (share_id, user['uuid'])); bump_config_revision(db, subscriber_uuids); db.commit()
+    if cursor.rowcount: share_cache.invalidate(share_id)
+    event_hub.publish_many(subscriber_uuids, 'share_revoked', {"share_id": share_id}); event_hub.publish_many(subscriber_uuids, 'config_changed'); return jsonify({"success": True})
+def get_compiled_share(share_id):
+    """从缓存获取分享的编译结果，未命中时查库编译并写入缓存。分享不存在时返回 None；配置损坏时抛出 json.JSONDecodeError。"""
+    compiled = share_cache.get(share_id)
+    if compiled is None:
+        generation = share_cache.generation()
+        share = get_db().execute('SELECT S.share_name, S.is_template, B.encoding, B.data FROM shares S LEFT JOIN config_blobs B ON B.hash = S.config_blob WHERE S.share_id = ?', (share_id,)).fetchone()
+        if not share:
+            return None
+        compiled = CompiledShare(share_id, share['share_name'], share['is_template'], decode_blob(share['encoding'], share['data']) or '{}')
+        share_cache.put(compiled, generation)
+    return compiled
+
+def get_compiled_shares(share_ids):
+    """
+    get_compiled_share 的批量版本：缓存命中的直接使用，其余用一条 IN (...) 查询取出并编译。
+    返回 ({share_id: CompiledShare}, [配置已损坏的 share_id])，不存在的分享两者都不包含。
+    """
+    found = {}; corrupted = []; missing = []
+    for share_id in share_ids:
+        compiled = share_cache.get(share_id)
+        if compiled is not None: found[share_id] = compiled
+        else: missing.append(share_id)
+    if missing:
+        generation = share_cache.generation()
+        placeholders = ','.join('?' * len(missing))
+        rows = get_db().execute(f'SELECT S.share_id, S.share_name, S.is_template, B.encoding, B.data FROM shares S LEFT JOIN config_blobs B ON B.hash = S.config_blob WHERE S.share_id IN ({placeholders})', missing)
+        for share in rows:
+            try:
+                compiled = CompiledShare(share['share_id'], share['share_name'], share['is_template'], decode_blob(share['encoding'], share['data']) or '{}')
+            except json.JSONDecodeError:
+                corrupted.append(share['share_id']); continue
+            share_cache.put(compiled, generation)
+            found[share['share_id']] = compiled
+    return found, corrupted
+
+@app.route('/api/share/public_info', methods=['POST'])
+@limiter.limit("20/minute")
+def get_shares_public_info():
+    """一次查询多个分享的公开信息，用于批量订阅。请求体 {"share_ids": [...]}"""
+    data = request.get_json(silent=True)
+    share_ids = data.get('share_ids') if isinstance(data, dict) else None
+    if not isinstance(share_ids, list) or not share_ids or not all(isinstance(share_id, str) and share_id for share_id in share_ids):
+        return jsonify({"error": "share_ids 必须是非空的字符串数组"}), 400
+    share_ids = list(dict.fromkeys(share_ids)) # 去重并保持顺序
+    if len(share_ids) > SHARE_BATCH_MAX_IDS:
+        return jsonify({"error": f"一次最多查询 {SHARE_BATCH_MAX_IDS} 个分享"}), 400
+    found, corrupted = get_compiled_shares(share_ids)
+    return jsonify({
+        "shares": {share_id: found[share_id].public_info for share_id in share_ids if share_id in found},
+        "missing": [share_id for share_id in share_ids if share_id not in found and share_id not in corrupted],
+        "corrupted": corrupted,
+    })
+
 @app.route('/api/share/get_public_info/<string:share_id>', methods=['GET'])
 def get_share_public_info(share_id):
-    db=get_db();share=db.execute('SELECT share_name, is_template, config_data_json FROM shares WHERE share_id = ?',(share_id,)).fetchone();db.close()
-    if not share:return jsonify({"error":"分享不存在或已撤销"}),404
-    config_data=json.loads(share['config_data_json']);public_info={"share_name":share['share_name'],"is_template":share['is_template']}
-    if share['is_template']:public_info['nodes']=[{"remark":node.get("remark"),"server_addr":node.get("server_addr"),"server_port":node.get("server_port")}for node in config_data.get('nodes',[])]
-    return jsonify(public_info)
+    try: compiled = get_compiled_share(share_id)
+    except json.JSONDecodeError: return jsonify({"error": "分享配置已损坏"}), 500
+    if not compiled: return jsonify({"error": "分享不存在或已撤销"}), 404
+    if request.if_none_match.contains_weak(compiled.etag):
+        response = make_response('', 304)
+    else:
+        response = jsonify(compiled.public_info)
+    # 分享随时可能被撤销，客户端每次都要回源校验。响应体按协商的格式和压缩方式变换，使用弱 ETag
+    response.set_etag(compiled.etag, weak=True); response.headers['Cache-Control'] = 'no-cache'
+    return response
 @app.route('/api/share/use', methods=['POST'])
 def use_share():
     data = request.get_json()
@@ -546,149 +1145,137 @@ def use_share():
     if not share_id:
         return jsonify({"error": "缺少share_id"}), 400
 
-    db = get_db()
-    share = db.execute('SELECT is_template, config_data_json FROM shares WHERE share_id = ?', (share_id,)).fetchone()
-    db.close()
-    if not share:
-        return jsonify({"error": "分享不存在或已撤销"}), 404
-
     try:
-        config_data = json.loads(share['config_data_json'])
+        compiled = get_compiled_share(share_id)
     except json.JSONDecodeError:
         return jsonify({"error": "分享配置已损坏"}), 500
+    if not compiled:
+        return jsonify({"error": "分享不存在或已撤销"}), 404
 
-    # 使用有序字典来保证最终TOML的结构顺序
-    final_config = OrderedDict()
-
-    if share['is_template']:
-        # --- 分支一：处理模板分享 ---
-        selected_node_remark = user_params.get('node_remark')
-        if not selected_node_remark:
-            return jsonify({"error": "模板分享需要选择一个节点"}), 400
-        
-        selected_node_info = next((n for n in config_data.get('nodes', []) if n.get('remark') == selected_node_remark), None)
-        if not selected_node_info:
-            return jsonify({"error": f"选择的节点 '{selected_node_remark}' 无效"}), 400
-            
-        # a. 按顺序填充服务器信息
-        final_config['serverAddr'] = str(selected_node_info.get('server_addr', ''))
-        final_config['serverPort'] = int(selected_node_info.get('server_port', 0))
-        final_config['auth'] = {'token': str(selected_node_info.get('token', ''))}
-        
-        # b. 对客户端传来的代理规则进行清洗和转换
-        final_proxies = []
-        for p_in in user_params.get('proxies', []):
-            p_out = {}
-            p_out['name'] = p_in.get('name')
-            p_out['type'] = p_in.get('type')
-            if not all([p_out['name'], p_out['type']]): continue
-            
-            p_out['localIP'] = p_in.get('local_ip', '127.0.0.1')
-            p_out['localPort'] = int(p_in.get('local_port', 0))
-            if p_out['type'] in ['http', 'https']:
-                if p_in.get('custom_domains'): p_out['custom_domains'] = [d.strip() for d in str(p_in['custom_domains']).split(',') if d.strip()]
-            else:
-                p_out['remotePort'] = int(p_in.get('remote_port', 0))
-            final_proxies.append(p_out)
-            
-        if final_proxies:
-            final_config['proxies'] = final_proxies
-            
-    else:
-        # --- 分支二：处理完整分享 ---
-        # a. 按顺序填充服务器信息，兼容多种键名
-        final_config['serverAddr'] = str(config_data.get('serverAddr', config_data.get('server_addr', '')))
-        final_config['serverPort'] = int(config_data.get('serverPort', config_data.get('server_port', 0)))
-        auth_info = config_data.get('auth', {})
-        final_config['auth'] = {'token': str(auth_info.get('token', ''))}
-        
-        # b. 对数据库中的代理规则进行清洗和转换
-        final_proxies = []
-        for p_in in config_data.get('proxies', []):
-            p_out = {}
-            p_out['name'] = p_in.get('name')
-            p_out['type'] = p_in.get('type')
-            if not all([p_out['name'], p_out['type']]): continue
-
-            p_out['localIP'] = p_in.get('localIP', p_in.get('local_ip', '127.0.0.1'))
-            try: p_out['localPort'] = int(p_in.get('localPort', p_in.get('local_port', 0)))
-            except (ValueError, TypeError): p_out['localPort'] = 0
-
-            if p_out['type'] in ['http', 'https']:
-                custom_domains_val = p_in.get('custom_domains', [])
-                if isinstance(custom_domains_val, str): p_out['custom_domains'] = [d.strip() for d in custom_domains_val.split(',') if d.strip()]
-                else: p_out['custom_domains'] = custom_domains_val
-            else:
-                try: p_out['remotePort'] = int(p_in.get('remotePort', p_in.get('remote_port', 0)))
-                except (ValueError, TypeError): p_out['remotePort'] = 0
-            
-            final_proxies.append(p_out)
-
-        if final_proxies:
-            final_config['proxies'] = final_proxies
-
-    # 最终检查
-    if not final_config or not final_config.get('serverAddr'):
+    if compiled.is_template:
+        # --- 分支一：模板分享，结果取决于用户参数，每次现场填充 ---
+        try:
+            final_toml_data = compile_template_share(compiled, user_params)
+        except ShareCompileError as e:
+            return jsonify({"error": str(e)}), 400
+        if not final_toml_data:
+            return jsonify({"error": "生成最终配置失败"}), 500
+        return jsonify({"final_toml_data": final_toml_data})
+
+    # --- 分支二：完整分享，直接返回缓存中预编译好的结果 ---
+    if not compiled.final_toml_data:
         return jsonify({"error": "生成最终配置失败"}), 500
-
-    return jsonify({"final_toml_data": dict(final_config)}) # 返回时转回普通dict
-# 接口 1：申请配置票据
-@app.route('/api/request_config_ticket', methods=['POST'])
-@token_required
-def request_config_ticket(user):
+    if request.if_none_match.contains_weak(compiled.etag):
+        response = make_response('', 304)
+    else:
+        response = jsonify({"final_toml_data": compiled.final_toml_data, "etag": quote_etag(compiled.etag, weak=True)})
+    response.set_etag(compiled.etag, weak=True)
+    return response
+def acquire_ticket_slot(user):
     """
-    为用户申请配置票据，并实现每个用户5秒一次的速率限制。
+    票据的每用户速率限制。通过时记录本次申请时间并返回 None，否则返回 429 响应。
     """
-    # ----------------------------------------------------
-    # 速率限制检查逻辑
-    # ----------------------------------------------------
     user_uuid = user['uuid']
     current_time = datetime.datetime.now(datetime.timezone.utc)
     
-    with rate_limit_lock:
+    with rate_limit_tracker.transaction():
         last_request_time = rate_limit_tracker.get(user_uuid)
 
-        # 如果该用户有过请求记录
+        # 如果该用户在限速窗口内有过请求记录（超过3秒的记录已自动过期）
         if last_request_time:
             time_since_last_request = (current_time - last_request_time).total_seconds()
             
             # 检查时间间隔是否小于3秒
-            if time_since_last_request < 3.0:
-                wait_time = 3.0 - time_since_last_request
+            if time_since_last_request < TICKET_RATE_LIMIT_SECONDS:
+                wait_time = TICKET_RATE_LIMIT_SECONDS - time_since_last_request
                 app.logger.warning(f"用户 '{user['nickname']}' (UUID: {user_uuid}) 触发速率限制，需等待 {wait_time:.1f} 秒。")
+                ticket_outcomes_total.inc('rate_limited')
                 # 返回一个 429 Too Many Requests 错误，并告知需要等待的时间
                 return jsonify({"error": f"请求过于频繁，请在 {wait_time:.1f} 秒后重试。"}), 429
         
         # 如果检查通过，更新该用户的最后请求时间
-        rate_limit_tracker[user_uuid] = current_time
-    # ----------------------------------------------------
-
-    data = request.get_json()
-    config_content = data.get('config_content')
-    if not config_content:
-        # 如果因为错误请求导致没有内容，最好将刚才记录的时间戳回滚，允许用户立即重试
-        with rate_limit_lock:
-            if user_uuid in rate_limit_tracker:
-                 del rate_limit_tracker[user_uuid]
-        return jsonify({"error": "缺少配置内容"}), 400
+        rate_limit_tracker.set(user_uuid, current_time)
+    return None
 
+def issue_config_ticket(user, config_content):
+    """保存配置内容并返回一次性票据的ID，frpc 凭它从 get_temp_config 取回配置"""
     config_id = str(uuid.uuid4())
     
-    with configs_lock:
-        one_time_configs[config_id] = {
-            "content": config_content,
-            "expires_at": datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=10),
-            "uses_left": 2,
-            "history": [],
-            "first_use_time": None
-        }
+    one_time_configs.set(config_id, {
+        "content": config_content,
+        "expires_at": datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=TICKET_LIFETIME_SECONDS),
+        "uses_left": 2,
+        "history": [],
+        "first_use_time": None
+    })
+    ticket_outcomes_total.inc('issued')
     
     app.logger.info(
         f"为用户(uuid:{user['uuid']}, name:{user['nickname']}) "
         f"创建了配置票据(ID: {config_id})"
     )
+    return config_id
+
+# 接口 1：申请配置票据
+@app.route('/api/request_config_ticket', methods=['POST'])
+@token_required
+def request_config_ticket(user):
+    """
+    为用户申请配置票据，并实现每个用户5秒一次的速率限制。
+    """
+    rejection = acquire_ticket_slot(user)
+    if rejection:
+        return rejection
+
+    data = request.get_json()
+    config_content = data.get('config_content')
+    if not config_content:
+        # 如果因为错误请求导致没有内容，最好将刚才记录的时间戳回滚，允许用户立即重试
+        rate_limit_tracker.delete(user['uuid'])
+        return jsonify({"error": "缺少配置内容"}), 400
+
+    config_id = issue_config_ticket(user, config_content)
     return jsonify({"success": True, "config_id": config_id})
 
+@app.route('/api/share/launch', methods=['POST'])
+@token_required
+def launch_share(user):
+    """
+    编译分享并直接签发配置票据：服务器渲染好 frpc 的 TOML 放进票据，
+    客户端不必先取回配置、再渲染上传，启动少一次往返。限速与 request_config_ticket 共用。
+    返回的 config_summary 只含服务器地址和代理规则（不含认证令牌），供客户端解析 frpc 日志。
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not data.get('share_id'):
+        return jsonify({"error": "缺少share_id"}), 400
+    user_params = data.get('user_params') or {}
+    if not isinstance(user_params, dict):
+        return jsonify({"error": "user_params 格式不正确"}), 400
+
+    try:
+        compiled = get_compiled_share(data['share_id'])
+    except json.JSONDecodeError:
+        return jsonify({"error": "分享配置已损坏"}), 500
+    if not compiled:
+        return jsonify({"error": "分享不存在或已撤销"}), 404
+
+    if compiled.is_template:
+        try:
+            final_toml_data = compile_template_share(compiled, user_params)
+        except ShareCompileError as e:
+            return jsonify({"error": str(e)}), 400
+        config_content = render_frpc_toml(final_toml_data) if final_toml_data else None
+    else:
+        final_toml_data, config_content = compiled.final_toml_data, compiled.final_toml_text
+    if not config_content:
+        return jsonify({"error": "生成最终配置失败"}), 500
+
+    rejection = acquire_ticket_slot(user)
+    if rejection:
+        return rejection
+    config_id = issue_config_ticket(user, config_content)
+    return jsonify({"success": True, "config_id": config_id, "config_summary": frpc_config_summary(final_toml_data)})
+
 # 接口 2：凭票据获取配置
 @app.route('/api/get_temp_config/<string:config_id>', methods=['GET'])
 def get_temp_config(config_id):
@@ -697,10 +1284,11 @@ def get_temp_config(config_id):
     1. 全局生命周期不超过10秒。
     2. 首次使用后，第二次使用必须在3秒内完成。
     """
-    with configs_lock:
+    with one_time_configs.transaction():
         config_data = one_time_configs.get(config_id)
 
         if not config_data:
+            ticket_outcomes_total.inc('not_found')
             return "Configuration not found, expired, or already used.", 404
 
         current_time = datetime.datetime.now(datetime.timezone.utc)
@@ -711,7 +1299,8 @@ def get_temp_config(config_id):
             history_log = ", ".join([f"于{h['time'].strftime('%H:%M:%S')}被IP {h['ip']} 使用" for h in config_data.get('history', [])])
             if not history_log: history_log = "但从未使用过"
             app.logger.warning(f"对已超时的票据(ID: {config_id})的访问被拒绝。该票据的历史: {history_log}。")
-            del one_time_configs[config_id]
+            one_time_configs.delete(config_id)
+            ticket_outcomes_total.inc('expired')
             return "Configuration link has expired.", 410
 
         # ----------------------------------------------------
@@ -728,7 +1317,8 @@ def get_temp_config(config_id):
                 # 如果超过2秒仍未进行第二次使用，则票据失效
                 history_log = f"于{first_use_time.strftime('%H:%M:%S')}被IP {config_data['history'][0]['ip']} 首次使用"
                 app.logger.warning(f"票据(ID: {config_id})因首次使用后超时而被拒绝。历史: {history_log}。")
-                del one_time_configs[config_id]
+                one_time_configs.delete(config_id)
+                ticket_outcomes_total.inc('second_use_timeout')
                 return "Secondary use window for configuration link has expired.", 410
         # ----------------------------------------------------
 
@@ -751,6 +1341,7 @@ def get_temp_config(config_id):
             # 在服务器日志中记录本次成功使用
             use_count = len(config_data['history'])
             app.logger.info(f"票据(ID: {config_id})被IP {request.remote_addr} 成功使用第 {use_count} 次。")
+            ticket_outcomes_total.inc('served')
             
             content = config_data['content']
             response = make_response(content)
@@ -758,7 +1349,10 @@ def get_temp_config(config_id):
             
             if config_data['uses_left'] == 0:
                 app.logger.info(f"票据(ID: {config_id})已用尽，将被删除。")
-                del one_time_configs[config_id]
+                one_time_configs.delete(config_id)
+            else:
+                # 写回剩余次数和使用记录（共享存储中取出的是副本）
+                one_time_configs.replace(config_id, config_data)
 
             return response
         else:
@@ -767,34 +1361,85 @@ def get_temp_config(config_id):
             history_log = ", ".join([f"于{h['time'].strftime('%H:%M:%S')}被IP {h['ip']} 使用" for h in config_data.get('history', [])])
             app.logger.error(f"对已用尽次数的票据(ID: {config_id})的异常访问！访问IP: {request.remote_addr}。该票据的历史: {history_log}。")
 
-            if config_id in one_time_configs:
-                del one_time_configs[config_id]
+            one_time_configs.delete(config_id)
+            ticket_outcomes_total.inc('exhausted')
             return "Configuration not found, expired, or already used.", 404
             
-def cleanup_rate_limit_tracker():
-    while True:
-        # 每隔5分钟清理一次
-        time.sleep(300) 
-        with rate_limit_lock:
-            current_time = datetime.datetime.now(datetime.timezone.utc)
-            # 找出所有超过15分钟未活动的用户的UUID
-            keys_to_delete = [
-                uuid for uuid, last_time in rate_limit_tracker.items()
-                if (current_time - last_time).total_seconds() > 900 # 15分钟
-            ]
-            
-            # 删除这些记录
-            for key in keys_to_delete:
-                del rate_limit_tracker[key]
-            
-            if keys_to_delete:
-                app.logger.info(f"后台清理：移除了 {len(keys_to_delete)} 个旧的速率限制记录。")
+# --- 后台维护 ---
+# 任务名: (间隔秒数, 单次执行的时间预算秒数)。间隔设为 0 即停用该任务
+MAINTENANCE_SCHEDULE = {
+    "ephemeral_stores": (60, 1.0),         # 回收临时存储中过期条目的内存（写入时已会顺带清理）
+    "expired_reset_tokens": (600, 2.0),    # 删除过期的密码重置令牌
+    "expired_sessions": (600, 2.0),        # 清除早已过期的会话令牌
+    "wal_checkpoint": (300, 5.0),
+    "optimize": (3600, 5.0),
+    "analyze": (86400, 30.0),
+    "incremental_vacuum": (86400, 10.0),
+}
+MAINTENANCE_JITTER = 0.1            # 每次间隔在 ±10% 内随机浮动
+MAINTENANCE_BATCH_SIZE = 500        # 每个写事务最多处理的行数，控制写锁的持有时间
+SESSION_PURGE_GRACE_SECONDS = 3600  # 会话过期超过这么久才清除，不与尚未写回的续期竞争
+
+maintenance_seconds = metrics.histogram('moefrp_maintenance_duration_seconds', '后台维护任务每次执行的耗时', ('job',),
+                                        buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+maintenance_runs_total = metrics.counter('moefrp_maintenance_runs_total', '后台维护任务的执行次数，按结果区分', ('job', 'outcome'))
+maintenance_items_total = metrics.counter('moefrp_maintenance_items_total', '后台维护任务处理的条目数（删除的行、检查点写回的页等）', ('job',))
+
+def observe_maintenance(job, duration, outcome, items):
+    maintenance_seconds.observe(duration, job)
+    maintenance_runs_total.inc(job, outcome)
+    if items:
+        maintenance_items_total.inc(job, amount=items)
+
+def sweep_ephemeral_stores(context):
+    total = 0
+    for store in EPHEMERAL_STORES:
+        removed = store.sweep()
+        if removed:
+            app.logger.info(f"后台清理：从 {store.name} 中移除了 {removed} 个过期条目。")
+        total += removed
+    return total
+
+def purge_expired_reset_tokens(context):
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    removed = delete_in_batches(context,
+        "SELECT rowid FROM password_reset_tokens WHERE expires_at < ? LIMIT ?",
+        "DELETE FROM password_reset_tokens WHERE expires_at < ? AND rowid = ?",
+        (now,), MAINTENANCE_BATCH_SIZE)
+    if removed:
+        app.logger.info(f"后台维护：删除了 {removed} 个过期的密码重置令牌。")
+    return removed
+
+def purge_expired_sessions(context):
+    cutoff = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=SESSION_PURGE_GRACE_SECONDS)).isoformat()
+    cleared = delete_in_batches(context,
+        "SELECT rowid FROM users WHERE current_session_token IS NOT NULL AND session_token_expiry < ? LIMIT ?",
+        "UPDATE users SET current_session_token = NULL, session_token_expiry = NULL WHERE session_token_expiry < ? AND rowid = ?",
+        (cutoff,), MAINTENANCE_BATCH_SIZE)
+    if cleared:
+        app.logger.info(f"后台维护：清除了 {cleared} 个过期的会话令牌。")
+    return cleared
+
+maintenance_scheduler = MaintenanceScheduler(db_pool, jitter=MAINTENANCE_JITTER, observer=observe_maintenance, logger=app.logger)
+for job_name, job_func, uses_db in [
+    ("ephemeral_stores", sweep_ephemeral_stores, False),
+    ("expired_reset_tokens", purge_expired_reset_tokens, True),
+    ("expired_sessions", purge_expired_sessions, True),
+    ("wal_checkpoint", wal_checkpoint, True),
+    ("optimize", optimize, True),
+    ("analyze", analyze, True),
+    ("incremental_vacuum", IncrementalVacuum(logger=app.logger), True),
+]:
+    interval_seconds, budget_seconds = MAINTENANCE_SCHEDULE[job_name]
+    maintenance_scheduler.add(job_name, job_func, interval_seconds, budget_seconds, uses_db)
+
+@app.before_request
+def start_maintenance():
+    # 首个请求到来时启动，这样由 WSGI 服务器加载时也会运行；之后只是一次属性检查
+    maintenance_scheduler.start()
 
 if __name__ == '__main__':
     init_db()
-    
-    # 【可选但推荐】启动后台清理线程
-    cleanup_thread = threading.Thread(target=cleanup_rate_limit_tracker, daemon=True)
-    cleanup_thread.start()
+    maintenance_scheduler.start()
     
     app.run(host='127.0.0.1', port=5000)
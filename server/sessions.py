@@ -0,0 +1,184 @@
+# sessions.py
+# 会话令牌的内存缓存，以及会话滑动续期的后台批量写入器
+
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class SessionCache:
+    """
+    按会话令牌缓存已认证用户的 LRU + TTL 内存缓存。
+    命中时 token_required 无需查询数据库；TTL 保证管理工具直接改库（如删除用户）后，缓存最多滞后 ttl_seconds 秒。
+    多进程部署时传入 invalidations（stores.SharedInvalidations）：某个进程中注销、登录顶替或重置密码后，
+    其他进程每隔 poll_interval 秒取回一次变化的用户，只丢弃这些用户的缓存，而不是继续接受旧令牌直到 TTL 到期。
+
+    未命中时调用方先用 begin_load() 取得标记再查库，put() 时带上它：查库期间该用户的会话被失效过，
+    读到的就可能是已经作废的令牌，这次结果不写入缓存。
+    """
+    def __init__(self, max_entries=10000, ttl_seconds=60, invalidations=None, poll_interval=0.5):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.invalidations = invalidations
+        self.poll_interval = poll_interval
+        self._entries = OrderedDict()   # token -> (user, expiry_time, cached_at)
+        self._token_by_user = {}        # user_uuid -> token，每个用户同一时间只有一个有效会话
+        self._shared_seq = None         # 已处理到的共享失效序号
+        self._next_poll = 0.0
+        self._poll_lock = threading.Lock()
+        self._invalidation_seq = 0          # 每次失效加一
+        self._invalidated_at = OrderedDict() # user_uuid -> 最近一次失效时的序号，按序号从小到大排列
+        self._forgotten_seq = 0             # 因数量上限被移出 _invalidated_at 的最大序号
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        """返回 (user, expiry_time)，未命中或已超过TTL时返回 None。"""
+        if self.invalidations is not None and time.monotonic() >= self._next_poll:
+            self._poll_invalidations()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            user, expiry_time, cached_at = entry
+            if time.monotonic() - cached_at > self.ttl_seconds:
+                self._remove(token)
+                return None
+            self._entries.move_to_end(token)
+            return user, expiry_time
+
+    def begin_load(self):
+        """缓存未命中、查询数据库之前调用，返回值作为 put() 的 loaded_at。"""
+        with self._lock:
+            return self._invalidation_seq
+
+    def put(self, token, user, expiry_time, loaded_at=None):
+        with self._lock:
+            if loaded_at is not None and (loaded_at < self._forgotten_seq or self._invalidated_at.get(user['uuid'], 0) > loaded_at):
+                return # 查库之后该用户的会话已被失效，读到的结果可能已经过时
+            old_token = self._token_by_user.get(user['uuid'])
+            if old_token is not None and old_token != token:
+                self._entries.pop(old_token, None)
+            self._entries[token] = (user, expiry_time, time.monotonic())
+            self._entries.move_to_end(token)
+            self._token_by_user[user['uuid']] = token
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def update_expiry(self, token, expiry_time):
+        """续期后更新缓存中的过期时间（不刷新TTL，缓存仍会按时回源校验）。"""
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None:
+                self._entries[token] = (entry[0], expiry_time, entry[2])
+
+    def invalidate_token(self, token):
+        with self._lock:
+            self._remove(token)
+
+    def invalidate_user(self, user_uuid):
+        """登录、退出或重置密码后（数据库已提交）调用，丢弃该用户的缓存会话，并通知其他进程。"""
+        with self._lock:
+            self._invalidate_local(user_uuid)
+        if self.invalidations is not None:
+            self.invalidations.publish(user_uuid)
+
+    def _poll_invalidations(self):
+        """取回其他进程发布的失效并丢弃对应用户的缓存。同一时间只有一个线程查询，其余线程不等待。"""
+        if not self._poll_lock.acquire(blocking=False):
+            return
+        try:
+            current, user_uuids = self.invalidations.changes_since(self._shared_seq)
+            with self._lock:
+                if self._shared_seq is not None and current < self._shared_seq:
+                    # 共享库被删除重建，不知道期间有哪些用户失效，丢弃全部缓存，正在查库的请求也不写入
+                    self._entries.clear()
+                    self._token_by_user.clear()
+                    self._invalidation_seq += 1
+                    self._forgotten_seq = self._invalidation_seq
+                for user_uuid in user_uuids:
+                    self._invalidate_local(user_uuid)
+                self._shared_seq = current
+            self._next_poll = time.monotonic() + self.poll_interval
+        finally:
+            self._poll_lock.release()
+
+    def _invalidate_local(self, user_uuid):
+        self._invalidation_seq += 1
+        self._invalidated_at[user_uuid] = self._invalidation_seq
+        self._invalidated_at.move_to_end(user_uuid)
+        while len(self._invalidated_at) > self.max_entries:
+            _, self._forgotten_seq = self._invalidated_at.popitem(last=False)
+        token = self._token_by_user.get(user_uuid)
+        if token is not None:
+            self._remove(token)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, token):
+        entry = self._entries.pop(token, None)
+        if entry is not None and self._token_by_user.get(entry[0]['uuid']) == token:
+            del self._token_by_user[entry[0]['uuid']]
+
+
+class SessionExpiryWriter:
+    """
+    会话滑动续期的后台批量写入器 (write-behind)。
+    请求线程只登记新的过期时间，由后台线程每隔 flush_interval 秒用一个事务批量写回数据库。
+    """
+    def __init__(self, pool, flush_interval=5.0, logger=None):
+        self.pool = pool
+        self.flush_interval = flush_interval
+        self.logger = logger or logging.getLogger(__name__)
+        self._pending = {}  # token -> (user_uuid, expiry_time)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def schedule(self, user_uuid, token, expiry_time):
+        with self._lock:
+            self._pending[token] = (user_uuid, expiry_time)
+            if self._thread is None:
+                # 首次使用时再启动线程，这样无论以何种方式部署（直接运行或WSGI服务器）都能工作
+                self._thread = threading.Thread(target=self._run, name="session-expiry-writer", daemon=True)
+                self._thread.start()
+
+    def pending_expiry(self, token):
+        """返回尚未写回数据库的续期时间，供缓存未命中时与库中的旧值比较。"""
+        with self._lock:
+            pending = self._pending.get(token)
+        return pending[1] if pending else None
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return 0
+        db = self.pool.acquire()
+        try:
+            # 只续期仍然有效的那个会话，避免把已在别处重新登录或已退出的旧令牌写回
+            db.executemany(
+                'UPDATE users SET session_token_expiry = ? WHERE uuid = ? AND current_session_token = ?',
+                [(expiry_time.isoformat(), user_uuid, token) for token, (user_uuid, expiry_time) in batch.items()]
+            )
+            db.commit()
+        except sqlite3.Error:
+            # 写入失败时放回队列等待下次重试，但不覆盖期间登记的更新续期
+            with self._lock:
+                for token, pending in batch.items():
+                    self._pending.setdefault(token, pending)
+            raise
+        finally:
+            self.pool.release(db)
+        return len(batch)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                count = self.flush()
+                if count:
+                    self.logger.info(f"Session expiry writer flushed {count} renewals.")
+            except Exception as e:
+                self.logger.error(f"会话续期批量写入失败: {e}", exc_info=True)
@@ -0,0 +1,196 @@
+# shares.py
+# 分享配置的编译与缓存：解析后的配置、完整分享预编译好的 final_toml_data、公开信息投影
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import toml
+
+
+class ShareCompileError(Exception):
+    """用户参数无效（如模板分享未选择节点），调用方应返回 400。"""
+
+
+class CompiledShare:
+    """一个分享的编译结果。分享创建后内容不可修改，因此编译结果在撤销之前一直有效。"""
+    __slots__ = ('share_id', 'share_name', 'is_template', 'nodes_by_remark', 'public_info', 'final_toml_data', 'final_toml_text', 'etag')
+
+    def __init__(self, share_id, share_name, is_template, config_data_json):
+        self.share_id = share_id
+        self.share_name = share_name
+        self.is_template = is_template
+        config_data = json.loads(config_data_json)
+        self.etag = hashlib.sha256(f"{share_name}\0{is_template}\0{config_data_json}".encode('utf-8')).hexdigest()[:20]
+
+        self.public_info = {"share_name": share_name, "is_template": is_template}
+        if is_template:
+            nodes = config_data.get('nodes', [])
+            # 同名节点保留第一个，与原来 next(...) 的查找结果一致
+            self.nodes_by_remark = {}
+            for node in nodes:
+                self.nodes_by_remark.setdefault(node.get('remark'), node)
+            self.public_info['nodes'] = [{"remark": node.get("remark"), "server_addr": node.get("server_addr"), "server_port": node.get("server_port")} for node in nodes]
+            self.final_toml_data = None
+            self.final_toml_text = None
+        else:
+            self.nodes_by_remark = None
+            self.final_toml_data = compile_full_share(config_data)
+            # 一键启动时直接放进票据的 frpc 配置文本
+            self.final_toml_text = render_frpc_toml(self.final_toml_data) if self.final_toml_data else None
+
+
+def compile_full_share(config_data):
+    """把完整分享的配置转换为 frpc 的 TOML 结构。缺少服务器地址时返回 None。"""
+    # 使用有序字典来保证最终TOML的结构顺序
+    final_config = OrderedDict()
+    # a. 按顺序填充服务器信息，兼容多种键名
+    final_config['serverAddr'] = str(config_data.get('serverAddr', config_data.get('server_addr', '')))
+    final_config['serverPort'] = int(config_data.get('serverPort', config_data.get('server_port', 0)))
+    auth_info = config_data.get('auth', {})
+    final_config['auth'] = {'token': str(auth_info.get('token', ''))}
+
+    # b. 对数据库中的代理规则进行清洗和转换
+    final_proxies = []
+    for p_in in config_data.get('proxies', []):
+        p_out = {}
+        p_out['name'] = p_in.get('name')
+        p_out['type'] = p_in.get('type')
+        if not all([p_out['name'], p_out['type']]): continue
+
+        p_out['localIP'] = p_in.get('localIP', p_in.get('local_ip', '127.0.0.1'))
+        try: p_out['localPort'] = int(p_in.get('localPort', p_in.get('local_port', 0)))
+        except (ValueError, TypeError): p_out['localPort'] = 0
+
+        if p_out['type'] in ['http', 'https']:
+            custom_domains_val = p_in.get('custom_domains', [])
+            if isinstance(custom_domains_val, str): p_out['custom_domains'] = [d.strip() for d in custom_domains_val.split(',') if d.strip()]
+            else: p_out['custom_domains'] = custom_domains_val
+        else:
+            try: p_out['remotePort'] = int(p_in.get('remotePort', p_in.get('remote_port', 0)))
+            except (ValueError, TypeError): p_out['remotePort'] = 0
+
+        final_proxies.append(p_out)
+
+    if final_proxies:
+        final_config['proxies'] = final_proxies
+
+    # 最终检查
+    if not final_config.get('serverAddr'):
+        return None
+    return dict(final_config) # 转回普通dict
+
+
+def render_frpc_toml(final_config):
+    """渲染交给 frpc 的 TOML 文本，与客户端启动在线配置时的处理一致（追加日志级别后用 toml.dumps）。"""
+    config = dict(final_config)
+    config['log'] = {'level': 'info'}
+    return toml.dumps(config)
+
+
+def frpc_config_summary(final_config):
+    """客户端解析 frpc 日志所需的部分：服务器地址和代理规则，不含认证令牌。"""
+    return {"serverAddr": final_config.get('serverAddr'), "serverPort": final_config.get('serverPort'), "proxies": final_config.get('proxies', [])}
+
+
+def compile_template_share(compiled, user_params):
+    """用用户选择的节点和代理规则填充模板分享。参数无效时抛出 ShareCompileError。"""
+    selected_node_remark = user_params.get('node_remark')
+    if not selected_node_remark:
+        raise ShareCompileError("模板分享需要选择一个节点")
+
+    selected_node_info = compiled.nodes_by_remark.get(selected_node_remark)
+    if not selected_node_info:
+        raise ShareCompileError(f"选择的节点 '{selected_node_remark}' 无效")
+
+    final_config = OrderedDict()
+    # a. 按顺序填充服务器信息
+    final_config['serverAddr'] = str(selected_node_info.get('server_addr', ''))
+    try:
+        final_config['serverPort'] = int(selected_node_info.get('server_port', 0))
+    except (TypeError, ValueError):
+        raise ShareCompileError(f"节点 '{selected_node_remark}' 的端口格式不正确")
+    final_config['auth'] = {'token': str(selected_node_info.get('token', ''))}
+
+    # b. 对客户端传来的代理规则进行清洗和转换
+    try:
+        final_proxies = _compile_user_proxies(user_params.get('proxies', []))
+    except (TypeError, ValueError, AttributeError):
+        raise ShareCompileError("代理规则格式不正确（每条规则须为对象，端口须为数字）")
+
+    if final_proxies:
+        final_config['proxies'] = final_proxies
+
+    if not final_config.get('serverAddr'):
+        return None
+    return dict(final_config)
+
+
+def _compile_user_proxies(proxies):
+    final_proxies = []
+    for p_in in proxies:
+        p_out = {}
+        p_out['name'] = p_in.get('name')
+        p_out['type'] = p_in.get('type')
+        if not all([p_out['name'], p_out['type']]): continue
+
+        p_out['localIP'] = p_in.get('local_ip', '127.0.0.1')
+        p_out['localPort'] = int(p_in.get('local_port', 0))
+        if p_out['type'] in ['http', 'https']:
+            if p_in.get('custom_domains'): p_out['custom_domains'] = [d.strip() for d in str(p_in['custom_domains']).split(',') if d.strip()]
+        else:
+            p_out['remotePort'] = int(p_in.get('remote_port', 0))
+        final_proxies.append(p_out)
+    return final_proxies
+
+
+class ShareCache:
+    """
+    按 share_id 缓存 CompiledShare 的 LRU + TTL 内存缓存。
+    撤销时主动失效；TTL 兜底管理工具直接改库（如删除用户级联删除分享）的情况。
+    """
+    def __init__(self, max_entries=1024, ttl_seconds=300):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()   # share_id -> (compiled, cached_at)
+        self._lock = threading.Lock()
+        # 每次失效都递增；查库前记下的代数与写入时不一致，说明期间发生过撤销，结果不能写入缓存
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, share_id):
+        with self._lock:
+            entry = self._entries.get(share_id)
+            if entry is not None and time.monotonic() - entry[1] <= self.ttl_seconds:
+                self._entries.move_to_end(share_id)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[share_id]
+            self.misses += 1
+            return None
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def put(self, compiled, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[compiled.share_id] = (compiled, time.monotonic())
+            self._entries.move_to_end(compiled.share_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, share_id):
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(share_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "max_entries": self.max_entries, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,419 @@
+# stores.py
+# 临时状态存储：配置票据、登录挑战码、按用户的速率限制记录，以及 Flask-Limiter 的计数器。
+# 默认放在进程内存中；多进程部署时改用 SQLite 后端，让所有工作进程共享同一份状态。
+
+import datetime
+import heapq
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from limits.storage import Storage
+
+
+class ExpiringStore:
+    """
+    带过期时间的键值存储。
+    过期时间记录在最小堆中，每次写入顺带弹出已过期的条目，清理代价是 O(log n) 而不是全表扫描；
+    条目数达到上限时淘汰最早过期的条目。读取时发现已过期的条目视同不存在。
+
+    需要"读取-修改-写回"的复合操作时，调用方应包在 with store.transaction(): 中。
+    """
+    def __init__(self, name, default_ttl, max_entries=10000):
+        self.name = name
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self.lock = threading.RLock()
+        self._data = {}     # key -> (value, expires_at)
+        self._heap = []     # (expires_at, seq, key)；键被覆盖或删除后，堆中的旧记录在弹出时跳过
+        self._seq = itertools.count()
+        self._stats = {"sets": 0, "hits": 0, "misses": 0, "expired": 0, "evicted": 0}
+
+    def set(self, key, value, ttl=None):
+        now = time.monotonic()
+        expires_at = now + (self.default_ttl if ttl is None else ttl)
+        with self.lock:
+            self._sweep(now)
+            if key not in self._data and len(self._data) >= self.max_entries:
+                self._evict_one()
+            self._data[key] = (value, expires_at)
+            heapq.heappush(self._heap, (expires_at, next(self._seq), key))
+            self._stats["sets"] += 1
+            # 频繁覆盖同一个键会在堆中留下大量旧记录，超过一定比例时重建
+            if len(self._heap) > 2 * len(self._data) + 64:
+                self._heap = [(exp, next(self._seq), k) for k, (_, exp) in self._data.items()]
+                heapq.heapify(self._heap)
+
+    def transaction(self):
+        return self.lock
+
+    def replace(self, key, value):
+        """修改已有条目的值，保留其过期时间。条目不存在时不做任何事。"""
+        with self.lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data[key] = (value, entry[1])
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return default
+            if entry[1] <= time.monotonic():
+                del self._data[key]
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return default
+            self._stats["hits"] += 1
+            return entry[0]
+
+    def pop(self, key, default=None):
+        with self.lock:
+            value = self.get(key, self)
+            if value is self:
+                return default
+            del self._data[key]
+            return value
+
+    def delete(self, key):
+        with self.lock:
+            self._data.pop(key, None)
+
+    def ttl(self, key):
+        """返回条目的剩余存活秒数，不存在或已过期时返回 None。"""
+        with self.lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            remaining = entry[1] - time.monotonic()
+            return remaining if remaining > 0 else None
+
+    def sweep(self):
+        """清理所有已过期的条目，返回清理数量。写入时会自动清理，这里供空闲期间的后台任务调用。"""
+        with self.lock:
+            return self._sweep(time.monotonic())
+
+    def _sweep(self, now):
+        removed = 0
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, _, key = heapq.heappop(self._heap)
+            entry = self._data.get(key)
+            if entry is not None and entry[1] == expires_at:
+                del self._data[key]
+                removed += 1
+        self._stats["expired"] += removed
+        return removed
+
+    def _evict_one(self):
+        while self._heap:
+            expires_at, _, key = heapq.heappop(self._heap)
+            entry = self._data.get(key)
+            if entry is not None and entry[1] == expires_at:
+                del self._data[key]
+                self._stats["evicted"] += 1
+                return
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.ttl(key) is not None
+
+    def stats(self):
+        with self.lock:
+            snapshot = dict(self._stats)
+            snapshot["entries"] = len(self._data)
+            snapshot["heap_size"] = len(self._heap)
+        snapshot["max_entries"] = self.max_entries
+        return snapshot
+
+
+# --- SQLite 共享后端 ---
+
+_SHARED_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS ephemeral_entries (
+        store TEXT NOT NULL,
+        key TEXT NOT NULL,
+        value TEXT NOT NULL,
+        expires_at REAL NOT NULL,
+        PRIMARY KEY (store, key)
+    ) WITHOUT ROWID""",
+    'CREATE INDEX IF NOT EXISTS idx_ephemeral_entries_expiry ON ephemeral_entries (store, expires_at)',
+    """CREATE TABLE IF NOT EXISTS limiter_counters (
+        key TEXT PRIMARY KEY,
+        count INTEGER NOT NULL,
+        expires_at REAL NOT NULL
+    ) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS generations (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    ) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS invalidations (
+        scope TEXT NOT NULL,
+        key TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        PRIMARY KEY (scope, key)
+    ) WITHOUT ROWID""",
+    'CREATE INDEX IF NOT EXISTS idx_invalidations_seq ON invalidations (scope, seq)',
+)
+
+
+class SharedDatabase:
+    """
+    临时状态共用的 SQLite 数据库（与 users.db 分开的独立文件，内容可以随时丢弃）。
+    每个线程持有自己的连接；进程 fork 后会重新连接，不复用父进程的连接。
+    """
+    def __init__(self, path, busy_timeout_ms=5000):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        db = self._connect()
+        for statement in _SHARED_SCHEMA:
+            db.execute(statement)
+
+    def _connect(self):
+        # isolation_level=None：单条语句自动提交，复合操作由 transaction() 显式开启事务
+        db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL;')
+        db.execute('PRAGMA synchronous=NORMAL;')
+        db.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)};')
+        self._local.db = db
+        self._local.pid = os.getpid()
+        self._local.depth = 0
+        return db
+
+    def connection(self):
+        if getattr(self._local, 'pid', None) != os.getpid():
+            return self._connect()
+        return self._local.db
+
+    @contextmanager
+    def transaction(self):
+        """写事务（BEGIN IMMEDIATE），同一线程内可嵌套，只有最外层提交。"""
+        db = self.connection()
+        if self._local.depth == 0:
+            db.execute('BEGIN IMMEDIATE')
+        self._local.depth += 1
+        try:
+            yield db
+        except BaseException:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                db.execute('ROLLBACK')
+            raise
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            db.execute('COMMIT')
+
+
+def _json_default(value):
+    if isinstance(value, datetime.datetime):
+        return {"$datetime": value.isoformat()}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def _json_object_hook(obj):
+    if len(obj) == 1 and "$datetime" in obj:
+        return datetime.datetime.fromisoformat(obj["$datetime"])
+    return obj
+
+
+class SQLiteExpiringStore:
+    """
+    与 ExpiringStore 接口相同、存放在共享 SQLite 文件中的实现，供多个工作进程共同使用。
+    值以 JSON 保存（支持 datetime）；过期时间使用墙上时钟，因为各进程的 monotonic 时钟互不相通。
+    写入时按 (store, expires_at) 索引删除已过期条目；数量上限每隔若干次写入检查一次，超出时淘汰最早过期的条目。
+    命中、淘汰等计数只统计本进程。
+    """
+    CAP_CHECK_INTERVAL = 32
+
+    def __init__(self, name, default_ttl, max_entries, database):
+        self.name = name
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self.database = database
+        self._stats_lock = threading.Lock()
+        self._stats = {"sets": 0, "hits": 0, "misses": 0, "expired": 0, "evicted": 0}
+
+    def _count(self, stat, amount=1):
+        with self._stats_lock:
+            self._stats[stat] += amount
+
+    def transaction(self):
+        return self.database.transaction()
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        expires_at = now + (self.default_ttl if ttl is None else ttl)
+        encoded = json.dumps(value, default=_json_default, ensure_ascii=False)
+        with self.database.transaction() as db:
+            self._sweep(db, now)
+            db.execute('INSERT OR REPLACE INTO ephemeral_entries (store, key, value, expires_at) VALUES (?, ?, ?, ?)',
+                       (self.name, key, encoded, expires_at))
+            with self._stats_lock:
+                self._stats["sets"] += 1
+                check_cap = self._stats["sets"] % self.CAP_CHECK_INTERVAL == 0
+            if check_cap:
+                overflow = db.execute('SELECT COUNT(*) FROM ephemeral_entries WHERE store = ?', (self.name,)).fetchone()[0] - self.max_entries
+                if overflow > 0:
+                    db.execute('DELETE FROM ephemeral_entries WHERE store = ? AND key IN '
+                               '(SELECT key FROM ephemeral_entries WHERE store = ? ORDER BY expires_at LIMIT ?)',
+                               (self.name, self.name, overflow))
+                    self._count("evicted", overflow)
+
+    def replace(self, key, value):
+        encoded = json.dumps(value, default=_json_default, ensure_ascii=False)
+        self.database.connection().execute('UPDATE ephemeral_entries SET value = ? WHERE store = ? AND key = ?', (encoded, self.name, key))
+
+    def get(self, key, default=None):
+        row = self.database.connection().execute(
+            'SELECT value FROM ephemeral_entries WHERE store = ? AND key = ? AND expires_at > ?', (self.name, key, time.time())
+        ).fetchone()
+        if row is None:
+            self._count("misses")
+            return default
+        self._count("hits")
+        return json.loads(row[0], object_hook=_json_object_hook)
+
+    def pop(self, key, default=None):
+        with self.database.transaction() as db:
+            value = self.get(key, self)
+            if value is self:
+                return default
+            db.execute('DELETE FROM ephemeral_entries WHERE store = ? AND key = ?', (self.name, key))
+            return value
+
+    def delete(self, key):
+        self.database.connection().execute('DELETE FROM ephemeral_entries WHERE store = ? AND key = ?', (self.name, key))
+
+    def ttl(self, key):
+        row = self.database.connection().execute(
+            'SELECT expires_at FROM ephemeral_entries WHERE store = ? AND key = ?', (self.name, key)
+        ).fetchone()
+        if row is None:
+            return None
+        remaining = row[0] - time.time()
+        return remaining if remaining > 0 else None
+
+    def sweep(self):
+        with self.database.transaction() as db:
+            return self._sweep(db, time.time())
+
+    def _sweep(self, db, now):
+        removed = db.execute('DELETE FROM ephemeral_entries WHERE store = ? AND expires_at <= ?', (self.name, now)).rowcount
+        if removed:
+            self._count("expired", removed)
+        return removed
+
+    def __len__(self):
+        return self.database.connection().execute('SELECT COUNT(*) FROM ephemeral_entries WHERE store = ?', (self.name,)).fetchone()[0]
+
+    def __contains__(self, key):
+        return self.ttl(key) is not None
+
+    def stats(self):
+        with self._stats_lock:
+            snapshot = dict(self._stats)
+        snapshot["entries"] = len(self)
+        snapshot["max_entries"] = self.max_entries
+        return snapshot
+
+
+class SharedInvalidations:
+    """
+    保存在共享数据库中的失效记录，用于在工作进程之间广播"某个键的本地缓存已失效"。
+    每个键只保留一行，记录最近一次失效的序号（序号取自 generations 表中以 scope 命名的计数器）；
+    各进程记住自己已处理到的序号，定期取回之后变化的键，只丢弃这些键的本地缓存。
+    """
+    def __init__(self, database, scope):
+        self.database = database
+        self.scope = scope
+
+    def publish(self, key):
+        """修改方在提交数据库改动后调用。返回本次失效的序号。"""
+        with self.database.transaction() as db:
+            db.execute('INSERT INTO generations (name, value) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1', (self.scope,))
+            seq = db.execute('SELECT value FROM generations WHERE name = ?', (self.scope,)).fetchone()[0]
+            db.execute('INSERT INTO invalidations (scope, key, seq) VALUES (?, ?, ?) '
+                       'ON CONFLICT(scope, key) DO UPDATE SET seq = excluded.seq', (self.scope, key, seq))
+        return seq
+
+    def changes_since(self, seq):
+        """
+        返回 (当前序号, 序号大于 seq 的键列表)。seq 为 None 时只返回当前序号。
+        当前序号小于 seq 说明共享库被删除重建过，调用方应丢弃全部本地缓存。
+        """
+        db = self.database.connection()
+        row = db.execute('SELECT value FROM generations WHERE name = ?', (self.scope,)).fetchone()
+        current = row[0] if row else 0
+        if seq is None or current <= seq:
+            return current, []
+        keys = [key for (key,) in db.execute('SELECT key FROM invalidations WHERE scope = ? AND seq > ?', (self.scope, seq))]
+        return current, keys
+
+
+def create_store(name, default_ttl, max_entries, database=None):
+    """database 为 None 时返回进程内存储，否则返回共享 SQLite 存储。"""
+    if database is None:
+        return ExpiringStore(name, default_ttl, max_entries)
+    return SQLiteExpiringStore(name, default_ttl, max_entries, database)
+
+
+class SQLiteLimiterStorage(Storage):
+    """
+    Flask-Limiter 的 SQLite 存储后端（固定窗口策略），注册为 sqlite:// 协议。
+    路径写法同 SQLAlchemy：sqlite:///ephemeral.db 为相对路径，sqlite:////var/lib/moefrp/ephemeral.db 为绝对路径。
+    """
+    STORAGE_SCHEME = ["sqlite"]
+    PURGE_INTERVAL = 256
+
+    def __init__(self, uri, wrap_exceptions=False, **options):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        self.database = SharedDatabase(uri.split("://", 1)[1][1:])
+        self._incr_count = itertools.count(1)
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def incr(self, key, expiry, amount=1):
+        now = time.time()
+        with self.database.transaction() as db:
+            row = db.execute('SELECT count, expires_at FROM limiter_counters WHERE key = ?', (key,)).fetchone()
+            if row is None or row[1] <= now:
+                count = amount
+                db.execute('INSERT OR REPLACE INTO limiter_counters (key, count, expires_at) VALUES (?, ?, ?)', (key, count, now + expiry))
+            else:
+                count = row[0] + amount
+                db.execute('UPDATE limiter_counters SET count = ? WHERE key = ?', (count, key))
+            # 过期的窗口计数平时只会被覆盖，定期批量删掉不再出现的键
+            if next(self._incr_count) % self.PURGE_INTERVAL == 0:
+                db.execute('DELETE FROM limiter_counters WHERE expires_at <= ?', (now,))
+        return count
+
+    def get(self, key):
+        row = self.database.connection().execute(
+            'SELECT count FROM limiter_counters WHERE key = ? AND expires_at > ?', (key, time.time())
+        ).fetchone()
+        return row[0] if row else 0
+
+    def get_expiry(self, key):
+        row = self.database.connection().execute('SELECT expires_at FROM limiter_counters WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else time.time()
+
+    def check(self):
+        try:
+            self.database.connection().execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self):
+        return self.database.connection().execute('DELETE FROM limiter_counters').rowcount
+
+    def clear(self, key):
+        self.database.connection().execute('DELETE FROM limiter_counters WHERE key = ?', (key,))